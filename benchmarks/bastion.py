@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+#
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Measure throughput and latency of every transport verb against the
+bastiontest fixture application launched locally.
+
+Results are written as JSON, so they can be compared between releases.
+
+Usage: PYTHONPATH=. python benchmarks/bastion.py [--output results.json]
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import math
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+VERB_PATHS = {
+    'get': "/",
+    'head': "/head",
+    'delete': "/delete",
+    'options': "/options",
+    'patch': "/payload",
+    'post': "/payload",
+    'put': "/payload",
+}
+BODY_VERBS = ("patch", "post", "put")
+
+
+def percentile(latencies, percent):
+    """ Return the nearest-rank percentile of sorted latencies.
+    """
+    if not latencies:
+        return None
+    rank = max(int(math.ceil(percent / 100 * len(latencies))), 1)
+    return latencies[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    completed = len(latencies)
+    return {
+        'requests': completed + errors,
+        'errors': errors,
+        'elapsed_s': elapsed,
+        'throughput_rps': completed / elapsed if elapsed else None,
+        'mean_ms': (sum(latencies) / completed * 1000
+                    if completed else None),
+        'p50_ms': (percentile(latencies, 50) or 0) * 1000,
+        'p99_ms': (percentile(latencies, 99) or 0) * 1000,
+    }
+
+
+def request_kwargs(transport_name, verb, payload):
+    if verb not in BODY_VERBS:
+        return {}
+    if transport_name == "asyncio":
+        return {'body': payload}
+    if transport_name == "tornado":
+        # tornado refuses empty bodies for patch, post and put otherwise
+        return {'body': payload, 'allow_nonstandard_methods': not payload}
+    return {'data': payload}
+
+
+def bench_requests(address, verb, concurrency, payload, number):
+    from peasant.client.transport_requests import RequestsTransport
+    kwargs = request_kwargs("requests", verb, payload)
+    latencies = []
+    errors = 0
+    with RequestsTransport(address, pool_maxsize=concurrency) as transport:
+        method = getattr(transport, verb)
+        path = VERB_PATHS[verb]
+
+        def call():
+            start = time.perf_counter()
+            method(path, **kwargs)
+            return time.perf_counter() - start
+
+        method(path, **kwargs)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(call) for _ in range(number)]:
+                try:
+                    latencies.append(future.result())
+                except Exception:
+                    errors += 1
+        elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed)
+
+
+def bench_asyncio(address, verb, concurrency, payload, number):
+    from peasant.client.transport_asyncio import AsyncioTransport
+    transport = AsyncioTransport(address, max_connections=concurrency)
+    return run_async(transport, "asyncio", verb, concurrency, payload,
+                     number)
+
+
+def bench_tornado(address, verb, concurrency, payload, number):
+    from peasant.client.transport_tornado import TornadoTransport
+    transport = TornadoTransport(address, max_clients=concurrency)
+    return run_async(transport, "tornado", verb, concurrency, payload,
+                     number)
+
+
+def run_async(transport, transport_name, verb, concurrency, payload,
+              number):
+    kwargs = request_kwargs(transport_name, verb, payload)
+    latencies = []
+    errors = 0
+
+    async def run():
+        nonlocal errors
+        with transport:
+            method = getattr(transport, verb)
+            path = VERB_PATHS[verb]
+            remaining = iter(range(number))
+
+            async def worker():
+                nonlocal errors
+                for _ in remaining:
+                    start = time.perf_counter()
+                    try:
+                        await method(path, **kwargs)
+                    except Exception:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - start)
+
+            await method(path, **kwargs)
+            start = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    return summarize(latencies, errors, elapsed)
+
+
+BENCHMARKS = {
+    'asyncio': bench_asyncio,
+    'requests': bench_requests,
+    'tornado': bench_tornado,
+}
+
+
+def launch_bastion():
+    """ Launch the bastiontest fixture application in a new process,
+    discarding its output, and return the process and the bastion address.
+
+    The firenado process launcher isn't used, as it only reads the
+    application output while its loop runs and the application would block
+    once the output buffer is full.
+    """
+    from firenado.launcher import ProcessLauncher
+    from tests import chdir_fixture_app, PROJECT_ROOT, wait_for_port
+    from tornado.testing import bind_unused_port
+    sock, port = bind_unused_port()
+    sock.close()
+    application_dir = chdir_fixture_app("bastiontest")
+    launcher = ProcessLauncher(dir=application_dir, path=PROJECT_ROOT)
+    launcher.port = port
+    launcher.load()
+    process = subprocess.Popen(shlex.split(launcher.command),
+                               cwd=application_dir,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, timeout=30)
+    except OSError:
+        process.terminate()
+        raise
+    return process, f"http://localhost:{port}"
+
+
+def main():
+    from peasant import get_version
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--transports", nargs="+", default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS))
+    parser.add_argument("--verbs", nargs="+", default=list(VERB_PATHS),
+                        choices=list(VERB_PATHS))
+    parser.add_argument("--concurrency", nargs="+", type=int,
+                        default=[1, 8, 32])
+    parser.add_argument("--payload-sizes", nargs="+", type=int,
+                        default=[0, 1024, 65536],
+                        help="Body sizes, in bytes, sent by patch, post and "
+                             "put")
+    parser.add_argument("--number", type=int, default=500,
+                        help="Requests sent by each benchmark")
+    parser.add_argument("--output", help="File to write the results to. "
+                                         "Default is stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    process, address = launch_bastion()
+    results = []
+    try:
+        for transport_name in args.transports:
+            for verb in args.verbs:
+                payload_sizes = (args.payload_sizes if verb in BODY_VERBS
+                                 else [0])
+                for payload_size in payload_sizes:
+                    payload = "x" * payload_size
+                    for concurrency in args.concurrency:
+                        result = BENCHMARKS[transport_name](
+                            address, verb, concurrency, payload, args.number)
+                        result.update({
+                            'transport': transport_name,
+                            'verb': verb,
+                            'concurrency': concurrency,
+                            'payload_size': payload_size,
+                        })
+                        print(f"{transport_name:<9} {verb:<8} "
+                              f"c={concurrency:<4} size={payload_size:<7} "
+                              f"{result['throughput_rps']:9.1f} req/s "
+                              f"p50={result['p50_ms']:7.2f}ms "
+                              f"p99={result['p99_ms']:7.2f}ms",
+                              file=sys.stderr)
+                        results.append(result)
+    finally:
+        process.terminate()
+        process.wait()
+
+    report = {
+        'peasant': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'number': args.number,
+        'results': results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Measure the per request overhead peasant adds before the http client is
+called, no socket is touched.
+
+Usage: PYTHONPATH=. python benchmarks/overhead.py [--number N]
+"""
+
+import argparse
+import timeit
+
+BASTION_ADDRESS = "http://localhost:8888"
+
+
+def bench_requests(number):
+    from peasant.client.transport import METHOD_POST
+    from peasant.client.transport_requests import RequestsTransport
+    transport = RequestsTransport(BASTION_ADDRESS)
+
+    def prepare():
+        transport.prepare_request(METHOD_POST, "/post", data="da body",
+                                  headers={'Accept': "text/plain"})
+    return timeit.timeit(prepare, number=number)
+
+
+def bench_tornado(number):
+    from peasant.client.transport import METHOD_POST
+    from peasant.client.transport_tornado import (get_tornado_request,
+                                                  TornadoTransport)
+    transport = TornadoTransport(BASTION_ADDRESS)
+
+    def prepare():
+        url, kwargs = transport.prepare_request(
+            METHOD_POST, "/post", body="da body",
+            headers={'Accept': "text/plain"})
+        get_tornado_request(url, method=METHOD_POST, **kwargs)
+    return timeit.timeit(prepare, number=number)
+
+
+BENCHMARKS = {
+    'requests': bench_requests,
+    'tornado': bench_tornado,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--number", type=int, default=100000,
+                        help="Requests prepared by each benchmark")
+    args = parser.parse_args()
+    for name, bench in BENCHMARKS.items():
+        elapsed = bench(args.number)
+        print(f"{name:<10} {elapsed / args.number * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import Executor, FIRST_COMPLETED, Future, wait
+import logging
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = 10
+
+
+class BatchRequest:
+    """ A request to be sent by a batch.
+    """
+
+    __slots__ = ("method", "path", "kwargs")
+
+    def __init__(self, method: str, path: str, **kwargs):
+        """
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments passed to the transport request
+        """
+        self.method = method
+        self.path = path
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.method} {self.path})"
+
+
+def to_batch_request(spec: t.Union[BatchRequest, tuple, dict]
+                     ) -> BatchRequest:
+    """ Return a `BatchRequest` from a request spec.
+
+    A spec is either a `BatchRequest`, a (method, path) or (method, path,
+    kwargs) tuple, or a dict with method, path and the request kwargs.
+
+    :param spec: The request spec
+    :return BatchRequest:
+    """
+    if isinstance(spec, BatchRequest):
+        return spec
+    if isinstance(spec, dict):
+        spec = dict(spec)
+        return BatchRequest(spec.pop("method"), spec.pop("path"), **spec)
+    if isinstance(spec, (tuple, list)) and 2 <= len(spec) <= 3:
+        kwargs = spec[2] if len(spec) == 3 else {}
+        return BatchRequest(spec[0], spec[1], **kwargs)
+    raise TypeError(f"Invalid batch request spec: {spec!r}")
+
+
+class BatchResult:
+    """ The outcome of a request sent by a batch, either its response or the
+    error raised while sending it.
+    """
+
+    __slots__ = ("index", "request", "response", "error")
+
+    def __init__(self, index: int, request: BatchRequest, response=None,
+                 error: BaseException = None):
+        self.index = index
+        self.request = request
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def result(self):
+        """ Return the response, raising the error if the request failed.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+    def __repr__(self):
+        outcome = "ok" if self.ok else repr(self.error)
+        return (f"{self.__class__.__name__}({self.index}, {self.request!r}, "
+                f"{outcome})")
+
+
+async def iter_batch(transport, requests: t.Iterable,
+                     concurrency: int = BATCH_CONCURRENCY
+                     ) -> t.AsyncIterator[BatchResult]:
+    """ Send requests through an asynchronous transport, at most concurrency
+    at once, yielding a `BatchResult` as each one completes.
+
+    A failed request doesn't stop the others, its error is kept in the
+    result. Requests still running are cancelled if the iteration is
+    interrupted.
+
+    :param Transport transport: The transport sending the requests
+    :param requests: Iterable of request specs
+    :param int concurrency: Maximum number of requests sent at once
+    """
+    requests = [to_batch_request(spec) for spec in requests]
+    if not requests:
+        return
+    if concurrency < 1:
+        raise ValueError("The batch concurrency must be at least 1.")
+    results = asyncio.Queue()
+    pending = iter(enumerate(requests))
+
+    async def worker():
+        for index, request in pending:
+            try:
+                response = await transport.request(
+                    request.method, request.path, **request.kwargs)
+                result = BatchResult(index, request, response=response)
+            except Exception as error:
+                logger.debug("Batch request %r failed: %s", request, error)
+                result = BatchResult(index, request, error=error)
+            results.put_nowait(result)
+
+    workers = [asyncio.ensure_future(worker())
+               for _ in range(min(concurrency, len(requests)))]
+    try:
+        for _ in range(len(requests)):
+            yield await results.get()
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def gather_batch(transport, requests: t.Iterable,
+                       concurrency: int = BATCH_CONCURRENCY
+                       ) -> t.List[BatchResult]:
+    """ Send requests through an asynchronous transport, at most concurrency
+    at once, returning their results in the order they were informed.
+
+    :param Transport transport: The transport sending the requests
+    :param requests: Iterable of request specs
+    :param int concurrency: Maximum number of requests sent at once
+    :return list:
+    """
+    results = [result async for result in iter_batch(
+        transport, requests, concurrency)]
+    results.sort(key=lambda result: result.index)
+    return results
+
+
+def iter_thread_batch(executor: Executor, transport, requests: t.Iterable,
+                      concurrency: int = BATCH_CONCURRENCY
+                      ) -> t.Iterator[BatchResult]:
+    """ Send requests through a synchronous transport from an executor, at
+    most concurrency at once, yielding a `BatchResult` as each one completes.
+
+    Requests are only submitted as others complete, so a batch doesn't
+    flood the executor queue. A failed request doesn't stop the others, its
+    error is kept in the result. Requests not yet started are cancelled if
+    the iteration is interrupted.
+
+    :param Executor executor: The executor running the requests
+    :param Transport transport: The transport sending the requests
+    :param requests: Iterable of request specs
+    :param int concurrency: Maximum number of requests sent at once
+    """
+    if concurrency < 1:
+        raise ValueError("The batch concurrency must be at least 1.")
+    pending = iter(enumerate(to_batch_request(spec) for spec in requests))
+    running = {}
+
+    def submit() -> bool:
+        for index, request in pending:
+            future = executor.submit(transport.request, request.method,
+                                     request.path, **request.kwargs)
+            running[future] = (index, request)
+            return True
+        return False
+
+    try:
+        while len(running) < concurrency and submit():
+            pass
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, request = running.pop(future)
+                yield future_result(future, index, request)
+                submit()
+    finally:
+        for future in running:
+            future.cancel()
+
+
+def future_result(future: Future, index: int,
+                  request: BatchRequest) -> BatchResult:
+    error = future.exception()
+    if error is not None:
+        logger.debug("Batch request %r failed: %s", request, error)
+        return BatchResult(index, request, error=error)
+    return BatchResult(index, request, response=future.result())
+
+
+class AsyncBatchMixin:
+    """ Adds batch and as_completed to asynchronous transports, sending many
+    requests with the concurrency set by the batch_concurrency option.
+    """
+
+    async def batch(self, specs: t.Iterable,
+                    **kwargs) -> t.List[BatchResult]:
+        """ Send requests concurrently, returning a `BatchResult` for each
+        one, in the order they were informed.
+
+        :param specs: Iterable of request specs, see `to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is the transport batch_concurrency.
+        :return list:
+        """
+        return await gather_batch(
+            self, specs, kwargs.get("concurrency", self.batch_concurrency))
+
+    def as_completed(self, specs: t.Iterable,
+                     **kwargs) -> t.AsyncIterator[BatchResult]:
+        """ Send requests concurrently, yielding a `BatchResult` as each one
+        completes.
+
+        :param specs: Iterable of request specs, see `to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is the transport batch_concurrency.
+        """
+        return iter_batch(
+            self, specs, kwargs.get("concurrency", self.batch_concurrency))
@@ -0,0 +1,706 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_METHODS = frozenset(("GET", "HEAD"))
+CACHEABLE_STATUSES = frozenset((200, 203))
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+# headers never stored with a cached response, a nonce is valid only once
+UNCACHED_HEADERS = frozenset(("connection", "keep-alive", "replay-nonce",
+                              "set-cookie", "transfer-encoding"))
+ENTRY_OVERHEAD = 256
+
+
+def get_header(headers: t.Optional[t.Mapping], name: str,
+               default: t.Any = None) -> t.Any:
+    """ Return a header value from a mapping, ignoring the name case.
+
+    Case-insensitive mappings, like the ones returned by requests and
+    tornado responses, are resolved directly.
+
+    :param Mapping headers: The headers mapping
+    :param str name: The header name
+    :param default: Value returned if the header isn't found
+    """
+    if not headers:
+        return default
+    value = headers.get(name)
+    if value is not None:
+        return value
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+def parse_cache_control(value: t.Optional[str]) -> dict:
+    """ Parse a Cache-Control header value into a dict of directives.
+
+    Directives without value, like no-cache, are mapped to True. Numeric
+    values are converted to int.
+
+    :param str value: The Cache-Control header value
+    :return dict:
+    """
+    directives = {}
+    if not value:
+        return directives
+    for directive in value.split(","):
+        directive = directive.strip()
+        if not directive:
+            continue
+        name, _, argument = directive.partition("=")
+        name = name.strip().lower()
+        argument = argument.strip().strip('"')
+        if not argument:
+            directives[name] = True
+            continue
+        try:
+            directives[name] = int(argument)
+        except ValueError:
+            directives[name] = argument
+    return directives
+
+
+def is_seconds(value: t.Any) -> bool:
+    """ Return True if a parsed Cache-Control directive value is a number of
+    seconds, and not a flag.
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class DirectoryCache:
+    """ Keeps the directory served by a bastion and its freshness.
+
+    The directory is fresh for the configured ttl, or for the max-age sent
+    by the bastion in the Cache-Control header. After that it can still be
+    served, for stale_while_revalidate seconds, while it is revalidated.
+    The ETag and Last-Modified validators are kept, so the directory can
+    be revalidated with a conditional request.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key ttl: Seconds the directory is fresh, if the bastion doesn't
+        send a max-age. Default is None, the directory never expires.
+        :key stale_while_revalidate: Seconds a stale directory can be
+        served while it is revalidated, if the bastion doesn't send
+        stale-while-revalidate. Default is 0.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.ttl = kwargs.get("ttl")
+        self.stale_while_revalidate = kwargs.get("stale_while_revalidate", 0)
+        self._clock = kwargs.get("clock", time.monotonic)
+        self._value = None
+        self._etag = None
+        self._last_modified = None
+        self._cache_control = None
+        self._expires_at = None
+        self._stale_until = None
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def etag(self) -> t.Optional[str]:
+        return self._etag
+
+    @property
+    def last_modified(self) -> t.Optional[str]:
+        return self._last_modified
+
+    def is_empty(self) -> bool:
+        return self._value is None
+
+    def is_fresh(self) -> bool:
+        """ Return True if the directory can be served without being
+        revalidated.
+        """
+        if self._value is None:
+            return False
+        return self._expires_at is None or self._clock() < self._expires_at
+
+    def is_usable(self) -> bool:
+        """ Return True if the directory can be served, even stale, while it
+        is revalidated.
+        """
+        if self.is_fresh():
+            return True
+        if self._value is None or self._stale_until is None:
+            return False
+        return self._clock() < self._stale_until
+
+    def conditional_headers(self) -> dict:
+        """ Return headers to revalidate the directory with a conditional
+        request.
+
+        :return dict:
+        """
+        headers = {}
+        if self._value is None:
+            return headers
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+        return headers
+
+    def store(self, value, headers: t.Optional[t.Mapping] = None):
+        """ Store a directory fetched from the bastion.
+
+        :param value: The directory
+        :param Mapping headers: The response headers, used to resolve the
+        directory freshness and validators
+        """
+        if value is None:
+            self.clear()
+            return
+        self._value = value
+        self._etag = get_header(headers, "ETag")
+        self._last_modified = get_header(headers, "Last-Modified")
+        self._cache_control = get_header(headers, "Cache-Control")
+        self._update_freshness()
+
+    def revalidate(self, headers: t.Optional[t.Mapping] = None):
+        """ Mark the directory as fresh again, after the bastion answered a
+        conditional request with 304 Not Modified.
+
+        Headers not sent with the 304 response are kept from the stored
+        directory response.
+
+        :param Mapping headers: The 304 response headers
+        """
+        if self._value is None:
+            return
+        self._etag = get_header(headers, "ETag", self._etag)
+        self._last_modified = get_header(headers, "Last-Modified",
+                                         self._last_modified)
+        self._cache_control = get_header(headers, "Cache-Control",
+                                         self._cache_control)
+        self._update_freshness()
+
+    def clear(self):
+        self._value = None
+        self._etag = None
+        self._last_modified = None
+        self._cache_control = None
+        self._expires_at = None
+        self._stale_until = None
+
+    def _update_freshness(self):
+        directives = parse_cache_control(self._cache_control)
+        ttl = self.ttl
+        if "no-store" in directives or "no-cache" in directives:
+            ttl = 0
+        elif is_seconds(directives.get("max-age")):
+            ttl = directives['max-age']
+        stale_while_revalidate = directives.get("stale-while-revalidate")
+        if not is_seconds(stale_while_revalidate):
+            stale_while_revalidate = self.stale_while_revalidate
+        if ttl is None:
+            self._expires_at = None
+            self._stale_until = None
+            return
+        now = self._clock()
+        self._expires_at = now + ttl
+        self._stale_until = self._expires_at + (stale_while_revalidate or 0)
+
+
+def parse_http_date(value: t.Optional[str]) -> t.Optional[float]:
+    """ Return the timestamp of a HTTP date, or None if it is invalid.
+
+    :param str value: The HTTP date
+    :return float:
+    """
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return date.timestamp()
+
+
+def freshness_lifetime(headers: t.Optional[t.Mapping]) -> t.Optional[float]:
+    """ Return the seconds a response is fresh for, from the Cache-Control
+    max-age or the Expires header, minus its Age.
+
+    :param Mapping headers: The response headers
+    :return float: None if the response has no explicit freshness
+    """
+    directives = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-cache" in directives:
+        lifetime = 0
+    elif is_seconds(directives.get("max-age")):
+        lifetime = directives['max-age']
+    else:
+        expires = get_header(headers, "Expires")
+        if expires is None:
+            return None
+        expires = parse_http_date(expires)
+        if expires is None:
+            # an invalid Expires means already expired
+            return 0
+        date = parse_http_date(get_header(headers, "Date"))
+        lifetime = expires - (time.time() if date is None else date)
+    age = get_header(headers, "Age", "0")
+    age = int(age) if str(age).isdigit() else 0
+    return max(lifetime - age, 0)
+
+
+class CachedResponse:
+    """ A response kept by the `ResponseCache`, transports rebuild their own
+    response type from it.
+    """
+
+    __slots__ = ("method", "url", "code", "reason", "headers", "body", "vary",
+                 "expires_at", "size")
+
+    def __init__(self, method: str, url: str, code: int, reason: str,
+                 headers: dict, body: bytes, vary: dict,
+                 expires_at: float):
+        self.method = method
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.vary = vary
+        self.expires_at = expires_at
+        self.size = ENTRY_OVERHEAD + len(body) + sum(
+            len(name) + len(value) for name, value in headers.items())
+
+    @property
+    def etag(self) -> t.Optional[str]:
+        return get_header(self.headers, "ETag")
+
+    @property
+    def last_modified(self) -> t.Optional[str]:
+        return get_header(self.headers, "Last-Modified")
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+    def matches(self, request_headers: t.Optional[t.Mapping]) -> bool:
+        """ Return True if the request headers selected by the response Vary
+        header are the ones the response was stored for.
+        """
+        return all(get_header(request_headers, name) == value
+                   for name, value in self.vary.items())
+
+    def to_dict(self) -> dict:
+        return {
+            'method': self.method,
+            'url': self.url,
+            'code': self.code,
+            'reason': self.reason,
+            'headers': self.headers,
+            'vary': self.vary,
+            'expires_at': self.expires_at,
+        }
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.method} {self.url})"
+
+
+class DiskCache:
+    """ Disk tier of the `ResponseCache`, keeping the last response of each
+    method and url in a file, up to max_bytes in total.
+
+    Files hold a json line with the response metadata followed by the body.
+    The oldest files are removed when the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param str path: Directory the responses are stored in, created if
+        needed
+        :param int max_bytes: Maximum size of the stored files
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._sizes = OrderedDict()
+        files = []
+        for name in os.listdir(path):
+            if name.endswith(".cache"):
+                stat = os.stat(os.path.join(path, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._sizes[name] = size
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def _file_name(self, method: str, url: str) -> str:
+        digest = hashlib.sha256(f"{method} {url}".encode()).hexdigest()
+        return f"{digest}.cache"
+
+    def get(self, method: str, url: str) -> t.Optional[CachedResponse]:
+        name = self._file_name(method, url)
+        try:
+            with open(os.path.join(self.path, name), "rb") as cache_file:
+                metadata = json.loads(cache_file.readline())
+                body = cache_file.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logger.warning("Discarding unreadable cache file %s: %s", name,
+                           error)
+            self.delete(method, url)
+            return None
+        with self._lock:
+            if name in self._sizes:
+                self._sizes.move_to_end(name)
+        return CachedResponse(body=body, **metadata)
+
+    def put(self, entry: CachedResponse):
+        name = self._file_name(entry.method, entry.url)
+        data = json.dumps(entry.to_dict()).encode() + b"\n" + entry.body
+        if len(data) > self.max_bytes:
+            return
+        # written to a temporary file first, so readers never see a partial
+        # response
+        descriptor, temporary = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(descriptor, "wb") as cache_file:
+                cache_file.write(data)
+            os.replace(temporary, os.path.join(self.path, name))
+        except OSError as error:
+            logger.warning("Unable to write cache file %s: %s", name, error)
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        with self._lock:
+            self._sizes[name] = len(data)
+            self._sizes.move_to_end(name)
+            evicted = []
+            total = sum(self._sizes.values())
+            while total > self.max_bytes:
+                evicted_name, evicted_size = self._sizes.popitem(last=False)
+                evicted.append(evicted_name)
+                total -= evicted_size
+        for evicted_name in evicted:
+            self._remove(evicted_name)
+
+    def delete(self, method: str, url: str):
+        name = self._file_name(method, url)
+        with self._lock:
+            self._sizes.pop(name, None)
+        self._remove(name)
+
+    def clear(self):
+        with self._lock:
+            names = list(self._sizes)
+            self._sizes.clear()
+        for name in names:
+            self._remove(name)
+
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+class CacheLookup:
+    """ A request looked up in the `ResponseCache`, completed with the
+    response received from the bastion if the cached one can't be served.
+    """
+
+    def __init__(self, cache: "ResponseCache", method: str, url: str,
+                 request_headers: t.Optional[t.Mapping],
+                 entry: t.Optional[CachedResponse], fresh: bool):
+        self.cache = cache
+        self.method = method
+        self.url = url
+        self.request_headers = request_headers
+        self.entry = entry
+        self.fresh = fresh
+
+    @property
+    def invalidates(self) -> bool:
+        """ True if the request is unsafe, invalidating the url responses
+        once answered.
+        """
+        return self.method not in SAFE_METHODS
+
+    def conditional_headers(self) -> dict:
+        """ Return headers to revalidate the stale cached response with a
+        conditional request.
+
+        :return dict:
+        """
+        headers = {}
+        if self.entry is None:
+            return headers
+        if self.entry.etag is not None:
+            headers['If-None-Match'] = self.entry.etag
+        if self.entry.last_modified is not None:
+            headers['If-Modified-Since'] = self.entry.last_modified
+        return headers
+
+    def complete(self, code: int, reason: t.Optional[str],
+                 headers: t.Optional[t.Mapping],
+                 body: t.Optional[bytes]) -> t.Optional[CachedResponse]:
+        """ Update the cache with the response received from the bastion.
+
+        :param int code: The response code
+        :param str reason: The response reason
+        :param Mapping headers: The response headers
+        :param bytes body: The response body
+        :return CachedResponse: The revalidated response if the bastion
+        answered 304 Not Modified, otherwise the stored one or None
+        """
+        if self.invalidates:
+            # RFC 9111 section 4.4, only a non-error response invalidates
+            if code < 400:
+                self.cache.invalidate(self.url)
+            return None
+        if code == 304 and self.entry is not None:
+            return self.cache.revalidate(self.entry, headers)
+        return self.cache.store(self.method, self.url, self.request_headers,
+                                code, reason, headers, body)
+
+
+class ResponseCache:
+    """ HTTP cache of GET and HEAD responses, shared by the requests of one
+    or more transports.
+
+    Responses are kept while fresh, as set by Cache-Control max-age or
+    Expires, and revalidated with a conditional request when stale if they
+    have an ETag or Last-Modified validator. Vary is honoured, keeping a
+    response per variant. Responses live in a memory LRU bounded by
+    max_bytes and, if a disk_path is set, in a disk tier surviving
+    restarts. Unsafe requests to an url answered with a non-error response
+    invalidate its responses.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key max_bytes: Maximum size of the responses kept in memory.
+        Default is 16MB.
+        :key max_entry_bytes: Maximum size of a response kept in memory,
+        bigger ones only go to the disk tier. Default is a quarter of
+        max_bytes.
+        :key disk_path: Directory of the disk tier. Default is None, no disk
+        tier.
+        :key disk_max_bytes: Maximum size of the disk tier. Default is
+        256MB.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.time`, as responses on disk outlive the process.
+        """
+        self.max_bytes = kwargs.get("max_bytes", 16 * 1024 * 1024)
+        self.max_entry_bytes = kwargs.get("max_entry_bytes",
+                                          self.max_bytes // 4)
+        self._clock = kwargs.get("clock", time.time)
+        self.disk = None
+        if kwargs.get("disk_path") is not None:
+            self.disk = DiskCache(kwargs['disk_path'],
+                                  kwargs.get("disk_max_bytes",
+                                             256 * 1024 * 1024))
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self) -> int:
+        """ Size of the responses kept in memory.
+        """
+        return self._size
+
+    def __len__(self):
+        return sum(len(variants) for variants in self._entries.values())
+
+    def lookup(self, method: str, url: str,
+               request_headers: t.Optional[t.Mapping] = None
+               ) -> t.Optional[CacheLookup]:
+        """ Look up the cached response of a request.
+
+        :param str method: The request method
+        :param str url: The request url
+        :param Mapping request_headers: The request headers
+        :return CacheLookup: None if the request must bypass the cache. An
+        unsafe request gets a lookup without entry, invalidating the url
+        responses when completed with a non-error response
+        """
+        method = method.upper()
+        if method not in CACHEABLE_METHODS:
+            if method not in SAFE_METHODS:
+                return CacheLookup(self, method, url, request_headers, None,
+                                   False)
+            return None
+        directives = parse_cache_control(
+            get_header(request_headers, "Cache-Control"))
+        if "no-store" in directives:
+            return None
+        if (get_header(request_headers, "If-None-Match") is not None or
+                get_header(request_headers, "If-Modified-Since") is not None):
+            # the caller is revalidating its own copy
+            return None
+        entry = self._get(method, url, request_headers)
+        fresh = (entry is not None and "no-cache" not in directives and
+                 directives.get("max-age") != 0 and
+                 entry.is_fresh(self._clock()))
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return CacheLookup(self, method, url, request_headers, entry, fresh)
+
+    def _get(self, method: str, url: str,
+             request_headers: t.Optional[t.Mapping]
+             ) -> t.Optional[CachedResponse]:
+        key = (method, url)
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants is not None:
+                self._entries.move_to_end(key)
+                for entry in variants:
+                    if entry.matches(request_headers):
+                        return entry
+        if self.disk is None:
+            return None
+        entry = self.disk.get(method, url)
+        if entry is None or not entry.matches(request_headers):
+            return None
+        self._put(entry)
+        return entry
+
+    def store(self, method: str, url: str,
+              request_headers: t.Optional[t.Mapping], code: int,
+              reason: t.Optional[str], headers: t.Optional[t.Mapping],
+              body: t.Optional[bytes]) -> t.Optional[CachedResponse]:
+        """ Store a response if it can be cached.
+
+        A response is stored if its code is cacheable, it doesn't forbid
+        storage, and it is either fresh or can be revalidated.
+
+        :return CachedResponse: None if the response wasn't stored
+        """
+        method = method.upper()
+        if method not in CACHEABLE_METHODS or code not in CACHEABLE_STATUSES:
+            return None
+        directives = parse_cache_control(get_header(headers,
+                                                    "Cache-Control"))
+        if "no-store" in directives:
+            return None
+        vary = get_header(headers, "Vary", "")
+        if vary.strip() == "*":
+            return None
+        lifetime = freshness_lifetime(headers)
+        stored_headers = {name: value for name, value in (
+            headers or {}).items() if name.lower() not in UNCACHED_HEADERS}
+        if lifetime is None:
+            if (get_header(headers, "ETag") is None and
+                    get_header(headers, "Last-Modified") is None):
+                return None
+            lifetime = 0
+        entry = CachedResponse(
+            method, url, code, reason or "", stored_headers, body or b"",
+            {name.strip().lower(): get_header(request_headers, name.strip())
+             for name in vary.split(",") if name.strip()},
+            self._clock() + lifetime)
+        self._put(entry)
+        if self.disk is not None:
+            self.disk.put(entry)
+        return entry
+
+    def revalidate(self, entry: CachedResponse,
+                   headers: t.Optional[t.Mapping]) -> CachedResponse:
+        """ Refresh a cached response after the bastion answered a
+        conditional request with 304 Not Modified, updating the headers sent
+        with the 304 response.
+
+        :return CachedResponse:
+        """
+        stored_headers = dict(entry.headers)
+        for name, value in (headers or {}).items():
+            if name.lower() in UNCACHED_HEADERS:
+                continue
+            for stored_name in [stored_name for stored_name in stored_headers
+                                if stored_name.lower() == name.lower()]:
+                del stored_headers[stored_name]
+            stored_headers[name] = value
+        lifetime = freshness_lifetime(stored_headers) or 0
+        refreshed = CachedResponse(
+            entry.method, entry.url, entry.code, entry.reason,
+            stored_headers, entry.body, entry.vary, self._clock() + lifetime)
+        self._put(refreshed)
+        if self.disk is not None:
+            self.disk.put(refreshed)
+        return refreshed
+
+    def _put(self, entry: CachedResponse):
+        if entry.size > self.max_entry_bytes:
+            return
+        key = (entry.method, entry.url)
+        with self._lock:
+            variants = self._entries.pop(key, [])
+            kept = []
+            for variant in variants:
+                if variant.vary == entry.vary:
+                    self._size -= variant.size
+                else:
+                    kept.append(variant)
+            kept.append(entry)
+            self._size += entry.size
+            self._entries[key] = kept
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= sum(variant.size for variant in evicted)
+
+    def invalidate(self, url: str):
+        """ Forget the responses of an url.
+
+        :param str url: The url
+        """
+        with self._lock:
+            for method in CACHEABLE_METHODS:
+                variants = self._entries.pop((method, url), ())
+                self._size -= sum(variant.size for variant in variants)
+        if self.disk is not None:
+            for method in CACHEABLE_METHODS:
+                self.disk.delete(method, url)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,218 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+import logging
+import math
+import threading
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """ Keeps the latencies of the last window requests, to estimate a
+    latency percentile.
+    """
+
+    def __init__(self, window: int = 100):
+        """
+        :param int window: Number of latencies kept
+        """
+        self._latencies = deque(maxlen=window)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            self._sorted = None
+
+    def percentile(self, percentile: float) -> t.Optional[float]:
+        """ Return the latency below which the percentile of the recorded
+        latencies fall, or None if nothing was recorded.
+
+        :param float percentile: Percentile between 0 and 1
+        :return float:
+        """
+        with self._lock:
+            if not self._latencies:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._latencies)
+            index = max(math.ceil(percentile * len(self._sorted)) - 1, 0)
+            return self._sorted[index]
+
+
+class HedgeBudget:
+    """ Token bucket capping the extra load generated by hedged requests.
+
+    Every request adds ratio tokens, up to max_tokens, and every hedge takes
+    a token, so hedges stay around ratio of the requests sent.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key ratio: Hedges allowed per request sent. Default is 0.1.
+        :key max_tokens: Hedges allowed in a burst. Default is 10.
+        """
+        self.ratio = kwargs.get("ratio", 0.1)
+        self.max_tokens = kwargs.get("max_tokens", 10)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def on_request(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def try_spend(self) -> bool:
+        """ Take a token for a hedge.
+
+        :return bool: True if the hedge is allowed
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class HedgePolicy:
+    """ Decide when a duplicate of a slow request is sent.
+
+    A request not answered within the percentile of the recent latencies is
+    sent again, and the first response is taken. Hedging only starts after
+    min_samples latencies were recorded, and is capped by a `HedgeBudget`.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key percentile: Latency percentile after which a hedge is sent.
+        Default is 0.95.
+        :key window: Number of recent latencies the percentile is computed
+        from. Default is 100.
+        :key min_samples: Latencies recorded before hedging starts. Default
+        is 20.
+        :key min_delay: Shortest delay before a hedge, in seconds. Default is
+        0.01.
+        :key max_delay: Longest delay before a hedge, in seconds. Default is
+        None, no limit.
+        :key budget: The `HedgeBudget` shared by requests using the policy.
+        Default is a new `HedgeBudget`.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.percentile = kwargs.get("percentile", 0.95)
+        self.min_samples = kwargs.get("min_samples", 20)
+        self.min_delay = kwargs.get("min_delay", 0.01)
+        self.max_delay = kwargs.get("max_delay")
+        self.budget = kwargs.get("budget") or HedgeBudget()
+        self.latencies = LatencyTracker(kwargs.get("window", 100))
+        self._clock = kwargs.get("clock", time.monotonic)
+
+    def delay(self) -> t.Optional[float]:
+        """ Return the seconds to wait for a response before sending a
+        hedge, or None if there aren't enough latencies recorded.
+
+        :return float:
+        """
+        latency = self.latencies.percentile(self.percentile)
+        if latency is None or len(self.latencies) < self.min_samples:
+            return None
+        delay = max(latency, self.min_delay)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+
+async def hedge(policy: HedgePolicy,
+                send: t.Callable[[], t.Awaitable]) -> t.Any:
+    """ Await send, calling it again if it doesn't complete within the
+    policy delay, and return the first successful result.
+
+    The request still running is cancelled once a result is taken. An error
+    is only raised if every request sent failed.
+
+    The latency of the first request is recorded whether it wins or not, a
+    first request cancelled because the hedge won is recorded with the time
+    it ran until then, a lower bound of its latency. Recording only the
+    winners would bias the percentile down, sending more hedges over time.
+
+    :param HedgePolicy policy: The hedging policy
+    :param send: Callable returning a new awaitable of the request
+    :return: The result of the first request to succeed
+    """
+    clock = policy._clock
+    policy.budget.on_request()
+    delay = policy.delay()
+
+    def start() -> asyncio.Future:
+        task = asyncio.ensure_future(send())
+        started[task] = clock()
+        return task
+
+    started = {}
+    primary = start()
+    tasks = {primary}
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and policy.budget.try_spend():
+                logger.debug("Hedging request not answered in %.3fs.", delay)
+                tasks.add(start())
+        while True:
+            done, tasks = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    if task is primary or not primary.done():
+                        policy.latencies.record(clock() - started[primary])
+                    return task.result()
+            if not tasks:
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AsyncHedgeMixin:
+    """ Adds hedging to the get method of asynchronous transports, as set by
+    the hedge_policy option.
+    """
+
+    async def get(self, path: str, **kwargs: dict):
+        """ Send a GET request, hedged if the transport has a hedge_policy.
+
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments passed to `request`
+        """
+        # the transport module imports this one
+        from peasant.client.transport import METHOD_GET
+        if self.hedge_policy is None:
+            return await self.request(METHOD_GET, path, **kwargs)
+        return await hedge(self.hedge_policy,
+                           lambda: self.request(METHOD_GET, path, **kwargs))
@@ -0,0 +1,120 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+NONCE_HEADER = "Replay-Nonce"
+
+_harvest_suppressed = contextvars.ContextVar("peasant_harvest_suppressed",
+                                             default=False)
+
+
+@contextlib.contextmanager
+def harvest_suppressed():
+    """ Stop nonces from being harvested from responses received in the
+    current context.
+
+    Used while a nonce is fetched to be handed out directly, so the same
+    nonce doesn't also land in the pool.
+    """
+    token = _harvest_suppressed.set(True)
+    try:
+        yield
+    finally:
+        _harvest_suppressed.reset(token)
+
+
+def is_harvest_suppressed() -> bool:
+    return _harvest_suppressed.get()
+
+
+class NoncePool:
+    """ Thread-safe pool of nonces ready to be used.
+
+    The pool holds up to size nonces, handing out the oldest first. When it
+    drops below the low watermark it should be refilled. Nonces older than
+    max_age are discarded, as the bastion may not accept them anymore.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key size: Maximum number of nonces kept. Default is 10.
+        :key low_watermark: Number of nonces below which the pool needs to
+        be refilled. Default is 2.
+        :key max_age: Seconds a nonce is kept before being discarded.
+        Default is None, nonces never expire.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.size = kwargs.get("size", 10)
+        self.low_watermark = min(kwargs.get("low_watermark", 2), self.size)
+        self.max_age = kwargs.get("max_age")
+        self._clock = kwargs.get("clock", time.monotonic)
+        self._nonces = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nonces)
+
+    def put(self, nonce: t.Optional[str]) -> bool:
+        """ Add a nonce to the pool.
+
+        :param str nonce: The nonce
+        :return bool: False if the nonce wasn't added because it is empty or
+        the pool is full
+        """
+        if not nonce:
+            return False
+        with self._lock:
+            if len(self._nonces) >= self.size:
+                return False
+            self._nonces.append((nonce, self._clock()))
+        return True
+
+    def pop(self) -> t.Optional[str]:
+        """ Remove and return the oldest valid nonce, or None if the pool is
+        empty.
+
+        :return str:
+        """
+        with self._lock:
+            while self._nonces:
+                nonce, stored_at = self._nonces.popleft()
+                if (self.max_age is None or
+                        self._clock() - stored_at < self.max_age):
+                    return nonce
+        return None
+
+    def missing(self) -> int:
+        """ Return how many nonces are needed to fill the pool.
+
+        :return int:
+        """
+        return max(self.size - len(self._nonces), 0)
+
+    def needs_refill(self) -> bool:
+        return len(self._nonces) < self.low_watermark
+
+    def clear(self):
+        with self._lock:
+            self._nonces.clear()
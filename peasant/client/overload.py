@@ -0,0 +1,423 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+import logging
+import threading
+import time
+import typing as t
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+_registry_lock = threading.Lock()
+_circuit_breakers = {}
+_limiters = {}
+
+
+def is_overload(code: t.Optional[int] = None,
+                error: t.Optional[BaseException] = None) -> bool:
+    """ Return True if a request outcome shows the bastion is failing or
+    overloaded: an error, a 5xx or a 429 response.
+    """
+    if error is not None:
+        return True
+    return code is not None and (code >= 500 or code == 429)
+
+
+class CircuitOpenError(Exception):
+    """ Raised when a request is refused because the circuit breaker of its
+    bastion is open.
+    """
+
+    def __init__(self, breaker: "CircuitBreaker"):
+        self.breaker = breaker
+        super().__init__(f"Circuit breaker {breaker.name or ''} is open, "
+                         f"retry in {breaker.retry_in():.2f}s.")
+
+
+class CircuitBreaker:
+    """ Stops requests to a failing bastion.
+
+    The breaker opens after failure_threshold consecutive failures, refusing
+    every request for reset_timeout seconds. Then it is half-open, letting
+    half_open_requests probe requests through. A successful probe closes the
+    breaker, while a failed one opens it again.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key name: Name used in logs and errors, like the bastion address.
+        :key failure_threshold: Consecutive failures opening the breaker.
+        Default is 5.
+        :key reset_timeout: Seconds the breaker stays open. Default is 30.
+        :key half_open_requests: Probe requests let through while half-open.
+        Default is 1.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.name = kwargs.get("name")
+        self.failure_threshold = kwargs.get("failure_threshold", 5)
+        self.reset_timeout = kwargs.get("reset_timeout", 30)
+        self.half_open_requests = kwargs.get("half_open_requests", 1)
+        self._clock = kwargs.get("clock", time.monotonic)
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._update_state()
+            return self._state
+
+    def _update_state(self):
+        if (self._state == STATE_OPEN and
+                self._clock() - self._opened_at >= self.reset_timeout):
+            logger.debug("Circuit breaker %s is half-open.", self.name)
+            self._state = STATE_HALF_OPEN
+            self._half_open_at = self._clock()
+            self._probes = 0
+
+    def retry_in(self) -> float:
+        """ Return the seconds until an open breaker lets requests through.
+        """
+        if self._opened_at is None:
+            return 0.0
+        return max(self._opened_at + self.reset_timeout - self._clock(), 0.0)
+
+    def allow(self) -> bool:
+        """ Return True if a request can be sent, counting it as a probe if
+        the breaker is half-open.
+        """
+        with self._lock:
+            self._update_state()
+            if self._state == STATE_CLOSED:
+                return True
+            if self._state != STATE_HALF_OPEN:
+                return False
+            if (self._probes >= self.half_open_requests and
+                    self._clock() - self._half_open_at >= self.reset_timeout):
+                # probes never reported back, let new ones through
+                self._half_open_at = self._clock()
+                self._probes = 0
+            if self._probes < self.half_open_requests:
+                self._probes += 1
+                return True
+            return False
+
+    def check(self):
+        """ Raise `CircuitOpenError` if a request can't be sent.
+        """
+        if not self.allow():
+            raise CircuitOpenError(self)
+
+    def record_success(self):
+        with self._lock:
+            if self._state == STATE_HALF_OPEN:
+                logger.debug("Circuit breaker %s is closed.", self.name)
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == STATE_HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                if self._state != STATE_OPEN:
+                    logger.warning("Circuit breaker %s is open after %s "
+                                   "failures.", self.name, self._failures)
+                self._state = STATE_OPEN
+                self._opened_at = self._clock()
+
+    def reset(self):
+        with self._lock:
+            self._state = STATE_CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._probes = 0
+
+
+class AIMDLimiter:
+    """ Limits the requests sent at once to a bastion, adapting the limit to
+    how the bastion copes with the load.
+
+    The limit grows by one each round of successful requests using most of
+    it (additive increase), and is multiplied by backoff_ratio when a
+    request fails, is answered with 429 or 5xx, or takes longer than
+    latency_threshold (multiplicative decrease). Requests beyond the limit
+    wait for a permit, both from threads and coroutines.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key initial_limit: Limit the limiter starts with. Default is 10.
+        :key min_limit: Lowest limit. Default is 1.
+        :key max_limit: Highest limit. Default is 200.
+        :key backoff_ratio: Ratio the limit is multiplied by when the
+        bastion is overloaded. Default is 0.9.
+        :key latency_threshold: Seconds above which a request is taken as a
+        sign of overload. Default is None, latency isn't considered.
+        """
+        self.min_limit = kwargs.get("min_limit", 1)
+        self.max_limit = kwargs.get("max_limit", 200)
+        self.backoff_ratio = kwargs.get("backoff_ratio", 0.9)
+        self.latency_threshold = kwargs.get("latency_threshold")
+        self._limit = float(min(max(kwargs.get("initial_limit", 10),
+                                    self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._async_waiters = deque()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def try_acquire(self) -> bool:
+        """ Take a permit if one is available, without waiting.
+        """
+        with self._condition:
+            if self._in_flight < int(self._limit):
+                self._in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float = None) -> bool:
+        """ Wait for a permit.
+
+        :param float timeout: Seconds to wait. Default is None, wait until a
+        permit is available.
+        :return bool: False if the timeout expired
+        """
+        with self._condition:
+            acquired = self._condition.wait_for(
+                lambda: self._in_flight < int(self._limit), timeout)
+            if acquired:
+                self._in_flight += 1
+            return acquired
+
+    async def acquire_async(self, timeout: float = None) -> bool:
+        """ Wait for a permit without blocking the event loop.
+
+        :param float timeout: Seconds to wait. Default is None, wait until a
+        permit is available.
+        :return bool: False if the timeout expired
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - loop.time()
+            # checking the permit and queueing the waiter under the same lock,
+            # a release from another thread can't slip in between
+            with self._condition:
+                if self._in_flight < int(self._limit):
+                    self._in_flight += 1
+                    return True
+                if remaining is not None and remaining <= 0:
+                    return False
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except BaseException as error:
+                self._abandon(loop, waiter)
+                if isinstance(error, asyncio.TimeoutError):
+                    return False
+                raise
+
+    def _abandon(self, loop: asyncio.AbstractEventLoop,
+                 waiter: asyncio.Future):
+        """ Take a waiter that timed out or was cancelled out of the queue.
+        A waiter no longer queued was picked by a release, so the wakeup is
+        passed on to the next one.
+        """
+        with self._condition:
+            try:
+                self._async_waiters.remove((loop, waiter))
+            except ValueError:
+                self._wake_next()
+
+    def _wake_next(self):
+        # called with the condition lock held
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if waiter.done():
+                continue
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # the waiter loop is closed
+                continue
+            break
+
+    def release(self, latency: float = None, overloaded: bool = False,
+                adapt: bool = True):
+        """ Give a permit back, adapting the limit to the request outcome.
+
+        :param float latency: Seconds the request took
+        :param bool overloaded: True if the request outcome shows the
+        bastion is overloaded
+        :param bool adapt: False if the request outcome says nothing about
+        the bastion, like a cancelled request, so the limit is kept
+        """
+        if (not overloaded and self.latency_threshold is not None and
+                latency is not None and latency > self.latency_threshold):
+            overloaded = True
+        with self._condition:
+            if not adapt:
+                pass
+            elif overloaded:
+                self._limit = max(self._limit * self.backoff_ratio,
+                                  self.min_limit)
+            elif self._in_flight * 2 >= self._limit:
+                self._limit = min(self._limit + 1 / self._limit,
+                                  self.max_limit)
+            self._in_flight -= 1
+            self._condition.notify()
+            self._wake_next()
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class OverloadGuard:
+    """ Runs the request attempts to a bastion through its circuit breaker
+    and concurrency limiter.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key circuit_breaker: The `CircuitBreaker` of the bastion.
+        :key limiter: The `AIMDLimiter` of the bastion.
+        :key limiter_timeout: Seconds to wait for a limiter permit, before
+        raising TimeoutError. Default is None, wait until one is available.
+        """
+        self.circuit_breaker = kwargs.get("circuit_breaker")
+        self.limiter = kwargs.get("limiter")
+        self.limiter_timeout = kwargs.get("limiter_timeout")
+
+    def enter(self) -> float:
+        """ Wait until a request attempt can be sent.
+
+        :return float: The attempt start time, to be informed to `exit`
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check()
+        if self.limiter is not None:
+            if not self.limiter.acquire(self.limiter_timeout):
+                self._limiter_timeout()
+        return time.monotonic()
+
+    async def enter_async(self) -> float:
+        """ Wait until a request attempt can be sent, without blocking the
+        event loop.
+
+        :return float: The attempt start time, to be informed to `exit`
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.check()
+        if self.limiter is not None:
+            if not await self.limiter.acquire_async(self.limiter_timeout):
+                self._limiter_timeout()
+        return time.monotonic()
+
+    def _limiter_timeout(self):
+        if self.circuit_breaker is not None:
+            # the probe let through by a half-open breaker wasn't sent
+            self.circuit_breaker.record_failure()
+        raise TimeoutError("Timed out waiting for a concurrency limiter "
+                           "permit.")
+
+    def exit(self, started_at: float, code: t.Optional[int] = None,
+             error: t.Optional[BaseException] = None):
+        """ Record the outcome of a request attempt.
+
+        :param float started_at: The value returned by `enter`
+        :param int code: The response code
+        :param BaseException error: The error raised by the attempt
+        """
+        overloaded = is_overload(code, error)
+        if self.circuit_breaker is not None:
+            if overloaded:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        if self.limiter is not None:
+            self.limiter.release(time.monotonic() - started_at, overloaded)
+
+    def cancel(self, started_at: float):
+        """ Give the limiter permit of an attempt back without recording an
+        outcome, as the attempt was cancelled or failed for a reason not
+        related to the bastion.
+
+        :param float started_at: The value returned by `enter`
+        """
+        if self.limiter is not None:
+            self.limiter.release(adapt=False)
+
+
+def get_circuit_breaker(address: str, **kwargs) -> CircuitBreaker:
+    """ Return the circuit breaker shared by every transport of a bastion
+    address, creating it with the kwargs if needed.
+
+    :param str address: The bastion address
+    :param dict kwargs: `CircuitBreaker` arguments
+    :return CircuitBreaker:
+    """
+    with _registry_lock:
+        breaker = _circuit_breakers.get(address)
+        if breaker is None:
+            kwargs.setdefault("name", address)
+            breaker = _circuit_breakers[address] = CircuitBreaker(**kwargs)
+        return breaker
+
+
+def get_limiter(address: str, **kwargs) -> AIMDLimiter:
+    """ Return the concurrency limiter shared by every transport of a
+    bastion address, creating it with the kwargs if needed.
+
+    :param str address: The bastion address
+    :param dict kwargs: `AIMDLimiter` arguments
+    :return AIMDLimiter:
+    """
+    with _registry_lock:
+        limiter = _limiters.get(address)
+        if limiter is None:
+            limiter = _limiters[address] = AIMDLimiter(**kwargs)
+        return limiter
+
+
+def clear_registry():
+    """ Forget every shared circuit breaker and limiter.
+    """
+    with _registry_lock:
+        _circuit_breakers.clear()
+        _limiters.clear()
@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from peasant.client.transport import Transport
+import asyncio
+import inspect
 import logging
+import threading
+from peasant.client.cache import DirectoryCache, get_header
+from peasant.client.nonce import (harvest_suppressed, is_harvest_suppressed,
+                                  NONCE_HEADER, NoncePool)
+from peasant.client.transport import Transport
 
 logger = logging.getLogger(__name__)
 
@@ -22,42 +28,263 @@ class Peasant(object):
 
     _transport: Transport
 
-    def __init__(self, transport):
-        self._directory_cache = None
+    def __init__(self, transport, **kwargs):
+        """
+        :param Transport transport: The transport used to reach the bastion
+        :param dict kwargs:
+        :key directory_cache: The `DirectoryCache` holding the bastion
+        directory. If not informed one is created with the directory_ttl
+        and directory_stale_while_revalidate values.
+        :key directory_ttl: Seconds the directory is fresh, if the bastion
+        doesn't send a max-age. Default is None, the directory never expires.
+        :key directory_stale_while_revalidate: Seconds a stale directory is
+        served while it is revalidated. Default is 0.
+        :key nonce_pool: A `NoncePool` to keep nonces ready to be used. If
+        not informed a pool is created when nonce_pool_size is informed,
+        otherwise every nonce is fetched by the transport.
+        :key nonce_pool_size: Maximum number of nonces kept in the pool.
+        :key nonce_low_watermark: Number of nonces below which the pool is
+        refilled in background. Default is 2.
+        :key nonce_max_age: Seconds a pooled nonce is valid. Default is None.
+        :key nonce_header: Response header nonces are harvested from.
+        Default is Replay-Nonce.
+        """
+        self._directory_cache = kwargs.get("directory_cache")
+        if self._directory_cache is None:
+            self._directory_cache = DirectoryCache(
+                ttl=kwargs.get("directory_ttl"),
+                stale_while_revalidate=kwargs.get(
+                    "directory_stale_while_revalidate", 0))
+        self._directory_lock = threading.Lock()
+        self._nonce_pool = kwargs.get("nonce_pool")
+        if self._nonce_pool is None and kwargs.get("nonce_pool_size"):
+            self._nonce_pool = NoncePool(
+                size=kwargs['nonce_pool_size'],
+                low_watermark=kwargs.get("nonce_low_watermark", 2),
+                max_age=kwargs.get("nonce_max_age"))
+        self.nonce_header = kwargs.get("nonce_header", NONCE_HEADER)
+        self._nonce_refill_thread = None
+        self._nonce_lock = threading.Lock()
         self._transport = transport
         self._transport.peasant = self
 
     @property
     def directory_cache(self):
-        return self._directory_cache
+        """ The cached bastion directory.
+
+        Transports implementing `set_directory` either set this property or
+        call `store_directory` with the response headers, so the directory
+        freshness and validators are kept.
+        """
+        return self._directory_cache.value
 
     @directory_cache.setter
     def directory_cache(self, directory_cache):
-        self._directory_cache = directory_cache
+        self._directory_cache.store(directory_cache)
+
+    @property
+    def directory_cache_backend(self) -> DirectoryCache:
+        return self._directory_cache
+
+    @property
+    def nonce_pool(self) -> NoncePool:
+        return self._nonce_pool
 
     @property
     def transport(self):
         return self._transport
 
+    def directory_headers(self) -> dict:
+        """ Return the headers a transport should send to revalidate the
+        directory with a conditional request.
+
+        :return dict:
+        """
+        return self._directory_cache.conditional_headers()
+
+    def store_directory(self, directory, headers=None):
+        """ Store the directory fetched by the transport.
+
+        :param directory: The directory
+        :param headers: The response headers
+        """
+        self._directory_cache.store(directory, headers)
+
+    def revalidate_directory(self, headers=None):
+        """ Keep the cached directory, as the bastion answered the
+        conditional request with 304 Not Modified.
+
+        :param headers: The response headers
+        """
+        self._directory_cache.revalidate(headers)
+
     def directory(self):
-        if self.directory_cache is None:
+        cache = self._directory_cache
+        if cache.is_fresh():
+            return cache.value
+        if cache.is_usable():
+            if self._directory_lock.acquire(blocking=False):
+                logger.debug("Revalidating stale directory in background.")
+                threading.Thread(target=self._refresh_directory,
+                                 args=(True,), daemon=True).start()
+            return cache.value
+        with self._directory_lock:
+            if not cache.is_fresh():
+                self.transport.set_directory()
+        return cache.value
+
+    def _refresh_directory(self, locked=False):
+        try:
             self.transport.set_directory()
-        return self.directory_cache
+        except Exception:
+            logger.exception("Error revalidating the directory.")
+        finally:
+            if locked:
+                self._directory_lock.release()
+
+    def harvest_nonce(self, headers):
+        """ Add the nonce sent with a response to the nonce pool, if any.
+
+        Transports call this for every response received, so most calls to
+        `new_nonce` find a nonce already available.
+
+        :param headers: The response headers
+        """
+        if self._nonce_pool is None or is_harvest_suppressed():
+            return
+        self._nonce_pool.put(get_header(headers, self.nonce_header))
 
     def new_nonce(self):
-        return self.transport.new_nonce()
+        if self._nonce_pool is None:
+            return self.transport.new_nonce()
+        nonce = self._nonce_pool.pop()
+        if nonce is None:
+            with harvest_suppressed():
+                nonce = self.transport.new_nonce()
+        if self._nonce_pool.needs_refill():
+            self._refill_nonces()
+        return nonce
+
+    def _refill_nonces(self):
+        with self._nonce_lock:
+            if self._nonce_refill_thread is not None:
+                return
+            self._nonce_refill_thread = threading.Thread(
+                target=self._fill_nonce_pool, daemon=True)
+            self._nonce_refill_thread.start()
+
+    def _fill_nonce_pool(self):
+        try:
+            with harvest_suppressed():
+                for _ in range(self._nonce_pool.missing()):
+                    if not self._nonce_pool.put(self.transport.new_nonce()):
+                        break
+        except Exception:
+            logger.exception("Error refilling the nonce pool.")
+        finally:
+            with self._nonce_lock:
+                self._nonce_refill_thread = None
 
 
 class AsyncPeasant(Peasant):
 
-    def __init__(self, transport):
-        super(AsyncPeasant, self).__init__(transport)
+    def __init__(self, transport, **kwargs):
+        super(AsyncPeasant, self).__init__(transport, **kwargs)
+        self._directory_future = None
+        self._nonce_future = None
+
+    async def batch(self, specs, **kwargs):
+        """ Send many requests through the transport, at most concurrency at
+        once, returning a `peasant.client.batch.BatchResult` for each one in
+        the order they were informed.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is the transport batch_concurrency.
+        :return list:
+        """
+        return await self.transport.batch(specs, **kwargs)
+
+    def as_completed(self, specs, **kwargs):
+        """ Send many requests through the transport, at most concurrency at
+        once, yielding a `peasant.client.batch.BatchResult` as each one
+        completes.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is the transport batch_concurrency.
+        """
+        return self.transport.as_completed(specs, **kwargs)
+
+    async def new_nonce(self):
+        nonce = None
+        if self._nonce_pool is not None:
+            nonce = self._nonce_pool.pop()
+        if nonce is None:
+            with harvest_suppressed():
+                nonce = await self._fetch_nonce()
+        if (self._nonce_pool is not None and
+                self._nonce_pool.needs_refill()):
+            self._refill_nonces()
+        return nonce
+
+    async def _fetch_nonce(self):
+        nonce = self.transport.new_nonce()
+        if inspect.isawaitable(nonce):
+            nonce = await nonce
+        return nonce
+
+    def _refill_nonces(self):
+        if self._nonce_future is None:
+            self._nonce_future = asyncio.ensure_future(
+                self._fill_nonce_pool())
+
+    async def _fill_nonce_pool(self):
+        try:
+            with harvest_suppressed():
+                for _ in range(self._nonce_pool.missing()):
+                    if not self._nonce_pool.put(await self._fetch_nonce()):
+                        break
+        except Exception:
+            logger.exception("Error refilling the nonce pool.")
+        finally:
+            self._nonce_future = None
 
     async def directory(self):
-        if self._directory_cache is None:
-            future = self.transport.set_directory()
-            if future is not None:
-                logger.debug("Running transport set directory cache "
-                             "asynchronously.")
-                await future
-        return self._directory_cache
+        cache = self._directory_cache
+        if cache.is_fresh():
+            return cache.value
+        if cache.is_usable():
+            logger.debug("Revalidating stale directory in background.")
+            self._fetch_directory()
+            return cache.value
+        await asyncio.shield(self._fetch_directory())
+        return cache.value
+
+    def _fetch_directory(self) -> asyncio.Future:
+        """ Return the in-flight directory fetch, starting one if needed, so
+        concurrent callers share a single request to the bastion.
+        """
+        if self._directory_future is None:
+            self._directory_future = asyncio.ensure_future(
+                self._set_directory())
+            self._directory_future.add_done_callback(
+                self._directory_fetched)
+        return self._directory_future
+
+    async def _set_directory(self):
+        future = self.transport.set_directory()
+        if future is not None:
+            logger.debug("Running transport set directory cache "
+                         "asynchronously.")
+            await future
+
+    def _directory_fetched(self, future: asyncio.Future):
+        self._directory_future = None
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug("Error fetching the directory: %s",
+                         future.exception())
@@ -0,0 +1,265 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from email.utils import parsedate_to_datetime
+import json
+import logging
+import random
+import threading
+import time
+import typing as t
+from peasant.client.cache import get_header
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(("DELETE", "GET", "HEAD", "OPTIONS", "PUT"))
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+BAD_NONCE_TYPE = "urn:ietf:params:acme:error:badNonce"
+
+
+def parse_retry_after(value: t.Optional[str],
+                      now: datetime.datetime = None) -> t.Optional[float]:
+    """ Return the seconds to wait from a Retry-After header value, either
+    a number of seconds or a HTTP date.
+
+    :param str value: The Retry-After header value
+    :param datetime now: The current time, used to resolve dates. Default
+    is the current utc time.
+    :return float: None if the value is missing or invalid
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0.0)
+
+
+def is_bad_nonce(code: int, headers: t.Optional[t.Mapping],
+                 body: t.Optional[bytes]) -> bool:
+    """ Return True if a response is a problem document rejecting the
+    request nonce.
+
+    :param int code: The response code
+    :param Mapping headers: The response headers
+    :param bytes body: The response body
+    """
+    if code != 400 or not body:
+        return False
+    content_type = get_header(headers, "Content-Type", "")
+    if "json" not in content_type:
+        return False
+    try:
+        problem = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(problem, dict) and problem.get("type") == BAD_NONCE_TYPE
+
+
+def is_replayable(kwargs: t.Mapping) -> bool:
+    """ Return True if the body of a request can be sent again, which isn't
+    the case of iterators and file-like bodies.
+    """
+    body = kwargs.get("body", kwargs.get("data"))
+    return body is None or isinstance(
+        body, (bytes, bytearray, str, dict, list, tuple))
+
+
+class RetryThrottle:
+    """ Token bucket stopping retries while most requests are failing, so
+    retries don't pile up on a bastion already overloaded.
+
+    Every failure takes a token and every success gives back token_ratio
+    tokens. Retries are only allowed while more than half of max_tokens are
+    left.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key max_tokens: Size of the bucket. Default is 10.
+        :key token_ratio: Tokens given back by each success. Default is 0.1.
+        """
+        self.max_tokens = kwargs.get("max_tokens", 10)
+        self.token_ratio = kwargs.get("token_ratio", 0.1)
+        self._tokens = float(self.max_tokens)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def on_success(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.token_ratio,
+                               self.max_tokens)
+
+    def on_failure(self) -> bool:
+        """ Take a token for a failure.
+
+        :return bool: True if a retry is allowed
+        """
+        with self._lock:
+            self._tokens = max(self._tokens - 1, 0)
+            return self._tokens > self.max_tokens / 2
+
+
+class RetryPolicy:
+    """ Decide if and when failed requests are retried.
+
+    Requests with idempotent methods are retried after connection errors
+    and retryable response codes. Any request is retried once if the
+    bastion rejects its nonce, as it wasn't processed. The delay between
+    attempts grows exponentially with full jitter, and the Retry-After
+    header is honoured.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key retries: Maximum number of retries of a request. Default is 3.
+        :key backoff_base: Seconds the backoff starts with. Default is 0.1.
+        :key backoff_max: Maximum backoff in seconds. Default is 10.
+        :key deadline: Seconds after the first attempt no retry is started.
+        Default is None, no deadline.
+        :key methods: Methods retried after errors and retryable response
+        codes. Default is `IDEMPOTENT_METHODS`.
+        :key statuses: Response codes retried. Default is `RETRY_STATUSES`.
+        :key retry_after_max: Maximum seconds honoured from Retry-After, a
+        longer wait isn't retried. Default is 60.
+        :key bad_nonce_retries: Retries of a request rejected with a
+        badNonce problem, regardless of the method. Default is 1.
+        :key throttle: The `RetryThrottle` shared by requests using the
+        policy. Default is a new `RetryThrottle`, None disables it.
+        :key random: Callable returning a float in [0, 1). Default is
+        `random.random`.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.retries = kwargs.get("retries", 3)
+        self.backoff_base = kwargs.get("backoff_base", 0.1)
+        self.backoff_max = kwargs.get("backoff_max", 10)
+        self.deadline = kwargs.get("deadline")
+        self.methods = frozenset(method.upper() for method in kwargs.get(
+            "methods", IDEMPOTENT_METHODS))
+        self.statuses = frozenset(kwargs.get("statuses", RETRY_STATUSES))
+        self.retry_after_max = kwargs.get("retry_after_max", 60)
+        self.bad_nonce_retries = kwargs.get("bad_nonce_retries", 1)
+        self.throttle = kwargs.get("throttle", RetryThrottle())
+        self._random = kwargs.get("random", random.random)
+        self._clock = kwargs.get("clock", time.monotonic)
+
+    def backoff(self, attempt: int) -> float:
+        """ Return the delay before a retry, between zero and the
+        exponential backoff of the attempt.
+
+        :param int attempt: The retry number, starting at 1
+        :return float:
+        """
+        ceiling = min(self.backoff_max,
+                      self.backoff_base * 2 ** (attempt - 1))
+        return self._random() * ceiling
+
+    def start(self, method: str, replayable: bool = True) -> "RetryState":
+        """ Return the state tracking the attempts of a request.
+
+        :param str method: The request method
+        :param bool replayable: False if the request body can't be sent
+        again
+        :return RetryState:
+        """
+        return RetryState(self, method, replayable)
+
+
+class RetryState:
+    """ Attempts of a request sent under a `RetryPolicy`.
+    """
+
+    def __init__(self, policy: RetryPolicy, method: str,
+                 replayable: bool = True):
+        self.policy = policy
+        self.method = method.upper()
+        self.replayable = replayable
+        self.retries = 0
+        self.bad_nonce_retries = 0
+        self.started_at = policy._clock()
+
+    def on_error(self, error: BaseException) -> t.Optional[float]:
+        """ Return the delay before retrying a request that failed with a
+        retryable error, or None if it shouldn't be retried.
+        """
+        if self.method not in self.policy.methods:
+            return None
+        return self._next_delay(str(error))
+
+    def on_response(self, code: int, headers: t.Optional[t.Mapping] = None,
+                    body: t.Optional[bytes] = None) -> t.Optional[float]:
+        """ Return the delay before retrying a request after its response,
+        or None if it shouldn't be retried.
+
+        :param int code: The response code
+        :param Mapping headers: The response headers
+        :param bytes body: The response body
+        :return float:
+        """
+        policy = self.policy
+        if is_bad_nonce(code, headers, body):
+            if (not self.replayable or
+                    self.bad_nonce_retries >= policy.bad_nonce_retries):
+                return None
+            self.bad_nonce_retries += 1
+            logger.debug("Retrying %s request with a fresh nonce.",
+                         self.method)
+            return 0.0
+        if code not in policy.statuses:
+            if policy.throttle is not None and code < 500:
+                policy.throttle.on_success()
+            return None
+        if self.method not in policy.methods:
+            return None
+        retry_after = parse_retry_after(get_header(headers, "Retry-After"))
+        if retry_after is not None and retry_after > policy.retry_after_max:
+            return None
+        return self._next_delay(f"response {code}", retry_after)
+
+    def _next_delay(self, reason: str,
+                    retry_after: float = None) -> t.Optional[float]:
+        policy = self.policy
+        if not self.replayable or self.retries >= policy.retries:
+            return None
+        if policy.throttle is not None and not policy.throttle.on_failure():
+            logger.debug("Retry of %s request throttled after %s.",
+                         self.method, reason)
+            return None
+        self.retries += 1
+        delay = policy.backoff(self.retries)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if (policy.deadline is not None and policy._clock() + delay -
+                self.started_at > policy.deadline):
+            return None
+        logger.debug("Retrying %s request in %.3fs after %s, retry %s of "
+                     "%s.", self.method, delay, reason, self.retries,
+                     policy.retries)
+        return delay
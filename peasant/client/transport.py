@@ -14,10 +14,22 @@
 
 from __future__ import annotations
 
+import asyncio
+import functools
 import logging
 import typing as t
+from collections.abc import MutableMapping
+from types import MappingProxyType
 from urllib.parse import urlencode, urlparse
 
+from peasant.client.batch import BATCH_CONCURRENCY
+from peasant.client.cache import CachedResponse, CacheLookup, ResponseCache
+from peasant.client.hedge import HedgePolicy
+from peasant.client.overload import (AIMDLimiter, CircuitBreaker,
+                                     get_circuit_breaker, get_limiter,
+                                     OverloadGuard)
+from peasant.client.retry import is_replayable, RetryPolicy, RetryState
+
 if t.TYPE_CHECKING:
     from peasant.client.protocol import Peasant
 
@@ -31,6 +43,24 @@ METHOD_PATCH = "PATCH"
 METHOD_POST = "POST"
 METHOD_PUT = "PUT"
 
+URL_CACHE_SIZE = 512
+STREAM_CHUNK_SIZE = 65536
+
+
+def encode_query_string(query_string: t.Union[dict, str]) -> str:
+    """ Return the query string encoded, if informed as a dict.
+
+    :param query_string: Query string as dict or string
+    :return str:
+    """
+    if isinstance(query_string, dict):
+        query_string = urlencode(query_string)
+    if not isinstance(query_string, str):
+        err = (f"'query_string' parameter should be dict, or string. "
+               f"Not {type(query_string)}")
+        raise TypeError(err)
+    return query_string
+
 
 def concat_url(url: str, path: str = None, **kwargs: dict) -> str:
     """ Concatenate a given url to a path, and query string if informed.
@@ -43,13 +73,7 @@ def concat_url(url: str, path: str = None, **kwargs: dict) -> str:
     """
     query_string = kwargs.get("query_string", None)
     if query_string:
-        if isinstance(query_string, dict):
-            query_string = urlencode(query_string)
-        if not isinstance(query_string, str):
-            err = (f"'query_string' parameter should be dict, or string. "
-                   f"Not {type(query_string)}")
-            raise TypeError(err)
-        path = f"{path}?{query_string}"
+        path = f"{path}?{encode_query_string(query_string)}"
     if path is not None and path != "" and path != "/":
         if path.startswith("/"):
             path = path[1:]
@@ -64,10 +88,168 @@ def fix_address(address):
     return parsed_address.geturl()
 
 
+def is_streamed_body(body: t.Any) -> bool:
+    """ Return True if a request body is an iterable, or async iterable, of
+    chunks to be sent as they are produced.
+    """
+    return body is not None and not isinstance(
+        body, (bytes, bytearray, memoryview, str))
+
+
+async def iter_body(body: t.Any) -> t.AsyncIterator[bytes]:
+    """ Yield a request body as bytes chunks.
+
+    The body can be bytes, a str, an iterable or an async iterable of bytes
+    or str chunks. A str is encoded as utf-8.
+
+    :param body: The request body
+    """
+    if body is None:
+        return
+    if not is_streamed_body(body):
+        yield body.encode("utf-8") if isinstance(body, str) else bytes(body)
+        return
+    if hasattr(body, "__aiter__"):
+        async for chunk in body:
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        return
+    for chunk in body:
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class LayeredHeaders(MutableMapping):
+    """ Headers informed to a request layered over the transport's shared
+    default headers.
+
+    Reads are resolved from the request headers first and then from the
+    defaults, without copying any of them. The first write flattens both
+    layers into a private dict, so neither the defaults nor the headers
+    informed by the caller are ever changed.
+    """
+
+    __slots__ = ("_defaults", "_headers", "_data")
+
+    def __init__(self, defaults: t.Mapping, headers: t.Mapping = None):
+        self._defaults = defaults
+        self._headers = headers if headers else None
+        self._data = None
+
+    def _flatten(self) -> dict:
+        if self._data is None:
+            self._data = dict(self._defaults)
+            if self._headers:
+                self._data.update(self._headers)
+            self._defaults = self._headers = None
+        return self._data
+
+    def __getitem__(self, key):
+        if self._data is not None:
+            return self._data[key]
+        if self._headers is not None and key in self._headers:
+            return self._headers[key]
+        return self._defaults[key]
+
+    def __contains__(self, key):
+        if self._data is not None:
+            return key in self._data
+        return ((self._headers is not None and key in self._headers) or
+                key in self._defaults)
+
+    def __setitem__(self, key, value):
+        self._flatten()[key] = value
+
+    def __delitem__(self, key):
+        del self._flatten()[key]
+
+    def __iter__(self):
+        if self._data is not None:
+            return iter(self._data)
+        if self._headers is None:
+            return iter(self._defaults)
+        return iter(self._keys())
+
+    def __len__(self):
+        if self._data is not None:
+            return len(self._data)
+        if self._headers is None:
+            return len(self._defaults)
+        return len(self._keys())
+
+    def _keys(self) -> list:
+        return list(self._defaults) + [key for key in self._headers
+                                       if key not in self._defaults]
+
+    def copy(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.copy()!r})"
+
+
 class Transport:
 
+    retryable_errors: t.Tuple[t.Type[BaseException], ...] = (
+        ConnectionError, TimeoutError, asyncio.TimeoutError)
+    _basic_headers: t.Mapping = MappingProxyType({})
     _kwargs_updater: t.Callable = None
-    _peasant: Peasant
+    _peasant: Peasant = None
+
+    def __init__(self, **kwargs: dict):
+        """
+        :param dict kwargs:
+        :key url_cache_size: Maximum number of urls resolved from paths to
+        be cached. None means unbounded and 0 disables the cache. Default is
+        `URL_CACHE_SIZE`.
+        :key batch_concurrency: Maximum number of requests sent at once by
+        `batch` and `as_completed`. Default is
+        `peasant.client.batch.BATCH_CONCURRENCY`.
+        :key retry_policy: The `peasant.client.retry.RetryPolicy` deciding
+        if failed requests are retried. Default is None, no retries.
+        :key circuit_breaker: The `peasant.client.overload.CircuitBreaker`
+        refusing requests to a failing bastion, or True to use the one
+        shared by every transport of the bastion address. Default is None.
+        :key concurrency_limiter: The `peasant.client.overload.AIMDLimiter`
+        adapting how many requests are sent at once, or True to use the one
+        shared by every transport of the bastion address. Default is None.
+        :key limiter_timeout: Seconds to wait for a concurrency limiter
+        permit. Default is None, wait until one is available.
+        :key hedge_policy: The `peasant.client.hedge.HedgePolicy` deciding
+        when a slow GET request is sent again, by transports supporting it.
+        Default is None, no hedging.
+        :key response_cache: The `peasant.client.cache.ResponseCache`
+        serving GET and HEAD responses while fresh. Default is None, no
+        cache.
+        """
+        self.batch_concurrency = kwargs.get("batch_concurrency",
+                                            BATCH_CONCURRENCY)
+        self.retry_policy: t.Optional[RetryPolicy] = kwargs.get(
+            "retry_policy")
+        self.hedge_policy: t.Optional[HedgePolicy] = kwargs.get(
+            "hedge_policy")
+        self.response_cache: t.Optional[ResponseCache] = kwargs.get(
+            "response_cache")
+        self._circuit_breaker = kwargs.get("circuit_breaker")
+        self._concurrency_limiter = kwargs.get("concurrency_limiter")
+        self._limiter_timeout = kwargs.get("limiter_timeout")
+        self._overload_guard = None
+        self._url_cache = functools.lru_cache(
+            maxsize=kwargs.get("url_cache_size", URL_CACHE_SIZE))(
+            self._resolve_path)
+
+    @property
+    def basic_headers(self) -> t.Mapping:
+        """ Read-only view of the headers sent with every request.
+
+        The defaults are shared by every request, to change them assign a
+        new mapping.
+
+        :return Mapping:
+        """
+        return self._basic_headers
+
+    @basic_headers.setter
+    def basic_headers(self, headers: t.Mapping):
+        self._basic_headers = MappingProxyType(dict(headers))
 
     @property
     def kwargs_updater(self) -> t.Callable:
@@ -85,35 +267,320 @@ class Transport:
     def peasant(self, peasant: Peasant):
         self._peasant = peasant
 
-    def get_url(self, path: str, **kwargs: dict):
-        if (path.lower().startswith("http://") or
-                path.lower().startswith("https://")):
-            return concat_url(path, "", **kwargs)
-        return concat_url(self._bastion_address, path, **kwargs)
+    def _resolve_path(self, address: str,
+                      path: str) -> t.Tuple[str, str]:
+        """ Resolve the url of a path, returning it with the separator to be
+        used before a query string.
+        """
+        if path[:8].lower().startswith(("http://", "https://")):
+            return path, "/?"
+        if path == "" or path == "/":
+            return address, "/?"
+        return concat_url(address, path), "?"
 
-    def delete(self, path: str, **kwargs: dict):
+    def get_url(self, path: str, **kwargs: dict) -> str:
+        """ Return the url of a path relative to the bastion address, or the
+        path itself if it is an absolute url.
+
+        Urls resolved from paths are kept in a bounded LRU cache, while the
+        query string is added on every call.
+
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key query_string: Query string to be added to the returned url
+        :return str:
+        """
+        url, separator = self._url_cache(self._bastion_address, path)
+        query_string = kwargs.get("query_string", None)
+        if query_string:
+            return f"{url}{separator}{encode_query_string(query_string)}"
+        return url
+
+    def url_cache_info(self):
+        """ Return hits, misses, maxsize and currsize of the url cache.
+
+        :return functools._CacheInfo:
+        """
+        return self._url_cache.cache_info()
+
+    def url_cache_clear(self):
+        self._url_cache.cache_clear()
+
+    def get_headers(self, **kwargs: dict) -> LayeredHeaders:
+        """ Return the headers to be sent with a request, the ones informed
+        overriding the basic headers.
+
+        :param dict kwargs:
+        :key headers: Headers informed to the request
+        :return LayeredHeaders:
+        """
+        return LayeredHeaders(self._basic_headers, kwargs.get('headers'))
+
+    def prepare_request(self, method: str, path: str,
+                        **kwargs: dict) -> t.Tuple[str, dict]:
+        """ Resolve the url and the keyword arguments to be used by a
+        request sent to the bastion.
+
+        This is the work peasant does for every request before the
+        underlining http client is called. The url is resolved from the path
+        and query string, the default headers are merged with the ones
+        informed and the kwargs updater is applied.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key headers: Headers to be merged with the transport basic headers
+        :key query_string: Query string to be added to the url
+        :return tuple: The url and the updated keyword arguments
+        """
+        url = self.get_url(path, **kwargs)
+        kwargs.pop("query_string", None)
+        kwargs['headers'] = self.get_headers(**kwargs)
+        return url, self.update_kwargs(method, **kwargs)
+
+    def process_response_headers(self, headers: t.Mapping):
+        """ Hand the headers of every response received, including error
+        responses, to the peasant, so it can harvest nonces from them.
+
+        :param Mapping headers: The response headers
+        """
+        if self._peasant is not None:
+            self._peasant.harvest_nonce(headers)
+
+    def lookup_cache(self, method: str, path: str,
+                     **kwargs: dict) -> t.Optional[CacheLookup]:
+        """ Look up the response of a request in the transport
+        response_cache.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs: The request arguments
+        :return CacheLookup: None if there is no cache, or the request
+        bypasses it
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.lookup(
+            method, self.get_url(path, **kwargs), self.get_headers(**kwargs))
+
+    def revalidation_kwargs(self, lookup: CacheLookup,
+                            **kwargs: dict) -> dict:
+        """ Return the request arguments with the headers revalidating the
+        stale response found by a cache lookup.
+        """
+        conditional_headers = lookup.conditional_headers()
+        if conditional_headers:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}),
+                                 **conditional_headers}
+        return kwargs
+
+    def complete_lookup(self, lookup: t.Optional[CacheLookup], response,
+                        code: int, reason: t.Optional[str],
+                        headers: t.Mapping, body: t.Optional[bytes]):
+        """ Update the response cache with the response received from the
+        bastion, returning the cached response if the bastion answered a
+        conditional request with 304 Not Modified.
+        """
+        if lookup is None:
+            return response
+        entry = lookup.complete(code, reason, headers, body)
+        if code == 304 and entry is not None:
+            return self.cached_response(entry)
+        return response
+
+    def cached_response(self, entry: CachedResponse):
+        """ Return a response of the transport client type from a response
+        kept by the response cache.
+
+        :param CachedResponse entry: The cached response
+        """
         raise NotImplementedError
 
-    def get(self, path: str, **kwargs: dict):
+    @property
+    def circuit_breaker(self) -> t.Optional[CircuitBreaker]:
+        if self._circuit_breaker is True:
+            self._circuit_breaker = get_circuit_breaker(
+                self._bastion_address)
+        return self._circuit_breaker
+
+    @property
+    def concurrency_limiter(self) -> t.Optional[AIMDLimiter]:
+        if self._concurrency_limiter is True:
+            self._concurrency_limiter = get_limiter(self._bastion_address)
+        return self._concurrency_limiter
+
+    @property
+    def overload_guard(self) -> t.Optional[OverloadGuard]:
+        """ The guard running request attempts through the transport
+        circuit breaker and concurrency limiter, None if it has neither.
+
+        :return OverloadGuard:
+        """
+        if (self._overload_guard is None and
+                (self._circuit_breaker or self._concurrency_limiter)):
+            self._overload_guard = OverloadGuard(
+                circuit_breaker=self.circuit_breaker,
+                limiter=self.concurrency_limiter,
+                limiter_timeout=self._limiter_timeout)
+        return self._overload_guard
+
+    def enter_guard(self) -> t.Optional[float]:
+        """ Wait until the overload guard lets a request attempt through,
+        raising `peasant.client.overload.CircuitOpenError` if the circuit
+        breaker is open.
+
+        :return float: The value to be informed to `exit_guard`
+        """
+        guard = self.overload_guard
+        return None if guard is None else guard.enter()
+
+    async def enter_guard_async(self) -> t.Optional[float]:
+        """ Wait, without blocking the event loop, until the overload guard
+        lets a request attempt through.
+
+        :return float: The value to be informed to `exit_guard`
+        """
+        guard = self.overload_guard
+        return None if guard is None else await guard.enter_async()
+
+    def exit_guard(self, started_at: t.Optional[float],
+                   code: t.Optional[int] = None,
+                   error: t.Optional[BaseException] = None):
+        """ Record the outcome of a request attempt in the overload guard.
+
+        Errors not caused by the bastion, like a cancellation, only give the
+        limiter permit back.
+
+        :param float started_at: The value returned by `enter_guard`
+        :param int code: The response code
+        :param BaseException error: The error raised by the attempt
+        """
+        guard = self._overload_guard
+        if guard is None or started_at is None:
+            return
+        if error is not None and not self.is_retryable_error(error):
+            guard.cancel(started_at)
+            return
+        guard.exit(started_at, code, error)
+
+    def start_retry(self, method: str,
+                    **kwargs: dict) -> t.Optional[RetryState]:
+        """ Return the state tracking the attempts of a request, or None if
+        the transport has no retry policy.
+
+        :param str method: The request method
+        :param dict kwargs: The request arguments
+        :return RetryState:
+        """
+        if self.retry_policy is None:
+            return None
+        return self.retry_policy.start(method, is_replayable(kwargs))
+
+    def is_retryable_error(self, error: BaseException) -> bool:
+        """ Return True if a request failed with an error, like a connection
+        reset, that may not happen again.
+        """
+        return isinstance(error, self.retryable_errors)
+
+    def retry_error_delay(self, retry: t.Optional[RetryState],
+                          error: BaseException) -> t.Optional[float]:
+        """ Return the seconds to wait before retrying a request that raised
+        an error, or None if the error should be raised.
+        """
+        if retry is None or not self.is_retryable_error(error):
+            return None
+        return retry.on_error(error)
+
+    def retry_response_delay(self, retry: t.Optional[RetryState], code: int,
+                             headers: t.Mapping,
+                             body: t.Optional[bytes]) -> t.Optional[float]:
+        """ Return the seconds to wait before retrying a request after its
+        response, or None if the response should be returned.
+
+        A retried request is prepared again, so a rejected nonce is
+        replaced by a fresh one.
+        """
+        if retry is None:
+            return None
+        return retry.on_response(code, headers, body)
+
+    def request(self, method: str, path: str, **kwargs: dict):
+        """ Send a request to the bastion.
+
+        Every verb method is delegated to this one, so transports should
+        implement it.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments to be used by the transport client
+        """
         raise NotImplementedError
 
-    def head(self, path: str, **kwargs: dict):
+    def stream(self, method: str, path: str, **kwargs: dict):
+        """ Send a request to the bastion, returning an iterator of the
+        response body chunks, read from the connection as they are consumed.
+
+        Synchronous transports return an iterator and asynchronous ones an
+        async iterator. The request is only sent when the iteration starts,
+        and an error response is raised before any chunk is returned.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments to be used by the transport client
+        :key chunk_size: Maximum size of the chunks returned. Default is
+        `STREAM_CHUNK_SIZE`.
+        """
         raise NotImplementedError
 
-    def options(self, path: str, **kwargs: dict):
+    def batch(self, specs: t.Iterable, **kwargs: dict):
+        """ Send many requests, at most batch_concurrency at once, returning
+        a `peasant.client.batch.BatchResult` for each one in the order they
+        were informed. A failed request doesn't stop the others.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is batch_concurrency.
+        """
         raise NotImplementedError
 
-    def patch(self, path: str, **kwargs: dict):
+    def as_completed(self, specs: t.Iterable, **kwargs: dict):
+        """ Send many requests, at most batch_concurrency at once, returning
+        an iterator of `peasant.client.batch.BatchResult` in the order the
+        requests complete.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is batch_concurrency.
+        """
         raise NotImplementedError
 
+    def delete(self, path: str, **kwargs: dict):
+        return self.request(METHOD_DELETE, path, **kwargs)
+
+    def get(self, path: str, **kwargs: dict):
+        return self.request(METHOD_GET, path, **kwargs)
+
+    def head(self, path: str, **kwargs: dict):
+        return self.request(METHOD_HEAD, path, **kwargs)
+
+    def options(self, path: str, **kwargs: dict):
+        return self.request(METHOD_OPTIONS, path, **kwargs)
+
+    def patch(self, path: str, **kwargs: dict):
+        return self.request(METHOD_PATCH, path, **kwargs)
+
     def post(self, path: str, **kwargs: dict):
-        raise NotImplementedError
+        return self.request(METHOD_POST, path, **kwargs)
 
     def post_as_get(self, path: str, **kwargs: dict):
         raise NotImplementedError
 
     def put(self, path: str, **kwargs: dict):
-        raise NotImplementedError
+        return self.request(METHOD_PUT, path, **kwargs)
 
     def set_directory(self):
         raise NotImplementedError
@@ -124,6 +591,17 @@ class Transport:
     def is_registered(self):
         raise NotImplementedError
 
+    def close(self):
+        """ Release resources held by the transport, like pooled connections.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def update_kwargs(self, method, **kwargs):
         if self.kwargs_updater is None:
             return kwargs
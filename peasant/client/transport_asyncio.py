@@ -0,0 +1,665 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+import http.client
+import io
+import json
+import logging
+import platform
+import re
+import ssl
+import time
+import typing as t
+from urllib.parse import urlsplit
+from peasant import get_version
+from peasant.client.batch import AsyncBatchMixin
+from peasant.client.cache import CachedResponse
+from peasant.client.hedge import AsyncHedgeMixin
+from peasant.client.nonce import NONCE_HEADER
+from peasant.client.transport import (fix_address, is_streamed_body,
+                                      iter_body, METHOD_HEAD,
+                                      STREAM_CHUNK_SIZE, Transport)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+BODY_METHODS = frozenset(("PATCH", "POST", "PUT"))
+# RFC 9110 token, used by methods and header names
+HEADER_NAME_PATTERN = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+")
+HEADER_INVALID_VALUE_CHARS = re.compile(r"[\x00-\x08\x0a-\x1f\x7f]")
+URL_INVALID_CHARS = re.compile(r"[\x00-\x20\x7f]")
+
+
+class HTTPClientError(Exception):
+    """ Raised by `AsyncioTransport` when the bastion answers with a non-2xx
+    response code.
+    """
+
+    def __init__(self, code: int, message: str = None,
+                 response: "HTTPResponse" = None):
+        self.code = code
+        self.message = message or http.client.responses.get(code, "Unknown")
+        self.response = response
+        super().__init__(code, self.message, response)
+
+    def __str__(self):
+        return f"HTTP {self.code}: {self.message}"
+
+
+class HTTPResponse:
+    """ Response received by `AsyncioTransport`.
+
+    The headers are a case-insensitive `http.client.HTTPMessage`.
+    """
+
+    def __init__(self, url: str, code: int, reason: str,
+                 headers: http.client.HTTPMessage, body: bytes = b"",
+                 request_time: float = None):
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.request_time = request_time
+
+    @property
+    def error(self) -> t.Optional[HTTPClientError]:
+        if 200 <= self.code < 300:
+            return None
+        return HTTPClientError(self.code, self.reason, self)
+
+    def rethrow(self):
+        """ Raise a `HTTPClientError` if the response code isn't 2xx.
+        """
+        error = self.error
+        if error is not None:
+            raise error
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.code} {self.reason})"
+
+
+class Connection:
+    """ A HTTP/1.1 connection to a host, kept alive between requests.
+    """
+
+    def __init__(self, key: tuple, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.loop = None
+        self.generation = 0
+        self.released_at = None
+        self.reused = False
+        self.keep_alive = False
+
+    def is_reusable(self, idle_timeout: float) -> bool:
+        if self.reader.at_eof() or self.writer.is_closing():
+            return False
+        return (idle_timeout is None or
+                time.monotonic() - self.released_at < idle_timeout)
+
+    def close(self):
+        if not self.writer.is_closing():
+            try:
+                self.writer.close()
+            except RuntimeError:
+                # the connection loop is closed
+                pass
+
+
+class ConnectionPool:
+    """ Keeps idle keep-alive connections per scheme, host and port, opening
+    at most max_connections concurrent connections to each host.
+
+    Connections and the semaphores limiting them belong to the loop they
+    were created in, so they are kept per running loop. The state of a
+    closed loop is dropped once another loop uses the pool.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key max_connections: Maximum concurrent connections per host.
+        Default is 10.
+        :key idle_timeout: Seconds an idle connection is kept. Default is
+        60.
+        :key connect_timeout: Seconds to wait for a connection to be opened.
+        Default is 20.
+        :key ssl_context: The `ssl.SSLContext` used by https connections.
+        Default is `ssl.create_default_context()`.
+        """
+        self.max_connections = kwargs.get("max_connections", 10)
+        self.idle_timeout = kwargs.get("idle_timeout", 60)
+        self.connect_timeout = kwargs.get("connect_timeout", 20)
+        self._ssl_context = kwargs.get("ssl_context")
+        # loop: (idle connections, limits), per (scheme, host, port)
+        self._loops = {}
+        # bumped by close, connections acquired before are stale
+        self._generation = 0
+        self.opened = 0
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def _loop_state(self, loop: asyncio.AbstractEventLoop
+                    ) -> t.Tuple[dict, dict]:
+        state = self._loops.get(loop)
+        if state is None:
+            for closed in [other for other in self._loops
+                           if other.is_closed()]:
+                self._close_idle(self._loops.pop(closed)[0])
+            state = self._loops[loop] = ({}, {})
+        return state
+
+    def _limit(self, loop: asyncio.AbstractEventLoop,
+               key: tuple) -> asyncio.Semaphore:
+        limits = self._loop_state(loop)[1]
+        limit = limits.get(key)
+        if limit is None:
+            limit = limits[key] = asyncio.Semaphore(self.max_connections)
+        return limit
+
+    async def acquire(self, scheme: str, host: str, port: int,
+                      connect_timeout: float = None) -> Connection:
+        """ Return an idle connection to the host, or a new one if none is
+        available, waiting while max_connections are in use.
+        """
+        key = (scheme, host, port)
+        loop = asyncio.get_running_loop()
+        await self._limit(loop, key).acquire()
+        try:
+            idle = self._loop_state(loop)[0].get(key)
+            while idle:
+                connection = idle.pop()
+                if connection.is_reusable(self.idle_timeout):
+                    connection.reused = True
+                    connection.keep_alive = False
+                    return connection
+                connection.close()
+            connection = await self._open(key, connect_timeout)
+            connection.loop = loop
+            connection.generation = self._generation
+            return connection
+        except BaseException:
+            self._limit(loop, key).release()
+            raise
+
+    async def _open(self, key: tuple, connect_timeout: float) -> Connection:
+        scheme, host, port = key
+        ssl_context = self.ssl_context if scheme == "https" else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            connect_timeout or self.connect_timeout)
+        self.opened += 1
+        return Connection(key, reader, writer)
+
+    def release(self, connection: Connection, reusable: bool = True):
+        """ Give a connection back to the pool, closing it if it can't be
+        reused.
+
+        A connection acquired before the pool was closed is closed, its
+        semaphore was dropped with the pool state.
+        """
+        if connection.generation != self._generation:
+            connection.close()
+            return
+        self._limit(connection.loop, connection.key).release()
+        if not reusable or connection.loop.is_closed():
+            connection.close()
+            return
+        connection.released_at = time.monotonic()
+        idle_connections = self._loop_state(connection.loop)[0]
+        idle = idle_connections.get(connection.key)
+        if idle is None:
+            idle = idle_connections[connection.key] = deque()
+        idle.append(connection)
+
+    def idle_connections(self) -> int:
+        return sum(len(idle) for idle_connections, _ in self._loops.values()
+                   for idle in idle_connections.values())
+
+    @staticmethod
+    def _close_idle(idle_connections: dict):
+        for idle in idle_connections.values():
+            while idle:
+                idle.pop().close()
+
+    def close(self):
+        for idle_connections, _ in self._loops.values():
+            self._close_idle(idle_connections)
+        self._loops.clear()
+        self._generation += 1
+
+
+def check_request_head(method: str, target: str, headers: t.Mapping):
+    """ Raise ValueError if the request line or headers have characters
+    that would break the request head, like CR and LF injecting headers or
+    another request, as `http.client` does.
+    """
+    if not HEADER_NAME_PATTERN.fullmatch(method):
+        raise ValueError(f"Invalid method: {method!r}")
+    if URL_INVALID_CHARS.search(target):
+        raise ValueError(f"Invalid url, control characters or spaces found: "
+                         f"{target!r}")
+    for name, value in headers.items():
+        if not HEADER_NAME_PATTERN.fullmatch(str(name)):
+            raise ValueError(f"Invalid header name: {name!r}")
+        if HEADER_INVALID_VALUE_CHARS.search(str(value)):
+            raise ValueError(f"Invalid value of the {name} header: "
+                             f"{value!r}")
+
+
+def host_header(scheme: str, host: str, port: int) -> str:
+    """ Return the Host header value of a request, like `http.client` does:
+    IPv6 addresses are bracketed and the scheme default port is left out.
+    """
+    if ":" in host:
+        host = f"[{host}]"
+    if port == DEFAULT_PORTS.get(scheme):
+        return host
+    return f"{host}:{port}"
+
+
+def parse_head(head: bytes) -> t.Tuple[int, str, http.client.HTTPMessage]:
+    """ Parse the status line and headers of a HTTP/1.x response.
+
+    :param bytes head: The response head, including the blank line
+    :return tuple: The response code, reason and headers
+    """
+    status_line, _, header_lines = head.partition(b"\r\n")
+    parts = status_line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise http.client.BadStatusLine(status_line.decode("latin-1"))
+    reason = parts[2] if len(parts) > 2 else ""
+    headers = http.client.parse_headers(io.BytesIO(header_lines))
+    return int(parts[1]), reason, headers
+
+
+class AsyncioTransport(AsyncBatchMixin, AsyncHedgeMixin, Transport):
+    """ Transport sending requests with a HTTP/1.1 client running on plain
+    asyncio, keeping connections alive in a pool between requests.
+    """
+
+    retryable_errors = Transport.retryable_errors + (
+        asyncio.IncompleteReadError,)
+
+    def __init__(self, bastion_address, **kwargs):
+        """
+        :param str bastion_address: The bastion base address
+        :param dict kwargs:
+        :key max_connections: Maximum concurrent connections per host.
+        Default is 10.
+        :key idle_timeout: Seconds an idle keep-alive connection is kept.
+        Default is 60.
+        :key connect_timeout: Default connect timeout in seconds. Default is
+        20.
+        :key request_timeout: Default request timeout in seconds. Default is
+        20.
+        :key max_body_size: Maximum accepted response body size. Default is
+        100MB.
+        :key ssl_context: The `ssl.SSLContext` used by https connections.
+        :key url_cache_size: Maximum number of urls resolved from paths to
+        be cached. Default is `peasant.client.transport.URL_CACHE_SIZE`.
+        :key directory_path: Path the bastion directory is fetched from.
+        Default is "/directory".
+        :key nonce_path: Path nonces are fetched from. Default is None, the
+        newNonce url from the directory is used.
+        """
+        super().__init__(**kwargs)
+        self._bastion_address = fix_address(bastion_address)
+        self.directory_path = kwargs.get("directory_path", "/directory")
+        self.nonce_path = kwargs.get("nonce_path")
+        self.request_timeout = kwargs.get("request_timeout", 20)
+        self.max_body_size = kwargs.get("max_body_size", 100 * 1024 * 1024)
+        self._pool = self.create_pool(**kwargs)
+        self.user_agent = (f"Peasant/{get_version()} "
+                           f"Python/{platform.python_version()}")
+        self.basic_headers = {
+            'User-Agent': self.user_agent
+        }
+
+    def create_pool(self, **kwargs) -> t.Optional[ConnectionPool]:
+        """ Create the pool keeping the transport connections.
+
+        :param dict kwargs: The transport arguments
+        :return ConnectionPool:
+        """
+        return ConnectionPool(**kwargs)
+
+    @property
+    def pool(self) -> ConnectionPool:
+        return self._pool
+
+    def close(self):
+        """ Close every idle connection kept by the transport.
+        """
+        self._pool.close()
+
+    async def request(self, method: str, path: str, **kwargs: dict):
+        """ Executes a request, asynchronously returning an `HTTPResponse`.
+
+        By default, a `HTTPClientError` is raised if the response code isn't
+        2xx. Instead, if ``raise_error`` is set to False, the response will
+        always be returned regardless of the response code.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key body: The request body, as bytes or str
+        :key connect_timeout: Connect timeout in seconds
+        :key headers: Headers to be sent with the request
+        :key query_string: Query string to be added to the url
+        :key raise_error: If False the response is returned regardless of
+        the response code. Default is True.
+        :key request_timeout: Request timeout in seconds
+
+        Failed requests are retried as decided by the transport
+        retry_policy. Each attempt goes through the transport circuit breaker
+        and concurrency limiter, when they are set. GET and HEAD responses
+        are served from the transport response_cache while fresh.
+
+        :return HTTPResponse:
+        """
+        lookup = self.lookup_cache(method, path, **kwargs)
+        if lookup is not None:
+            if lookup.fresh:
+                return self.cached_response(lookup.entry)
+            kwargs = self.revalidation_kwargs(lookup, **kwargs)
+        retry = self.start_retry(method, **kwargs)
+        while True:
+            url, request_kwargs = self.prepare_request(method, path, **kwargs)
+            started_at = await self.enter_guard_async()
+            try:
+                response = await self.fetch(method, url, **request_kwargs)
+            except BaseException as error:
+                self.exit_guard(started_at, error=error)
+                if not isinstance(error, Exception):
+                    raise
+                delay = self.retry_error_delay(retry, error)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.exit_guard(started_at, response.code)
+            self.process_response_headers(response.headers)
+            delay = self.retry_response_delay(retry, response.code,
+                                              response.headers, response.body)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        response = self.complete_lookup(lookup, response, response.code,
+                                        response.reason, response.headers,
+                                        response.body)
+        if request_kwargs.get("raise_error", True):
+            response.rethrow()
+        return response
+
+    def cached_response(self, entry: CachedResponse) -> HTTPResponse:
+        headers = http.client.HTTPMessage()
+        for name, value in entry.headers.items():
+            headers[name] = value
+        return HTTPResponse(entry.url, entry.code, entry.reason, headers,
+                            entry.body, 0)
+
+    async def set_directory(self):
+        """ Fetch the bastion directory, storing it in the peasant directory
+        cache.
+
+        The cached directory validators are sent, so a directory not
+        modified is only revalidated.
+        """
+        response = await self.get(self.directory_path,
+                                  headers=self.peasant.directory_headers(),
+                                  raise_error=False)
+        if response.code == 304:
+            self.peasant.revalidate_directory(response.headers)
+            return
+        response.rethrow()
+        self.peasant.store_directory(json.loads(response.body),
+                                     response.headers)
+
+    async def new_nonce(self, nonce_path: str = None) -> t.Optional[str]:
+        """ Fetch a new nonce from the bastion with a head request.
+
+        :param str nonce_path: Path the nonce is fetched from. Default is the
+        transport nonce_path, or the newNonce url from the directory.
+        :return str: The nonce
+        """
+        nonce_path = nonce_path or self.nonce_path
+        nonce_header = NONCE_HEADER
+        if self.peasant is not None:
+            nonce_header = self.peasant.nonce_header
+            if nonce_path is None:
+                directory = await self.peasant.directory()
+                nonce_path = directory['newNonce']
+        if nonce_path is None:
+            raise ValueError("A nonce_path is needed to fetch nonces "
+                             "without a peasant.")
+        response = await self.head(nonce_path)
+        return response.headers.get(nonce_header)
+
+    async def stream(self, method: str, path: str, **kwargs: dict):
+        """ Send a request, yielding the response body chunks as they are
+        read from the connection.
+
+        Chunks are only read when consumed, so a slow consumer slows the
+        bastion down instead of buffering the body in memory. The request
+        timeout covers the request until the response headers are received.
+        An error response is raised as `HTTPClientError`, if
+        ``raise_error`` isn't False, before any chunk is yielded.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key body: The request body, as bytes, str, an iterable or async
+        iterable of chunks
+        :key chunk_size: Maximum size of the chunks returned. Default is
+        `peasant.client.transport.STREAM_CHUNK_SIZE`.
+        """
+        chunk_size = kwargs.pop("chunk_size", STREAM_CHUNK_SIZE)
+        url, kwargs = self.prepare_request(method, path, **kwargs)
+        connection, code, reason, headers = await asyncio.wait_for(
+            self._start_exchange(method, url, **kwargs),
+            kwargs.get("request_timeout", self.request_timeout))
+        try:
+            self.process_response_headers(headers)
+            if kwargs.get("raise_error", True) and not 200 <= code < 300:
+                raise HTTPClientError(code, reason, HTTPResponse(
+                    url, code, reason, headers))
+            async for chunk in self._iter_body(connection, method, code,
+                                               headers, chunk_size, None):
+                yield chunk
+        finally:
+            self._pool.release(connection, connection.keep_alive)
+
+    async def fetch(self, method: str, url: str, **kwargs) -> HTTPResponse:
+        """ Send a request to the url, returning the response regardless of
+        the response code.
+        """
+        start = time.monotonic()
+
+        async def exchange():
+            connection, code, reason, headers = await self._start_exchange(
+                method, url, **kwargs)
+            try:
+                body = b"".join([chunk async for chunk in self._iter_body(
+                    connection, method, code, headers)])
+            finally:
+                self._pool.release(connection, connection.keep_alive)
+            return code, reason, headers, body
+
+        code, reason, headers, body = await asyncio.wait_for(
+            exchange(), kwargs.get("request_timeout", self.request_timeout))
+        return HTTPResponse(url, code, reason, headers, body,
+                            time.monotonic() - start)
+
+    async def _start_exchange(self, method: str, url: str,
+                              **kwargs) -> tuple:
+        """ Send the request and read the response head, returning it with
+        the connection the response body is read from.
+
+        A request failing on a reused connection, before any response byte
+        is received, is retried once on a new connection, as the bastion
+        may have closed the idle connection. Streamed bodies can't be sent
+        twice, so they are never retried.
+
+        :return tuple: The connection, response code, reason and headers
+        """
+        scheme, host, port, target = self._split_url(url)
+        for attempt in range(2):
+            connection = await self._pool.acquire(
+                scheme, host, port, kwargs.get("connect_timeout"))
+            try:
+                await self._send_request(connection, method, host, port,
+                                         target, **kwargs)
+                code, reason, headers = await self._read_head(connection)
+            except (asyncio.IncompleteReadError, ConnectionError) as error:
+                self._pool.release(connection, False)
+                if (attempt == 0 and connection.reused and
+                        not getattr(error, "partial", b"") and
+                        not is_streamed_body(kwargs.get("body"))):
+                    logger.debug("Reused connection to %s:%s was closed, "
+                                 "retrying.", host, port)
+                    continue
+                raise
+            except BaseException:
+                self._pool.release(connection, False)
+                raise
+            return connection, code, reason, headers
+
+    def _split_url(self, url: str) -> t.Tuple[str, str, int, str]:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS:
+            raise ValueError(f"Unsupported url scheme: {url}")
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        return (scheme, parts.hostname, parts.port or DEFAULT_PORTS[scheme],
+                target)
+
+    async def _send_request(self, connection: Connection, method: str,
+                            host: str, port: int, target: str, **kwargs):
+        body = kwargs.get("body")
+        streamed = is_streamed_body(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = kwargs.get("headers") or {}
+        check_request_head(method, target, headers)
+        names = {name.lower() for name in headers}
+        lines = [f"{method} {target} HTTP/1.1"]
+        if "host" not in names:
+            lines.append(f"Host: {host_header(connection.key[0], host, port)}")
+        for name, value in headers.items():
+            lines.append(f"{name}: {value}")
+        if streamed:
+            lines.append("Transfer-Encoding: chunked")
+        elif "content-length" not in names and (
+                body or method in BODY_METHODS):
+            lines.append(f"Content-Length: {len(body or b'')}")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        writer = connection.writer
+        if not streamed:
+            writer.write(head + body if body else head)
+            await writer.drain()
+            return
+        writer.write(head)
+        async for chunk in iter_body(body):
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _read_head(self, connection: Connection) -> tuple:
+        while True:
+            head = await connection.reader.readuntil(b"\r\n\r\n")
+            code, reason, headers = parse_head(head)
+            # informational responses are followed by the final one
+            if not 100 <= code < 200 or code == 101:
+                return code, reason, headers
+
+    async def _iter_body(self, connection: Connection, method: str,
+                         code: int, headers,
+                         chunk_size: int = STREAM_CHUNK_SIZE,
+                         max_size: t.Optional[int] = -1
+                         ) -> t.AsyncIterator[bytes]:
+        """ Yield the response body chunks as they are read.
+
+        The connection is marked to be kept alive once the whole body is
+        read, if the bastion didn't ask to close it.
+
+        :param int max_size: Maximum body size, -1 to use max_body_size or
+        None for no limit
+        """
+        if max_size == -1:
+            max_size = self.max_body_size
+        reader = connection.reader
+        keep_alive = "close" not in headers.get("Connection", "").lower()
+        if method == METHOD_HEAD or code in (204, 304) or code < 200:
+            connection.keep_alive = keep_alive
+            return
+        received = 0
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            while True:
+                size_line = await reader.readuntil(b"\r\n")
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if size == 0:
+                    # trailers, if any, end with a blank line
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    connection.keep_alive = keep_alive
+                    return
+                received += size
+                check_body_size(received, max_size)
+                while size > 0:
+                    chunk = await reader.readexactly(min(size, chunk_size))
+                    size -= len(chunk)
+                    yield chunk
+                await reader.readexactly(2)
+        content_length = headers.get("Content-Length")
+        if content_length is not None:
+            remaining = int(content_length)
+            check_body_size(remaining, max_size)
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, chunk_size))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+            connection.keep_alive = keep_alive
+            return
+        while True:
+            chunk = await reader.read(chunk_size)
+            if not chunk:
+                return
+            received += len(chunk)
+            check_body_size(received, max_size)
+            yield chunk
+
+
+def check_body_size(size: int, max_size: t.Optional[int]):
+    if max_size is not None and size > max_size:
+        raise ValueError(f"Response body exceeds the maximum size of "
+                         f"{max_size} bytes.")
@@ -0,0 +1,421 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+import typing as t
+from peasant.client.batch import (BatchResult, gather_batch, iter_batch,
+                                  iter_thread_batch)
+from peasant.client.hedge import hedge
+from peasant.client.overload import CircuitOpenError, STATE_OPEN
+from peasant.client.transport import fix_address, METHOD_GET, Transport
+from peasant.client.transport_asyncio import AsyncioTransport
+
+if t.TYPE_CHECKING:
+    from peasant.client.protocol import Peasant
+
+logger = logging.getLogger(__name__)
+
+BALANCE_LEAST_OUTSTANDING = "least_outstanding"
+BALANCE_P2C = "p2c"
+
+
+class Endpoint:
+    """ A bastion replica, with the transport sending requests to it and
+    the number of requests outstanding.
+    """
+
+    def __init__(self, transport: Transport):
+        self.transport = transport
+        self.address = transport._bastion_address
+        self.outstanding = 0
+
+    @property
+    def available(self) -> bool:
+        """ False while the endpoint circuit breaker is open, ejecting the
+        endpoint from the balancing.
+        """
+        breaker = self.transport.circuit_breaker
+        return breaker is None or breaker.state != STATE_OPEN
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}({self.address}, "
+                f"outstanding={self.outstanding})")
+
+
+class Balancer:
+    """ Pick the endpoint each request is sent to.
+
+    The p2c strategy takes the endpoint with fewer outstanding requests of
+    two picked at random, while least_outstanding takes the one with fewer
+    outstanding requests of all, breaking ties at random. Endpoints with an
+    open circuit breaker are skipped.
+    """
+
+    def __init__(self, endpoints: t.List[Endpoint], **kwargs):
+        """
+        :param list endpoints: The endpoints balanced
+        :param dict kwargs:
+        :key strategy: Either `BALANCE_P2C` or `BALANCE_LEAST_OUTSTANDING`.
+        Default is `BALANCE_P2C`.
+        :key random: The `random.Random` used to pick endpoints. Default is
+        a new `random.Random`.
+        """
+        strategy = kwargs.get("strategy", BALANCE_P2C)
+        if strategy not in (BALANCE_LEAST_OUTSTANDING, BALANCE_P2C):
+            raise ValueError(f"Invalid balance strategy: {strategy}")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self._random = kwargs.get("random") or random.Random()
+        self._lock = threading.Lock()
+
+    def pick(self, exclude: t.Container[Endpoint] = ()
+             ) -> t.Optional[Endpoint]:
+        """ Return the endpoint a request is sent to, counting the request
+        as outstanding until `release` is called.
+
+        :param exclude: Endpoints not to be picked
+        :return Endpoint: None if no endpoint is available
+        """
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in exclude and endpoint.available]
+            if not candidates:
+                return None
+            if self.strategy == BALANCE_P2C and len(candidates) > 2:
+                first, second = self._random.sample(candidates, 2)
+                endpoint = (first if first.outstanding <= second.outstanding
+                            else second)
+            else:
+                fewest = min(endpoint.outstanding for endpoint in candidates)
+                endpoint = self._random.choice(
+                    [endpoint for endpoint in candidates
+                     if endpoint.outstanding == fewest])
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+
+def per_endpoint(name: str, value) -> t.Callable[[], t.Any]:
+    """ Return a callable creating the circuit breaker or limiter of each
+    replica, from the value informed to `BalancedTransport`.
+
+    An instance would be shared by every replica, so a failing replica
+    would eject them all, only True, None or a factory are accepted.
+    """
+    if value is None or value is False or value is True:
+        return lambda: value
+    if callable(value):
+        return value
+    raise ValueError(f"The {name} of a balanced transport must be True, "
+                     "None or a callable creating one for each replica.")
+
+
+class BalancedTransport(Transport):
+    """ Transport balancing requests between replicas of a bastion.
+
+    Each bastion address gets its own transport, keeping its own connection
+    pool, and a circuit breaker passively ejecting the replica after
+    consecutive failures. A request refused by an open breaker is sent to
+    another replica.
+
+    The transport is synchronous or asynchronous like the transport_class
+    it wraps.
+    """
+
+    def __init__(self, bastion_addresses: t.Iterable[str], **kwargs):
+        """
+        :param bastion_addresses: Addresses of the bastion replicas
+        :param dict kwargs: Also passed to the transport of each replica
+        :key transport_class: Transport class used for each replica.
+        Default is `peasant.client.transport_asyncio.AsyncioTransport`.
+        :key balance_strategy: Either `BALANCE_P2C` or
+        `BALANCE_LEAST_OUTSTANDING`. Default is `BALANCE_P2C`.
+        :key circuit_breaker: Default is True, each replica uses the circuit
+        breaker shared by the transports of its address. A callable without
+        arguments, like `peasant.client.overload.CircuitBreaker`, creates a
+        breaker for each replica. None disables the ejection.
+        :key concurrency_limiter: Default is None, no limiter. True or a
+        callable without arguments gives each replica its own limiter, like
+        circuit_breaker.
+        :key random: The `random.Random` used to pick replicas.
+        """
+        transport_class = kwargs.pop("transport_class", AsyncioTransport)
+        strategy = kwargs.pop("balance_strategy", BALANCE_P2C)
+        random_ = kwargs.pop("random", None)
+        circuit_breaker = per_endpoint(
+            "circuit_breaker", kwargs.pop("circuit_breaker", True))
+        concurrency_limiter = per_endpoint(
+            "concurrency_limiter", kwargs.pop("concurrency_limiter", None))
+        super().__init__(**kwargs)
+        addresses = list(dict.fromkeys(
+            fix_address(address) for address in bastion_addresses))
+        if not addresses:
+            raise ValueError("At least one bastion address is needed.")
+        self.endpoints = [
+            Endpoint(transport_class(
+                address, circuit_breaker=circuit_breaker(),
+                concurrency_limiter=concurrency_limiter(), **kwargs))
+            for address in addresses]
+        self.balancer = Balancer(self.endpoints, strategy=strategy,
+                                 random=random_)
+        first = self.endpoints[0].transport
+        self._bastion_address = first._bastion_address
+        self._is_async = asyncio.iscoroutinefunction(first.request)
+        self.basic_headers = first.basic_headers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @Transport.basic_headers.setter
+    def basic_headers(self, headers: t.Mapping):
+        Transport.basic_headers.fset(self, headers)
+        for endpoint in getattr(self, "endpoints", ()):
+            endpoint.transport.basic_headers = headers
+
+    @Transport.kwargs_updater.setter
+    def kwargs_updater(self, callable: t.Callable):
+        self._kwargs_updater = callable
+        for endpoint in self.endpoints:
+            endpoint.transport.kwargs_updater = callable
+
+    @Transport.peasant.setter
+    def peasant(self, peasant: Peasant):
+        self._peasant = peasant
+        for endpoint in self.endpoints:
+            endpoint.transport.peasant = peasant
+
+    @property
+    def healthy_endpoints(self) -> t.List[Endpoint]:
+        """ The endpoints whose circuit breaker isn't open.
+
+        :return list:
+        """
+        return [endpoint for endpoint in self.endpoints if endpoint.available]
+
+    def relative_path(self, path: str) -> str:
+        """ Return an url of any replica relative to the replica address,
+        so it can be sent to another replica, like the urls listed in the
+        bastion directory.
+
+        :param str path: Absolute or relative url
+        :return str:
+        """
+        for endpoint in self.endpoints:
+            address = endpoint.address
+            if path == address or path.startswith(f"{address}/"):
+                return path[len(address):] or "/"
+        return path
+
+    def _unavailable(self, error: t.Optional[CircuitOpenError] = None
+                     ) -> CircuitOpenError:
+        if error is not None:
+            return error
+        breakers = [endpoint.transport.circuit_breaker
+                    for endpoint in self.endpoints]
+        return CircuitOpenError(min(breakers,
+                                    key=lambda breaker: breaker.retry_in()))
+
+    def dispatch(self, send: t.Callable[[Transport], t.Any]):
+        """ Call send with the transport of the replica picked by the
+        balancer, picking another one if the replica circuit breaker refuses
+        the request.
+
+        :param send: Callable receiving the replica transport
+        :return: The result of send, awaitable if the transport is
+        asynchronous
+        """
+        if self._is_async:
+            return self._dispatch_async(send)
+        tried = []
+        error = None
+        while True:
+            endpoint = self.balancer.pick(tried)
+            if endpoint is None:
+                raise self._unavailable(error)
+            try:
+                return send(endpoint.transport)
+            except CircuitOpenError as open_error:
+                error = open_error
+                tried.append(endpoint)
+            finally:
+                self.balancer.release(endpoint)
+
+    async def _dispatch_async(self, send: t.Callable[[Transport], t.Any]):
+        tried = []
+        error = None
+        while True:
+            endpoint = self.balancer.pick(tried)
+            if endpoint is None:
+                raise self._unavailable(error)
+            try:
+                return await send(endpoint.transport)
+            except CircuitOpenError as open_error:
+                error = open_error
+                tried.append(endpoint)
+            finally:
+                self.balancer.release(endpoint)
+
+    def request(self, method: str, path: str, **kwargs: dict):
+        """ Send a request to the replica picked by the balancer.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments passed to the replica transport
+        """
+        path = self.relative_path(path)
+        return self.dispatch(
+            lambda transport: transport.request(method, path, **kwargs))
+
+    def get(self, path: str, **kwargs: dict):
+        """ Send a GET request to the replica picked by the balancer. With a
+        hedge_policy, an asynchronous transport sends slow requests again,
+        usually to another replica.
+
+        :param str path: Absolute or relative url
+        :param dict kwargs: Arguments passed to the replica transport
+        """
+        if self._is_async and self.hedge_policy is not None:
+            return hedge(self.hedge_policy,
+                         lambda: self.request(METHOD_GET, path, **kwargs))
+        return self.request(METHOD_GET, path, **kwargs)
+
+    def stream(self, method: str, path: str, **kwargs: dict):
+        """ Stream a request from the replica picked by the balancer, which
+        counts the request as outstanding until the iteration ends.
+        """
+        path = self.relative_path(path)
+        if self._is_async:
+            return self._stream_async(method, path, **kwargs)
+        return self._stream(method, path, **kwargs)
+
+    def _stream(self, method: str, path: str, **kwargs: dict):
+        endpoint = self.balancer.pick()
+        if endpoint is None:
+            raise self._unavailable()
+        try:
+            yield from endpoint.transport.stream(method, path, **kwargs)
+        finally:
+            self.balancer.release(endpoint)
+
+    async def _stream_async(self, method: str, path: str, **kwargs: dict):
+        endpoint = self.balancer.pick()
+        if endpoint is None:
+            raise self._unavailable()
+        try:
+            async for chunk in endpoint.transport.stream(method, path,
+                                                         **kwargs):
+                yield chunk
+        finally:
+            self.balancer.release(endpoint)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """ The executor running batch requests of a synchronous transport,
+        with batch_concurrency threads.
+
+        :return ThreadPoolExecutor:
+        """
+        executor = self._executor
+        if executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.batch_concurrency,
+                        thread_name_prefix="peasant-balanced")
+                executor = self._executor
+        return executor
+
+    def batch(self, specs: t.Iterable, **kwargs: dict):
+        """ Send requests concurrently, balanced between the replicas,
+        returning a `BatchResult` for each one in the order they were
+        informed.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is batch_concurrency.
+        """
+        concurrency = kwargs.get("concurrency", self.batch_concurrency)
+        if self._is_async:
+            return gather_batch(self, specs, concurrency)
+        results = list(iter_thread_batch(self.executor, self, specs,
+                                         concurrency))
+        results.sort(key=lambda result: result.index)
+        return results
+
+    def as_completed(self, specs: t.Iterable,
+                     **kwargs: dict) -> t.Iterable[BatchResult]:
+        """ Send requests concurrently, balanced between the replicas,
+        yielding a `BatchResult` as each one completes.
+
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once. Default
+        is batch_concurrency.
+        """
+        concurrency = kwargs.get("concurrency", self.batch_concurrency)
+        if self._is_async:
+            return iter_batch(self, specs, concurrency)
+        return iter_thread_batch(self.executor, self, specs, concurrency)
+
+    def post_as_get(self, path: str, **kwargs: dict):
+        path = self.relative_path(path)
+        return self.dispatch(
+            lambda transport: transport.post_as_get(path, **kwargs))
+
+    def set_directory(self):
+        return self.dispatch(lambda transport: transport.set_directory())
+
+    def new_nonce(self):
+        if self._is_async:
+            return self._new_nonce_async()
+        return self.dispatch(lambda transport: transport.new_nonce())
+
+    async def _new_nonce_async(self):
+        nonce_path = None
+        if (self.peasant is not None and getattr(
+                self.endpoints[0].transport, "nonce_path", None) is None):
+            directory = await self.peasant.directory()
+            # the directory newNonce url points to one of the replicas, the
+            # nonce is fetched from the replica picked by the balancer
+            nonce_path = self.relative_path(directory['newNonce'])
+        if nonce_path is None:
+            return await self._dispatch_async(
+                lambda transport: transport.new_nonce())
+        return await self._dispatch_async(
+            lambda transport: transport.new_nonce(nonce_path))
+
+    def is_registered(self):
+        return self.dispatch(lambda transport: transport.is_registered())
+
+    def close(self):
+        """ Close the transport of every replica, and the batch executor.
+        """
+        with self._executor_lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for endpoint in self.endpoints:
+            endpoint.transport.close()
@@ -0,0 +1,510 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import http.client
+import logging
+import ssl
+import time
+import typing as t
+from peasant.client.transport import (is_streamed_body, iter_body,
+                                      STREAM_CHUNK_SIZE)
+from peasant.client.transport_asyncio import (AsyncioTransport,
+                                              host_header, HTTPClientError,
+                                              HTTPResponse)
+
+logger = logging.getLogger(__name__)
+
+h2_installed = False
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    h2_installed = True
+except ImportError:
+    pass
+
+# headers only meaningful to a HTTP/1.1 connection, not sent over h2
+CONNECTION_HEADERS = frozenset((
+    "connection", "host", "keep-alive", "proxy-connection",
+    "transfer-encoding", "upgrade",
+))
+
+
+class StreamClosedError(ConnectionError):
+    """ Raised when a stream is reset or its connection is lost before the
+    response is complete.
+    """
+
+
+class H2Stream:
+    """ A request sent over a HTTP/2 connection.
+
+    Received data is queued with its flow controlled length, which is only
+    acknowledged to the server when the data is consumed.
+    """
+
+    __slots__ = ("stream_id", "code", "headers", "data", "response_received",
+                 "ended")
+
+    def __init__(self, stream_id: int):
+        self.stream_id = stream_id
+        self.code = None
+        self.headers = http.client.HTTPMessage()
+        self.data = asyncio.Queue()
+        self.response_received = asyncio.get_running_loop().create_future()
+        self.ended = False
+
+    def fail(self, error: Exception):
+        if not self.response_received.done():
+            self.response_received.set_exception(error)
+        self.data.put_nowait((error, 0))
+
+
+class H2Connection:
+    """ A HTTP/2 connection multiplexing concurrent requests as streams.
+
+    At most max_concurrent_streams streams are open at once, or fewer if the
+    server asks so. Requests beyond that wait for a stream to be closed.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, **kwargs):
+        """
+        :param StreamReader reader:
+        :param StreamWriter writer:
+        :param dict kwargs:
+        :key max_concurrent_streams: Maximum concurrent streams opened by the
+        client. Default is 100.
+        :key connection_window: Size of the connection flow control window.
+        It is larger than the stream windows, so a stream not consumed
+        doesn't stall the others. Default is 16MB.
+        """
+        self._reader = reader
+        self._writer = writer
+        self.max_concurrent_streams = kwargs.get("max_concurrent_streams",
+                                                 100)
+        self.connection_window = kwargs.get("connection_window", 2 ** 24)
+        self._h2 = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True,
+                                             header_encoding=None))
+        self._streams = {}
+        self._stream_available = asyncio.Condition()
+        self._window_updated = asyncio.Event()
+        self._read_task = None
+        self._closed = False
+        self.last_used = time.monotonic()
+
+    @property
+    def is_closed(self) -> bool:
+        return self._closed
+
+    @property
+    def open_streams(self) -> int:
+        return len(self._streams)
+
+    def stream_limit(self) -> int:
+        """ Return how many streams can be open at once, the lowest between
+        the client and server limits.
+        """
+        return min(self.max_concurrent_streams,
+                   self._h2.remote_settings.max_concurrent_streams)
+
+    async def start(self):
+        self._h2.initiate_connection()
+        window = self.connection_window - self._h2.inbound_flow_control_window
+        if window > 0:
+            self._h2.increment_flow_control_window(window)
+        await self._flush()
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def request(self, method: str, authority: str, scheme: str,
+                      target: str, headers: t.Mapping = None,
+                      body: t.Any = None) -> t.Tuple[int, t.Any, bytes]:
+        """ Send a request in a new stream and wait for the whole response.
+
+        :return tuple: The response code, headers and body
+        """
+        stream = await self.open_stream(method, authority, scheme, target,
+                                        headers, body)
+        try:
+            body = b"".join([chunk async for chunk in self.iter_data(stream)])
+        finally:
+            await self.close_stream(stream)
+        return stream.code, stream.headers, body
+
+    async def open_stream(self, method: str, authority: str, scheme: str,
+                          target: str, headers: t.Mapping = None,
+                          body: t.Any = None) -> H2Stream:
+        """ Send a request in a new stream, returning it once the response
+        headers are received.
+
+        The stream must be closed with `close_stream` once consumed.
+
+        :param body: The request body, as bytes, str, an iterable or async
+        iterable of chunks
+        :return H2Stream:
+        """
+        async with self._stream_available:
+            await self._stream_available.wait_for(
+                lambda: self._closed or
+                self.open_streams < self.stream_limit())
+            if self._closed:
+                raise StreamClosedError("The connection is closed.")
+            stream_id = self._h2.get_next_available_stream_id()
+            stream = self._streams[stream_id] = H2Stream(stream_id)
+        try:
+            content_length = None
+            if body is not None and not is_streamed_body(body):
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                content_length = len(body)
+            self._h2.send_headers(
+                stream_id, self._encode_headers(
+                    method, authority, scheme, target, headers,
+                    content_length),
+                end_stream=body is None or content_length == 0)
+            await self._flush()
+            if body is not None and content_length != 0:
+                await self._send_body(stream_id, body)
+            await stream.response_received
+        except BaseException:
+            await self.close_stream(stream)
+            raise
+        return stream
+
+    async def iter_data(self, stream: H2Stream) -> t.AsyncIterator[bytes]:
+        """ Yield the data received by the stream, acknowledging it to the
+        server as it is consumed.
+        """
+        while True:
+            data, flow_controlled_length = await stream.data.get()
+            if data is None:
+                return
+            if isinstance(data, Exception):
+                raise data
+            if flow_controlled_length and not self._closed:
+                self._h2.acknowledge_received_data(flow_controlled_length,
+                                                   stream.stream_id)
+                await self._flush()
+            yield data
+
+    async def close_stream(self, stream: H2Stream):
+        """ Close the stream, resetting it if the response wasn't entirely
+        received.
+        """
+        if not stream.ended and not self._closed:
+            stream.ended = True
+            try:
+                self._h2.reset_stream(stream.stream_id,
+                                      h2.errors.ErrorCodes.CANCEL)
+                self._writer.write(self._h2.data_to_send())
+            except h2.exceptions.ProtocolError:
+                pass
+        self.last_used = time.monotonic()
+        async with self._stream_available:
+            self._streams.pop(stream.stream_id, None)
+            self._stream_available.notify()
+
+    def _encode_headers(self, method: str, authority: str, scheme: str,
+                        target: str, headers: t.Optional[t.Mapping],
+                        content_length: t.Optional[int]) -> list:
+        encoded = [
+            (b":method", method.encode()),
+            (b":authority", authority.encode()),
+            (b":scheme", scheme.encode()),
+            (b":path", target.encode()),
+        ]
+        for name, value in (headers or {}).items():
+            name = name.lower()
+            if name in CONNECTION_HEADERS:
+                continue
+            encoded.append((name.encode(), str(value).encode("latin-1")))
+        if content_length:
+            encoded.append((b"content-length", str(content_length).encode()))
+        return encoded
+
+    async def _send_body(self, stream_id: int, body: t.Any):
+        async for chunk in iter_body(body):
+            await self._send_data(stream_id, chunk)
+        self._h2.end_stream(stream_id)
+        await self._flush()
+
+    async def _send_data(self, stream_id: int, data: bytes):
+        view = memoryview(data)
+        while view:
+            if self._closed:
+                raise StreamClosedError("The connection is closed.")
+            window = self._h2.local_flow_control_window(stream_id)
+            if window <= 0:
+                self._window_updated.clear()
+                await self._window_updated.wait()
+                continue
+            size = min(window, self._h2.max_outbound_frame_size, len(view))
+            self._h2.send_data(stream_id, view[:size].tobytes())
+            view = view[size:]
+            await self._flush()
+
+    async def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self._writer.write(data)
+            await self._writer.drain()
+
+    async def _read_loop(self):
+        error = None
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                for event in self._h2.receive_data(data):
+                    self._handle_event(event)
+                data = self._h2.data_to_send()
+                if data:
+                    self._writer.write(data)
+                if self._closed:
+                    break
+        except Exception as e:
+            error = e
+            logger.debug("HTTP/2 connection lost: %s", e)
+        finally:
+            await self._terminate(error)
+
+    def _handle_event(self, event):
+        stream = self._streams.get(getattr(event, "stream_id", None))
+        if isinstance(event, h2.events.ResponseReceived) and stream:
+            for name, value in event.headers:
+                if name == b":status":
+                    stream.code = int(value)
+                    continue
+                stream.headers[name.decode()] = value.decode("latin-1")
+            stream.response_received.set_result(None)
+        elif isinstance(event, h2.events.DataReceived):
+            if stream:
+                stream.data.put_nowait((event.data,
+                                        event.flow_controlled_length))
+            else:
+                self._h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded) and stream:
+            stream.ended = True
+            stream.data.put_nowait((None, 0))
+        elif isinstance(event, h2.events.StreamReset) and stream:
+            stream.ended = True
+            stream.fail(StreamClosedError(
+                f"Stream {event.stream_id} reset with error "
+                f"{event.error_code!r}."))
+        elif isinstance(event, h2.events.WindowUpdated):
+            self._window_updated.set()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            self._window_updated.set()
+            asyncio.ensure_future(self._notify_streams())
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            logger.debug("HTTP/2 connection terminated by the server with "
+                         "error %r.", event.error_code)
+            self._closed = True
+
+    async def _notify_streams(self):
+        async with self._stream_available:
+            self._stream_available.notify_all()
+
+    async def _terminate(self, error: Exception = None):
+        self._closed = True
+        self._window_updated.set()
+        for stream in self._streams.values():
+            if not stream.ended:
+                stream.ended = True
+                stream.fail(StreamClosedError(
+                    f"Connection lost before stream {stream.stream_id} "
+                    f"ended: {error}"))
+        await self._notify_streams()
+        if not self._writer.is_closing():
+            self._writer.close()
+
+    def close(self):
+        """ Close the connection, failing the streams still open.
+        """
+        if not self._closed:
+            try:
+                self._h2.close_connection()
+                self._writer.write(self._h2.data_to_send())
+            except (h2.exceptions.ProtocolError, RuntimeError):
+                pass
+        self._closed = True
+        if self._read_task is not None and not self._read_task.done():
+            self._read_task.cancel()
+        elif not self._writer.is_closing():
+            self._writer.close()
+
+
+class H2Transport(AsyncioTransport):
+    """ Transport multiplexing concurrent requests over a single HTTP/2
+    connection per bastion host.
+
+    Plain http connections use h2c with prior knowledge, while https
+    connections negotiate h2 with ALPN.
+    """
+
+    def __init__(self, bastion_address, **kwargs):
+        """
+        :param str bastion_address: The bastion base address
+        :param dict kwargs:
+        :key max_concurrent_streams: Maximum concurrent streams opened to a
+        host. Default is 100.
+        :key connect_timeout: Default connect timeout in seconds. Default is
+        20.
+        :key request_timeout: Default request timeout in seconds. Default is
+        20.
+        :key ssl_context: The `ssl.SSLContext` used by https connections.
+        It is used as informed, so it must offer the h2 ALPN protocol, with
+        `set_alpn_protocols(["h2"])`. Default is a context created by the
+        transport, offering h2.
+        :key directory_path: Path the bastion directory is fetched from.
+        Default is "/directory".
+        :key nonce_path: Path nonces are fetched from. Default is None, the
+        newNonce url from the directory is used.
+        """
+        if not h2_installed:
+            logger.warn("H2Transport cannot be used without h2 installed.\n"
+                        "It is necessary to install peasant with extras "
+                        "modifiers all or h2.\n\n Ex: pip install "
+                        "peasant[all] or pip install peasant[h2]\n\n"
+                        "Installing h2 manually will also work.\n")
+            raise NotImplementedError
+        super().__init__(bastion_address, **kwargs)
+        self.max_concurrent_streams = kwargs.get("max_concurrent_streams",
+                                                 100)
+        self.connect_timeout = kwargs.get("connect_timeout", 20)
+        self._ssl_context = kwargs.get("ssl_context")
+        self._connections = {}
+        self._connecting = {}
+        self.opened = 0
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+            self._ssl_context.set_alpn_protocols(["h2"])
+        return self._ssl_context
+
+    def create_pool(self, **kwargs) -> None:
+        """ Requests are multiplexed over the transport own connections,
+        there is no HTTP/1.1 connection pool.
+        """
+        return None
+
+    def close(self):
+        """ Close every connection kept by the transport.
+        """
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+
+    async def connection(self, scheme: str, host: str, port: int,
+                         connect_timeout: float = None) -> H2Connection:
+        """ Return the connection to the host, opening it if needed.
+
+        Concurrent calls share the same connection attempt.
+        """
+        key = (scheme, host, port)
+        connection = self._connections.get(key)
+        if connection is not None and not connection.is_closed:
+            return connection
+        connecting = self._connecting.get(key)
+        if connecting is None:
+            connecting = self._connecting[key] = asyncio.ensure_future(
+                self._open(scheme, host, port, connect_timeout))
+            connecting.add_done_callback(
+                lambda _: self._connecting.pop(key, None))
+        connection = await asyncio.shield(connecting)
+        self._connections[key] = connection
+        return connection
+
+    async def _open(self, scheme: str, host: str, port: int,
+                    connect_timeout: float = None) -> H2Connection:
+        ssl_context = self.ssl_context if scheme == "https" else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            connect_timeout or self.connect_timeout)
+        if ssl_context is not None:
+            protocol = writer.get_extra_info("ssl_object")
+            if protocol.selected_alpn_protocol() != "h2":
+                writer.close()
+                raise ConnectionError(f"{host}:{port} doesn't support "
+                                      f"HTTP/2.")
+        connection = H2Connection(
+            reader, writer,
+            max_concurrent_streams=self.max_concurrent_streams)
+        await connection.start()
+        self.opened += 1
+        return connection
+
+    async def stream(self, method: str, path: str, **kwargs: dict):
+        """ Send a request in a new stream, yielding the response body
+        chunks as they are received.
+
+        Received data is only acknowledged when consumed, so the server
+        stops sending once the stream flow control window is full. The
+        request timeout covers the request until the response headers are
+        received. An error response is raised as `HTTPClientError`, if
+        ``raise_error`` isn't False, before any chunk is yielded.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key body: The request body, as bytes, str, an iterable or async
+        iterable of chunks
+        :key chunk_size: Ignored, chunks are yielded as the frames are
+        received.
+        """
+        kwargs.pop("chunk_size", STREAM_CHUNK_SIZE)
+        url, kwargs = self.prepare_request(method, path, **kwargs)
+        scheme, host, port, target = self._split_url(url)
+        connection = await self.connection(scheme, host, port,
+                                           kwargs.get("connect_timeout"))
+        stream = await asyncio.wait_for(
+            connection.open_stream(method, host_header(scheme, host, port),
+                                   scheme, target, kwargs.get("headers"),
+                                   kwargs.get("body")),
+            kwargs.get("request_timeout", self.request_timeout))
+        try:
+            self.process_response_headers(stream.headers)
+            if (kwargs.get("raise_error", True) and
+                    not 200 <= stream.code < 300):
+                reason = http.client.responses.get(stream.code, "")
+                raise HTTPClientError(stream.code, reason, HTTPResponse(
+                    url, stream.code, reason, stream.headers))
+            async for chunk in connection.iter_data(stream):
+                yield chunk
+        finally:
+            await connection.close_stream(stream)
+
+    async def fetch(self, method: str, url: str, **kwargs) -> HTTPResponse:
+        """ Send a request to the url in a new stream, returning the
+        response regardless of the response code.
+        """
+        scheme, host, port, target = self._split_url(url)
+        start = time.monotonic()
+        connection = await self.connection(scheme, host, port,
+                                           kwargs.get("connect_timeout"))
+        code, headers, body = await asyncio.wait_for(
+            connection.request(method, host_header(scheme, host, port),
+                               scheme, target, kwargs.get("headers"),
+                               kwargs.get("body")),
+            kwargs.get("request_timeout", self.request_timeout))
+        return HTTPResponse(url, code, http.client.responses.get(code, ""),
+                            headers, body, time.monotonic() - start)
@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
+import threading
+import time
+import typing as t
 from peasant import get_version
-from peasant.client.transport import (METHOD_DELETE, METHOD_GET, METHOD_HEAD,
-                                      METHOD_OPTIONS, METHOD_PATCH,
-                                      METHOD_POST, METHOD_PUT, Transport)
+from peasant.client.batch import BatchResult, iter_thread_batch
+from peasant.client.cache import CachedResponse
+from peasant.client.transport import (fix_address, STREAM_CHUNK_SIZE,
+                                      Transport)
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +29,10 @@ requests_installed = False
 
 try:
     import requests
+    from requests.adapters import (DEFAULT_POOLBLOCK, DEFAULT_POOLSIZE,
+                                   HTTPAdapter)
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
     requests_installed = True
 
 except ImportError:
@@ -33,11 +41,31 @@ except ImportError:
 
 class RequestsTransport(Transport):
 
-    basic_headers: dict
     user_agent: str
 
-    def __init__(self, bastion_address):
-        super().__init__()
+    def __init__(self, bastion_address, **kwargs):
+        """ Create a transport that sends requests to the bastion through a
+        long-lived `requests.Session`, reusing its pooled connections
+        between calls.
+
+        :param str bastion_address: The bastion base address
+        :param dict kwargs:
+        :key pool_connections: Number of host pools to be cached by the
+        session adapter. Default is `requests.adapters.DEFAULT_POOLSIZE`.
+        :key pool_maxsize: Maximum number of connections kept per host.
+        Default is `requests.adapters.DEFAULT_POOLSIZE`, or
+        batch_concurrency if greater, so every batch worker keeps its
+        connection.
+        :key pool_block: If True, calls will block when the host pool is
+        exhausted instead of opening connections that won't be kept. Default
+        is `requests.adapters.DEFAULT_POOLBLOCK`.
+        :key url_cache_size: Maximum number of urls resolved from paths to
+        be cached. Default is `peasant.client.transport.URL_CACHE_SIZE`.
+        :key batch_concurrency: Number of threads of the executor running
+        submitted and batch requests. Default is
+        `peasant.client.batch.BATCH_CONCURRENCY`.
+        """
+        super().__init__(**kwargs)
         if not requests_installed:
             logger.warn("RequestsTransport cannot be used without requests "
                         "installed.\nIt is necessary to install peasant "
@@ -45,136 +73,214 @@ class RequestsTransport(Transport):
                         "install peasant[all] or pip install peasant[requests]"
                         "\n\nInstalling requests manually will also work.\n")
             raise NotImplementedError
-        self._bastion_address = bastion_address
+        self._bastion_address = fix_address(bastion_address)
         self._directory = None
         self.user_agent = (f"Peasant/{get_version()} "
                            f"Requests/{requests.__version__}")
         self.basic_headers = {
             'User-Agent': self.user_agent
         }
+        self._pool_connections = kwargs.get("pool_connections",
+                                            DEFAULT_POOLSIZE)
+        self._pool_maxsize = kwargs.get(
+            "pool_maxsize", max(DEFAULT_POOLSIZE, self.batch_concurrency))
+        self._pool_block = kwargs.get("pool_block", DEFAULT_POOLBLOCK)
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._executor = None
 
-    def get_headers(self, **kwargs):
-        headers = copy.deepcopy(self.basic_headers)
-        _headers = kwargs.get('headers')
-        if _headers:
-            headers.update(_headers)
-        return headers
+    @property
+    def session(self) -> "requests.Session":
+        """ The session used to send requests to the bastion.
 
-    def delete(self, path: str, **kwargs):
-        """ Send a delete method with basic headers.
+        The session is created on first use, and recreated if used after the
+        transport was closed. Connection pooling is shared by the threads
+        sending requests through the transport, do not mutate the session,
+        like its cookies, mounts or auth, concurrently with requests.
 
-        :param path: absolute or relative URL for the new
-        :class:`requests.Request` object.
-        :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        :return requests.Session:
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_DELETE, **kwargs)
-        with requests.delete(url, **kwargs) as result:
-            result.raise_for_status()
-        return result
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self.build_session()
+                session = self._session
+        return session
 
-    def get(self, path, **kwargs):
-        """Send a GET request.
+    def build_session(self) -> "requests.Session":
+        """ Return a new session with the pooled adapter mounted for http and
+        https.
 
-        :param path: absolute or relative URL for the new
-        :class:`requests.Request` object.
-        :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        :return requests.Session:
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_GET, **kwargs)
-        with requests.get(url, **kwargs) as result:
-            result.raise_for_status()
-        return result
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self._pool_connections,
+                              pool_maxsize=self._pool_maxsize,
+                              pool_block=self._pool_block)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
-    def head(self, path, **kwargs):
-        """Send a HEAD request.
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """ The executor running submitted and batch requests, with
+        batch_concurrency threads sharing the transport session.
 
-        :param path: absolute or relative URL for the new
-        :class:`requests.Request` object.
-        :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        The executor is created on first use, and recreated if used after
+        the transport was closed.
+
+        :return ThreadPoolExecutor:
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_HEAD, **kwargs)
-        with requests.head(url, **kwargs) as result:
-            result.raise_for_status()
-        return result
+        executor = self._executor
+        if executor is None:
+            with self._session_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.batch_concurrency,
+                        thread_name_prefix="peasant-requests")
+                executor = self._executor
+        return executor
 
-    def options(self, path, **kwargs):
-        """Send a OPTIONS request.
+    def close(self):
+        """ Shut the executor down, waiting for running requests, and close
+        the session and every pooled connection held by it.
+        """
+        with self._session_lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._session_lock:
+            session = self._session
+            self._session = None
+        if session is not None:
+            session.close()
 
-        :param path: absolute or relative URL for the new
-        :class:`requests.Request` object.
+    def submit(self, method: str, path: str, **kwargs) -> Future:
+        """ Send a request from the transport executor.
+
+        :param str method: The request method
+        :param str path: Absolute or relative url
         :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        :return Future: Future resolving to the `requests.Response`
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_OPTIONS, **kwargs)
-        with requests.options(url, **kwargs) as result:
-            result.raise_for_status()
-        return result
+        return self.executor.submit(self.request, method, path, **kwargs)
 
-    def patch(self, path, **kwargs):
-        """Send a PATCH request.
+    def batch(self, specs: t.Iterable, **kwargs) -> t.List[BatchResult]:
+        """ Send requests from the transport executor, returning a
+        `BatchResult` for each one, in the order they were informed.
 
-        :param path: absolute or relative URL for the new
-        :class:`requests.Request` object.
-        :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once, limited
+        by batch_concurrency. Default is batch_concurrency.
+        :return list:
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_PATCH, **kwargs)
-        with requests.patch(url, **kwargs) as result:
-            result.raise_for_status()
-        return result
+        results = list(self.as_completed(specs, **kwargs))
+        results.sort(key=lambda result: result.index)
+        return results
 
-    def post(self, path, **kwargs):
-        """Send a POST request.
+    def as_completed(self, specs: t.Iterable,
+                     **kwargs) -> t.Iterator[BatchResult]:
+        """ Send requests from the transport executor, yielding a
+        `BatchResult` as each one completes.
 
+        :param specs: Iterable of request specs, see
+        `peasant.client.batch.to_batch_request`
+        :param dict kwargs:
+        :key concurrency: Maximum number of requests sent at once, limited
+        by batch_concurrency. Default is batch_concurrency.
+        """
+        return iter_thread_batch(
+            self.executor, self, specs,
+            kwargs.get("concurrency", self.batch_concurrency))
+
+    def request(self, method: str, path: str, **kwargs):
+        """ Send a request through the transport session.
+
+        :param str method: The request method
         :param path: absolute or relative URL for the new
         :class:`requests.Request` object.
         :param **kwargs: Optional arguments that ``request`` takes.
+
+        Failed requests are retried as decided by the transport
+        retry_policy. Each attempt goes through the transport circuit breaker
+        and concurrency limiter, when they are set. GET and HEAD responses
+        are served from the transport response_cache while fresh.
+
         :return: :class:`requests.Response <Response>` object
         :rtype: requests.Response
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_POST, **kwargs)
-        with requests.post(url, **kwargs) as result:
-            result.raise_for_status()
+        lookup = self.lookup_cache(method, path, **kwargs)
+        if lookup is not None:
+            if lookup.fresh:
+                return self.cached_response(lookup.entry)
+            kwargs = self.revalidation_kwargs(lookup, **kwargs)
+        retry = self.start_retry(method, **kwargs)
+        while True:
+            url, request_kwargs = self.prepare_request(method, path, **kwargs)
+            started_at = self.enter_guard()
+            try:
+                with self.session.request(method, url,
+                                          **request_kwargs) as result:
+                    self.process_response_headers(result.headers)
+            except BaseException as error:
+                self.exit_guard(started_at, error=error)
+                if not isinstance(error, Exception):
+                    raise
+                delay = self.retry_error_delay(retry, error)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.exit_guard(started_at, result.status_code)
+            delay = self.retry_response_delay(
+                retry, result.status_code, result.headers, result.content)
+            if delay is None:
+                break
+            time.sleep(delay)
+        result = self.complete_lookup(lookup, result, result.status_code,
+                                      result.reason, result.headers,
+                                      result.content)
+        result.raise_for_status()
         return result
 
-    def put(self, path, **kwargs):
-        """Send a PUT request.
+    def cached_response(self, entry: CachedResponse) -> "requests.Response":
+        response = requests.Response()
+        response.status_code = entry.code
+        response.reason = entry.reason
+        response.url = entry.url
+        response.headers = CaseInsensitiveDict(entry.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry.body
+        return response
 
+    def is_retryable_error(self, error: BaseException) -> bool:
+        return super().is_retryable_error(error) or isinstance(
+            error, (requests.ConnectionError, requests.Timeout))
+
+    def stream(self, method: str, path: str, **kwargs):
+        """ Send a request through the transport session, yielding the
+        response body in chunks as they are read.
+
+        The response is closed, and its connection released, when the
+        iteration ends or the iterator is closed. A generator, or any
+        iterable, informed as data is sent with chunked transfer encoding.
+
+        :param str method: The request method
         :param path: absolute or relative URL for the new
         :class:`requests.Request` object.
         :param **kwargs: Optional arguments that ``request`` takes.
-        :return: :class:`requests.Response <Response>` object
-        :rtype: requests.Response
+        :key chunk_size: Maximum size of the chunks returned. Default is
+        `peasant.client.transport.STREAM_CHUNK_SIZE`.
+        :return: Iterator of bytes
         """
-        url = self.get_url(path, **kwargs)
-        headers = self.get_headers(**kwargs)
-        kwargs['headers'] = headers
-        kwargs = self.update_kwargs(METHOD_PUT, **kwargs)
-        with requests.put(url, **kwargs) as result:
+        chunk_size = kwargs.pop("chunk_size", STREAM_CHUNK_SIZE)
+        url, kwargs = self.prepare_request(method, path, **kwargs)
+        kwargs['stream'] = True
+        with self.session.request(method, url, **kwargs) as result:
+            self.process_response_headers(result.headers)
             result.raise_for_status()
-        return result
+            yield from result.iter_content(chunk_size)
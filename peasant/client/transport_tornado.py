@@ -12,23 +12,71 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import asyncio
+import io
 import logging
+from cartola.config import get_from_string
 from peasant import get_version
-from peasant.client.transport import (fix_address, METHOD_DELETE, METHOD_GET,
-                                      METHOD_HEAD, METHOD_OPTIONS,
-                                      METHOD_PATCH, METHOD_POST, METHOD_PUT,
-                                      Transport)
+from peasant.client.batch import AsyncBatchMixin
+from peasant.client.cache import CachedResponse
+from peasant.client.hedge import AsyncHedgeMixin
+from peasant.client.transport import (fix_address, is_streamed_body,
+                                      iter_body, METHOD_GET, Transport)
 
 logger = logging.getLogger(__name__)
 
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class StreamBufferFullError(Exception):
+    """ Raised by `TornadoTransport.stream` when the chunks received and not
+    consumed yet exceed the stream buffer size.
+    """
+
+
 tornado_installed = False
 try:
-    from tornado.httpclient import HTTPRequest
+    from tornado.httpclient import HTTPClientError, HTTPRequest, HTTPResponse
+    from tornado.httputil import (HTTPHeaders, HTTPInputError,
+                                  parse_response_start_line)
     from tornado import version as tornado_version
     from tornado.httpclient import AsyncHTTPClient
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient
     tornado_installed = True
 
+    CLIENT_CLASSES = {
+        'curl': "tornado.curl_httpclient.CurlAsyncHTTPClient",
+        'simple': "tornado.simple_httpclient.SimpleAsyncHTTPClient",
+    }
+
+    def get_client_class(client_class=None):
+        """ Resolve the AsyncHTTPClient implementation to be used by a
+        transport.
+
+        :param client_class: Either ``simple``, ``curl``, a dotted path to an
+        `AsyncHTTPClient` implementation or the class itself. If None the
+        class configured globally by `AsyncHTTPClient.configure` is returned.
+        :return type:
+        """
+        if client_class is None:
+            return AsyncHTTPClient.configured_class()
+        if isinstance(client_class, str):
+            client_class = get_from_string(
+                CLIENT_CLASSES.get(client_class.lower(), client_class))
+        return client_class
+
+    HTTP_REQUEST_ARGUMENTS = frozenset((
+        "auth_username", "auth_password", "auth_mode", "connect_timeout",
+        "request_timeout", "if_modified_since", "follow_redirects",
+        "max_redirects", "user_agent", "use_gzip", "network_interface",
+        "streaming_callback", "header_callback", "prepare_curl_callback",
+        "proxy_host", "proxy_port", "proxy_username", "proxy_password",
+        "proxy_auth_mode", "allow_nonstandard_methods", "validate_cert",
+        "ca_certs", "allow_ipv6", "client_key", "client_cert",
+        "body_producer", "expect_100_continue", "decompress_response",
+        "ssl_options",
+    ))
+
     def get_tornado_request(url, **kwargs):
         """ Return a HTTPRequest to help with AsyncHTTPClient and HTTPClient
         execution. The HTTPRequest will use the provided url combined with path
@@ -37,74 +85,31 @@ try:
         If form_urlencoded is defined as True a Content-Type header will be
         added to the request with application/x-www-form-urlencoded value.
 
+        Only keyword arguments accepted by HTTPRequest are passed to it, the
+        ones not informed are resolved from the client defaults.
+
         :param str url: Base url to be set to the HTTPRequest
+        :key body: The request body. An iterable or async iterable body is
+        sent chunk by chunk through a body_producer.
         :key form_urlencoded: If the true will add the header Content-Type
         application/x-www-form-urlencoded to the form. Default is False.
+        :key headers: Headers to be sent with the request.
         :key method: Method to be used by the HTTPRequest. Default it GET.
-        :key path: If informed will add the path to the base url informed.
-        Default is None.
         :return HTTPRequest:
         """
-        method = kwargs.get("method", METHOD_GET)
-
-        auth_username = kwargs.get("auth_username")
-        auth_password = kwargs.get("auth_password")
-        auth_mode = kwargs.get("auth_mode")
-        connect_timeout = kwargs.get("connect_timeout")
-        request_timeout = kwargs.get("request_timeout")
-        if_modified_since = kwargs.get("if_modified_since")
-        follow_redirects = kwargs.get("follow_redirects")
-        max_redirects = kwargs.get("max_redirects")
-        user_agent = kwargs.get("user_agent")
-        use_gzip = kwargs.get("use_gzip")
-        network_interface = kwargs.get("network_interface")
-        streaming_callback = kwargs.get("streaming_callback")
-        header_callback = kwargs.get("header_callback")
-        prepare_curl_callback = kwargs.get("prepare_curl_callback")
-        proxy_host = kwargs.get("proxy_host")
-        proxy_port = kwargs.get("proxy_port")
-        proxy_username = kwargs.get("proxy_username")
-        proxy_password = kwargs.get("proxy_password")
-        proxy_auth_mode = kwargs.get("proxy_auth_mode")
-        allow_nonstandard_methods = kwargs.get("allow_nonstandard_methods")
-        validate_cert = kwargs.get("validate_cert")
-        ca_certs = kwargs.get("ca_certs")
-        allow_ipv6 = kwargs.get("allow_ipv6")
-        client_key = kwargs.get("client_key")
-        client_cert = kwargs.get("client_cert")
-        body_producer = kwargs.get("body_producer")
-        expect_100_continue = kwargs.get("expect_100_continue")
-        decompress_response = kwargs.get("decompress_response")
-        ssl_options = kwargs.get("ssl_options")
-
-        form_urlencoded = kwargs.get("form_urlencoded", False)
-        request = HTTPRequest(
-                url, method=method, headers=None, body=None,
-                auth_username=auth_username, auth_password=auth_password,
-                auth_mode=auth_mode, connect_timeout=connect_timeout,
-                request_timeout=request_timeout,
-                if_modified_since=if_modified_since,
-                follow_redirects=follow_redirects, max_redirects=max_redirects,
-                user_agent=user_agent, use_gzip=use_gzip,
-                network_interface=network_interface,
-                streaming_callback=streaming_callback,
-                header_callback=header_callback,
-                prepare_curl_callback=prepare_curl_callback,
-                proxy_host=proxy_host, proxy_port=proxy_port,
-                proxy_username=proxy_username, proxy_password=proxy_password,
-                proxy_auth_mode=proxy_auth_mode,
-                allow_nonstandard_methods=allow_nonstandard_methods,
-                validate_cert=validate_cert, ca_certs=ca_certs,
-                allow_ipv6=allow_ipv6, client_key=client_key,
-                client_cert=client_cert, body_producer=body_producer,
-                expect_100_continue=expect_100_continue,
-                decompress_response=decompress_response,
-                ssl_options=ssl_options,
-                )
+        request_kwargs = {key: value for key, value in kwargs.items()
+                          if key in HTTP_REQUEST_ARGUMENTS}
+        headers = kwargs.get("headers")
+        if headers is not None:
+            headers = HTTPHeaders(headers)
         body = kwargs.get("body", None)
-        if body:
-            request.body = body
-        if form_urlencoded:
+        if is_streamed_body(body):
+            request_kwargs['body_producer'] = get_body_producer(body)
+            body = None
+        request = HTTPRequest(url, method=kwargs.get("method", METHOD_GET),
+                              headers=headers, body=body if body else None,
+                              **request_kwargs)
+        if kwargs.get("form_urlencoded", False):
             request.headers.add("Content-Type",
                                 "application/x-www-form-urlencoded")
         return request
@@ -112,10 +117,43 @@ except ImportError:
     pass
 
 
-class TornadoTransport(Transport):
+def get_body_producer(body):
+    """ Return a body_producer writing an iterable or async iterable body
+    chunk by chunk.
+    """
+    async def body_producer(write):
+        async for chunk in iter_body(body):
+            await write(chunk)
+    return body_producer
 
-    def __init__(self, bastion_address) -> None:
-        super().__init__()
+
+class TornadoTransport(AsyncBatchMixin, AsyncHedgeMixin, Transport):
+
+    def __init__(self, bastion_address, **kwargs) -> None:
+        """ Create a transport that sends requests to the bastion through an
+        `AsyncHTTPClient` owned by the transport.
+
+        :param str bastion_address: The bastion base address
+        :param dict kwargs:
+        :key client_class: AsyncHTTPClient implementation. Could be
+        ``simple``, ``curl``, a dotted path or the class itself. Default is
+        the class configured globally for AsyncHTTPClient.
+        :key max_clients: Maximum number of concurrent fetches, others will
+        be queued. Default is 10.
+        :key max_buffer_size: Maximum bytes to be read into memory at once.
+        Only used by the simple client.
+        :key max_body_size: Maximum accepted response body size. Only used by
+        the simple client.
+        :key max_header_size: Maximum accepted response header size. Only
+        used by the simple client.
+        :key connect_timeout: Default connect timeout in seconds.
+        :key request_timeout: Default request timeout in seconds.
+        :key stream_buffer_size: Maximum bytes received by `stream` and not
+        consumed yet. Default is `STREAM_BUFFER_SIZE`.
+        :key url_cache_size: Maximum number of urls resolved from paths to
+        be cached. Default is `peasant.client.transport.URL_CACHE_SIZE`.
+        """
+        super().__init__(**kwargs)
         if not tornado_installed:
             logger.warn("TornadoTransport cannot be used without tornado "
                         "installed.\nIt is necessary to install peasant "
@@ -123,64 +161,57 @@ class TornadoTransport(Transport):
                         "install peasant[all] or pip install peasant[tornado]"
                         "\n\nInstalling tornado manually will also work.\n")
             raise NotImplementedError
-        self._client = AsyncHTTPClient()
+        self._client = None
+        self._client_class = get_client_class(kwargs.get("client_class"))
+        self._max_clients = kwargs.get("max_clients", 10)
+        self._client_kwargs = {}
+        if issubclass(self._client_class, SimpleAsyncHTTPClient):
+            for key in ("max_buffer_size", "max_body_size",
+                        "max_header_size"):
+                if kwargs.get(key) is not None:
+                    self._client_kwargs[key] = kwargs[key]
+        self._request_defaults = {}
+        for key in ("connect_timeout", "request_timeout"):
+            if kwargs.get(key) is not None:
+                self._request_defaults[key] = kwargs[key]
+        self.stream_buffer_size = kwargs.get("stream_buffer_size",
+                                             STREAM_BUFFER_SIZE)
         self._bastion_address = fix_address(bastion_address)
         self._directory = None
         self.user_agent = (f"Peasant/{get_version()} "
                            f"Tornado/{tornado_version}")
-        self._basic_headers = {
+        self.basic_headers = {
             'User-Agent': self.user_agent
         }
 
-    def get_headers(self, **kwargs):
-        headers = copy.deepcopy(self._basic_headers)
-        _headers = kwargs.get('headers')
-        if _headers:
-            headers.update(_headers)
-        return headers
+    @property
+    def client(self) -> "AsyncHTTPClient":
+        """ The client used to fetch requests from the bastion.
 
-    async def delete(self, path: str, **kwargs: dict):
-        """Executes a DELETE request, asynchronously returning an
-        `tornado.HTTPResponse`.
+        The client is created on first use, bound to the current IOLoop, and
+        recreated if used after the transport was closed.
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
+        :return AsyncHTTPClient:
         """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_DELETE
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
-
-    async def get(self, path: str, **kwargs: dict):
-        """Executes a GET request, asynchronously returning an
-        `tornado.HTTPResponse`.
+        if self._client is None:
+            defaults = None
+            if self._request_defaults:
+                defaults = dict(self._request_defaults)
+            self._client = self._client_class(
+                force_instance=True, max_clients=self._max_clients,
+                defaults=defaults, **self._client_kwargs)
+        return self._client
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
+    def close(self):
+        """ Close the client owned by the transport, freeing its connections.
         """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_GET
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+        client = self._client
+        self._client = None
+        if client is not None:
+            client.close()
 
-    async def head(self, path: str, **kwargs: dict):
-        """Executes a HEAD request, asynchronously returning an
+    async def request(self, method: str, path: str, **kwargs: dict):
+        """Executes a request, asynchronously returning an
         `tornado.HTTPResponse`.
 
         This method returns a `tornado.web.Future` whose result is an
@@ -190,91 +221,138 @@ class TornadoTransport(Transport):
         contacted). Instead, if ``raise_error`` is set to False, the
         response will always be returned regardless of the response
         code.
+
+        Failed requests are retried as decided by the transport
+        retry_policy. Each attempt goes through the transport circuit breaker
+        and concurrency limiter, when they are set. GET and HEAD responses
+        are served from the transport response_cache while fresh.
         """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_HEAD
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+        lookup = self.lookup_cache(method, path, **kwargs)
+        if lookup is not None:
+            if lookup.fresh:
+                return self.cached_response(lookup.entry)
+            kwargs = self.revalidation_kwargs(lookup, **kwargs)
+        retry = self.start_retry(method, **kwargs)
+        while True:
+            url, request_kwargs = self.prepare_request(method, path, **kwargs)
+            request_kwargs['method'] = method
+            request = get_tornado_request(url, **request_kwargs)
+            started_at = await self.enter_guard_async()
+            try:
+                response = await self.client.fetch(request, raise_error=False)
+            except BaseException as error:
+                self.exit_guard(started_at, error=error)
+                if not isinstance(error, Exception):
+                    raise
+                delay = self.retry_error_delay(retry, error)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.exit_guard(started_at, response.code)
+            self.process_response_headers(response.headers)
+            delay = self.retry_response_delay(retry, response.code,
+                                              response.headers, response.body)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        response = self.complete_lookup(lookup, response, response.code,
+                                        response.reason, response.headers,
+                                        response.body)
+        if request_kwargs.get("raise_error", True):
+            response.rethrow()
+        return response
 
-    async def options(self, path: str, **kwargs: dict):
-        """Executes a OPTIONS request, asynchronously returning an
-        `tornado.HTTPResponse`.
+    def cached_response(self, entry: CachedResponse) -> "HTTPResponse":
+        return HTTPResponse(HTTPRequest(entry.url, method=entry.method),
+                            entry.code, reason=entry.reason,
+                            headers=HTTPHeaders(entry.headers),
+                            buffer=io.BytesIO(entry.body), request_time=0)
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
-        """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_OPTIONS
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+    def is_retryable_error(self, error: BaseException) -> bool:
+        # tornado reports timeouts and connection errors with the code 599
+        return super().is_retryable_error(error) or (
+            isinstance(error, HTTPClientError) and error.code == 599)
 
-    async def patch(self, path: str, **kwargs: dict):
-        """Executes a PATCH request, asynchronously returning an
-        `tornado.HTTPResponse`.
+    async def stream(self, method: str, path: str, **kwargs: dict):
+        """ Send a request, yielding the response body chunks as they are
+        received by the client.
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
-        """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_PATCH
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+        The response headers are processed, and an error response raised as
+        `tornado.httpclient.HTTPClientError` if ``raise_error`` isn't False,
+        before any chunk is yielded.
 
-    async def post(self, path: str, **kwargs: dict):
-        """Executes a POST request, asynchronously returning an
-        `tornado.HTTPResponse`.
+        Tornado can't pause a fetch while chunks aren't consumed, so the
+        chunks received and not consumed yet are buffered up to
+        ``buffer_size`` bytes. Beyond that the connection is closed and
+        `StreamBufferFullError` raised, keeping the memory used bound
+        regardless of the body size. Use a transport applying backpressure,
+        like `peasant.client.transport_asyncio.AsyncioTransport`, to stream
+        large bodies to a slow consumer.
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
+        :param str method: The request method
+        :param str path: Absolute or relative url
+        :param dict kwargs:
+        :key buffer_size: Maximum bytes buffered. Default is the transport
+        stream_buffer_size.
         """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_POST
-        request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+        buffer_size = kwargs.pop("buffer_size", self.stream_buffer_size)
+        url, kwargs = self.prepare_request(method, path, **kwargs)
+        kwargs['method'] = method
+        chunks = asyncio.Queue()
+        head = []
+        # bytes buffered, whether the consumer closed the stream and the
+        # error stopping the fetch
+        state = {'buffered': 0, 'closed': False, 'error': None}
 
-    async def put(self, path: str, **kwargs: dict):
-        """Executes a PUT request, asynchronously returning an
-        `tornado.HTTPResponse`.
+        def header_callback(line):
+            head.append(line)
+            if line == "\r\n":
+                chunks.put_nowait(head)
 
-        This method returns a `tornado.web.Future` whose result is an
-        `tornado.web.HTTPResponse`. By default, the ``Future`` will raise an
-        `tornado.web.HTTPError` if the request returned a non-200 response code
-        (other errors may also be raised if the server could not be
-        contacted). Instead, if ``raise_error`` is set to False, the
-        response will always be returned regardless of the response
-        code.
-        """
-        url = self.get_url(path, **kwargs)
-        kwargs["method"] = METHOD_PUT
+        def streaming_callback(chunk):
+            # a HTTPInputError closes the connection, so no more body is
+            # received, without tornado logging it as uncaught
+            if state['closed']:
+                raise HTTPInputError("Stream closed by its consumer.")
+            state['buffered'] += len(chunk)
+            if state['buffered'] > buffer_size:
+                state['error'] = StreamBufferFullError(
+                    f"More than {buffer_size} bytes received and not "
+                    f"consumed from {url}.")
+                raise HTTPInputError(str(state['error']))
+            chunks.put_nowait(chunk)
+
+        kwargs['header_callback'] = header_callback
+        kwargs['streaming_callback'] = streaming_callback
         request = get_tornado_request(url, **kwargs)
-        headers = self.get_headers(**kwargs)
-        request.headers.update(headers)
-        kwargs = self.update_kwargs(**kwargs)
-        return await self._client.fetch(request)
+        fetch = asyncio.ensure_future(
+            self.client.fetch(request, raise_error=False))
+        fetch.add_done_callback(lambda _: chunks.put_nowait(None))
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                if chunk is head:
+                    self._process_stream_head(head, kwargs)
+                    continue
+                state['buffered'] -= len(chunk)
+                yield chunk
+            if state['error'] is not None:
+                raise state['error']
+            response = fetch.result()
+            if response.code == 599 or not head:
+                response.rethrow()
+        finally:
+            if not fetch.done():
+                state['closed'] = True
+                fetch.cancel()
+
+    def _process_stream_head(self, head: list, kwargs: dict):
+        start_line = parse_response_start_line(head[0].strip())
+        headers = HTTPHeaders.parse("".join(head[1:]))
+        self.process_response_headers(headers)
+        if (kwargs.get("raise_error", True) and
+                not 200 <= start_line.code < 300):
+            raise HTTPClientError(start_line.code, start_line.reason)
@@ -17,8 +17,35 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import ec
 
 
+CURVES = {
+    'p-256': ec.SECP256R1,
+    'p-384': ec.SECP384R1,
+    'p-521': ec.SECP521R1,
+    'secp256r1': ec.SECP256R1,
+    'secp384r1': ec.SECP384R1,
+    'secp521r1': ec.SECP521R1,
+}
+
+
+def get_curve(curve=None):
+    """
+    Returns an elliptic curve instance from a curve instance, class or name.
+    Default is SECP384R1.
+    """
+    if curve is None:
+        return ec.SECP384R1()
+    if isinstance(curve, str):
+        curve_class = CURVES.get(curve.lower())
+        if curve_class is None:
+            raise ValueError("Unsupported curve: %s" % curve)
+        return curve_class()
+    if isinstance(curve, type):
+        return curve()
+    return curve
+
+
 def default_key_gen(**kwargs):
-    curve = kwargs.get("curve", ec.SECP384R1)
+    curve = get_curve(kwargs.get("curve"))
     backend = kwargs.get("backend", default_backend)
     return ec.generate_private_key(curve=curve, backend=backend)
 
@@ -26,8 +53,12 @@ def default_key_gen(**kwargs):
 def generate_key(**kwargs):
     """
     Generates a new Elliptic Curve private key.
+    :param curve: Curve instance, class or name. Default is SECP384R1.
+    :param key_gen: Callable, or its dotted path, generating the key from
+    the arguments informed. Default is `default_key_gen`.
+    :return: The EllipticCurvePrivateKey
     """
     key_gen = kwargs.get("key_gen", default_key_gen)
     if isinstance(key_gen, str):
         key_gen = get_from_string(key_gen)
-    return key_gen()
+    return key_gen(**kwargs)
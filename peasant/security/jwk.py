@@ -13,6 +13,22 @@
 # limitations under the License.
 
 import base64
+from collections import namedtuple, OrderedDict
+import functools
+import hashlib
+import json
+import threading
+import weakref
+
+KEY_CACHE_SIZE = 256
+# curve name: (JWK crv, JWS alg)
+EC_CURVES = {
+    'secp256r1': ("P-256", "ES256"),
+    'secp384r1': ("P-384", "ES384"),
+    'secp521r1': ("P-521", "ES512"),
+}
+
+JwkInfo = namedtuple("JwkInfo", ("alg", "jwk", "thumbprint"))
 
 
 def jose_b64(data):
@@ -22,20 +38,139 @@ def jose_b64(data):
     return base64.urlsafe_b64encode(data).decode('ascii').replace('=', '')
 
 
+def int_to_bytes(value, length=None):
+    """
+    Converts an integer to big-endian bytes, with the minimum length or the
+    length informed.
+    """
+    if length is None:
+        length = max((value.bit_length() + 7) // 8, 1)
+    return value.to_bytes(length, byteorder='big')
+
+
+class KeyCache:
+    """
+    Keeps values computed from key objects.
+
+    Keys supporting weak references are held weakly, so values go away with
+    their keys. Others, like the keys of cryptography's rust bindings,
+    aren't cached, unless strong is True: they are kept in a LRU of the
+    maxsize most recently used keys, which holds the key so its id isn't
+    reused. A strong cache keeps private keys in memory until evicted.
+    """
+
+    def __init__(self, maxsize=KEY_CACHE_SIZE, strong=False):
+        self.maxsize = maxsize
+        self.strong = strong
+        self._weak = weakref.WeakKeyDictionary()
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._weak) + len(self._lru)
+
+    def get(self, key, factory):
+        """
+        Returns the value cached for the key, computing it with factory if
+        needed.
+        """
+        with self._lock:
+            try:
+                value = self._weak.get(key)
+                if value is None:
+                    value = self._weak[key] = factory(key)
+                return value
+            except TypeError:
+                pass
+            if not self.strong:
+                return factory(key)
+            entry = self._lru.get(id(key))
+            if entry is not None and entry[0] is key:
+                self._lru.move_to_end(id(key))
+                return entry[1]
+            value = factory(key)
+            self._lru[id(key)] = (key, value)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._weak.clear()
+            self._lru.clear()
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _numbers_jwk_info(numbers):
+    from cryptography.hazmat.primitives.asymmetric.ec import (
+        EllipticCurvePublicNumbers
+    )
+    from cryptography.hazmat.primitives.asymmetric.rsa import (
+        RSAPublicNumbers
+    )
+    if isinstance(numbers, RSAPublicNumbers):
+        alg = "RS256"
+        jwk = {
+            'kty': "RSA",
+            'e': jose_b64(int_to_bytes(numbers.e)),
+            'n': jose_b64(int_to_bytes(numbers.n)),
+        }
+    elif isinstance(numbers, EllipticCurvePublicNumbers):
+        curve = EC_CURVES.get(numbers.curve.name)
+        if curve is None:
+            raise NotImplementedError("Unsupported curve: %s" %
+                                      numbers.curve.name)
+        crv, alg = curve
+        # coordinates have the full curve size, RFC 7518 section 6.2.1.2
+        length = (numbers.curve.key_size + 7) // 8
+        jwk = {
+            'kty': "EC",
+            'crv': crv,
+            'x': jose_b64(int_to_bytes(numbers.x, length)),
+            'y': jose_b64(int_to_bytes(numbers.y, length)),
+        }
+    else:
+        raise NotImplementedError("Key is not a RSA or EC key.")
+    # the jwk has only the required members, as RFC 7638 hashes them
+    canonical = json.dumps(jwk, sort_keys=True, separators=(",", ":"))
+    thumbprint = jose_b64(hashlib.sha256(canonical.encode()).digest())
+    return JwkInfo(alg, jwk, thumbprint)
+
+
+def jwk_info(key):
+    """
+    Returns the JWS algorithm, public JWK and RFC 7638 thumbprint of a
+    private or public RSA or EC key.
+
+    The result is cached by the key public numbers, so no key object is
+    kept alive by the cache.
+    """
+    public_key = key.public_key() if hasattr(key, "public_key") else key
+    if not hasattr(public_key, "public_numbers"):
+        raise NotImplementedError("Key is not a RSA or EC key.")
+    return _numbers_jwk_info(public_key.public_numbers())
+
+
+def public_jwk(key):
+    """
+    Returns the public JWK of a key.
+    """
+    return dict(jwk_info(key).jwk)
+
+
+def thumbprint(key):
+    """
+    Returns the RFC 7638 JWK thumbprint of a key.
+    """
+    return jwk_info(key).thumbprint
+
+
 def to_jwk(account_key):
     """
     Creates a new request header for the specified account key.
     """
-    numbers = account_key.public_key().public_numbers()
-    e = numbers.e.to_bytes((numbers.e.bit_length() // 8 + 1), byteorder='big')
-    n = numbers.n.to_bytes((numbers.n.bit_length() // 8 + 1), byteorder='big')
-    if n[0] == 0: # for strict JWK
-        n = n[1:]
+    info = jwk_info(account_key)
     return {
-        'alg': 'RS256',
-        'jwk': {
-            'kty': 'RSA',
-            'e': jose_b64(e),
-            'n': jose_b64(n),
-        },
+        'alg': info.alg,
+        'jwk': dict(info.jwk),
     }
@@ -0,0 +1,581 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import base64
+import binascii
+from collections import OrderedDict
+import functools
+import hashlib
+import json
+import logging
+import re
+import threading
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    decode_dss_signature, encode_dss_signature
+)
+from .ec import get_curve
+from .jwk import EC_CURVES, int_to_bytes, jose_b64, jwk_info, KeyCache
+from .rsa import MINIMUM_KEY_SIZE
+
+logger = logging.getLogger(__name__)
+
+# JWS alg: (hash algorithm, EC signature coordinate size)
+ALGORITHMS = {
+    'RS256': (hashes.SHA256, None),
+    'ES256': (hashes.SHA256, 32),
+    'ES384': (hashes.SHA384, 48),
+    'ES512': (hashes.SHA512, 66),
+}
+SERIALIZATION_COMPACT = "compact"
+SERIALIZATION_FLATTENED = "flattened"
+MAX_JWS_SIZE = 64 * 1024
+PUBLIC_KEY_CACHE_SIZE = 1024
+B64_PATTERN = re.compile(r"^[A-Za-z0-9_-]*$")
+
+
+def json_bytes(data):
+    """
+    Encodes data as compact JSON, used for protected headers and payloads.
+    """
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def encode_payload(payload):
+    """
+    Returns the bytes signed for a payload: bytes as they are, str encoded
+    to utf-8, None as the empty payload of a POST-as-GET, and anything else
+    as compact JSON.
+    """
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode()
+    return json_bytes(payload)
+
+
+class Signer:
+    """
+    Signs JWS with a private RSA or EC key.
+
+    The members of the protected header that don't change between
+    signatures, alg and either jwk or kid, are serialized and base64 encoded
+    once. Each signature only encodes its own members, like nonce and url,
+    which are appended to the precomputed header.
+    """
+
+    def __init__(self, key, **kwargs):
+        """
+        :param key: The private RSA or EC key
+        :param kid: Key id sent instead of the jwk, like an ACME account
+        url. Default is None, the jwk is sent.
+        :param header: Other members added to every protected header.
+        """
+        self.key = key
+        info = jwk_info(key)
+        self.alg = info.alg
+        self.kid = kwargs.get("kid")
+        self.thumbprint = info.thumbprint
+        hash_class, self._coordinate_size = ALGORITHMS[self.alg]
+        self._hash = hash_class()
+        header = {'alg': self.alg}
+        if self.kid is None:
+            header['jwk'] = info.jwk
+        else:
+            header['kid'] = self.kid
+        header.update(kwargs.get("header") or {})
+        # "{...}" without the closing brace, dynamic members are appended
+        prefix = json_bytes(header)[:-1]
+        # base64 encodes 3 bytes groups independently, so the aligned part
+        # of the prefix is encoded once
+        aligned = len(prefix) - len(prefix) % 3
+        self._prefix_b64 = jose_b64(prefix[:aligned])
+        self._prefix_tail = prefix[aligned:]
+
+    def protected_header(self, **members):
+        """
+        Returns the base64 encoded protected header, with the members
+        informed added to the precomputed ones.
+        """
+        if members:
+            tail = self._prefix_tail + b"," + json_bytes(members)[1:]
+        else:
+            tail = self._prefix_tail + b"}"
+        return self._prefix_b64 + jose_b64(tail)
+
+    def signature(self, signing_input):
+        """
+        Returns the raw JWS signature of the signing input bytes.
+        """
+        if self._coordinate_size is None:
+            return self.key.sign(signing_input, padding.PKCS1v15(),
+                                 self._hash)
+        # JWS EC signatures are r and s concatenated, not DER
+        r, s = decode_dss_signature(
+            self.key.sign(signing_input, ec.ECDSA(self._hash)))
+        return (int_to_bytes(r, self._coordinate_size) +
+                int_to_bytes(s, self._coordinate_size))
+
+    def _sign(self, payload, members):
+        protected = self.protected_header(**members)
+        encoded_payload = jose_b64(encode_payload(payload))
+        signature = jose_b64(self.signature(
+            f"{protected}.{encoded_payload}".encode("ascii")))
+        return protected, encoded_payload, signature
+
+    def sign(self, payload, **members):
+        """
+        Signs a payload, returning the JWS compact serialization.
+
+        :param payload: bytes, str, None for an empty payload, or data to be
+        encoded as JSON
+        :param members: Members added to the protected header, like nonce
+        and url
+        :return str:
+        """
+        return ".".join(self._sign(payload, members))
+
+    def sign_flattened(self, payload, **members):
+        """
+        Signs a payload, returning the JWS flattened JSON serialization, as
+        used by ACME request bodies.
+
+        :param payload: bytes, str, None for an empty payload, or data to be
+        encoded as JSON
+        :param members: Members added to the protected header, like nonce
+        and url
+        :return dict:
+        """
+        protected, payload, signature = self._sign(payload, members)
+        return {
+            'protected': protected,
+            'payload': payload,
+            'signature': signature,
+        }
+
+    def sign_batch(self, items, **kwargs):
+        """
+        Signs many payloads in one call, returning the signatures in the
+        order the items were informed.
+
+        :param items: Iterable of payloads, or of (payload, members) tuples
+        with the protected header members of each payload
+        :param serialization: `SERIALIZATION_FLATTENED` or
+        `SERIALIZATION_COMPACT`. Default is `SERIALIZATION_FLATTENED`.
+        :param executor: Executor signing the items concurrently. Default
+        is None, items are signed on the caller thread.
+        :return list:
+        """
+        serialization = kwargs.get("serialization", SERIALIZATION_FLATTENED)
+        if serialization == SERIALIZATION_FLATTENED:
+            sign = self.sign_flattened
+        elif serialization == SERIALIZATION_COMPACT:
+            sign = self.sign
+        else:
+            raise ValueError("Invalid serialization: %s" % serialization)
+
+        def sign_item(item):
+            if isinstance(item, tuple):
+                payload, members = item
+                return sign(payload, **(members or {}))
+            return sign(item)
+
+        executor = kwargs.get("executor")
+        if executor is None:
+            return [sign_item(item) for item in items]
+        return list(executor.map(sign_item, items))
+
+
+_signer_cache = KeyCache()
+
+
+def get_signer(key, kid=None):
+    """
+    Returns the signer of a key, created once per key and kid while the key
+    is alive. Keys that can't be weakly referenced, like the keys of
+    cryptography's rust bindings, get a new signer each call, as caching it
+    would keep the private key in memory. Its JWK and thumbprint are still
+    cached by `peasant.security.jwk.jwk_info`, and callers signing many
+    requests should keep the signer.
+
+    :param key: The private RSA or EC key
+    :param kid: Key id sent instead of the jwk
+    :return Signer:
+    """
+    signers = _signer_cache.get(key, lambda _: {})
+    signer = signers.get(kid)
+    if signer is None:
+        signer = signers.setdefault(kid, Signer(key, kid=kid))
+    return signer
+
+
+class JWSError(ValueError):
+    """
+    Raised when a JWS is malformed, uses an unexpected key or algorithm, or
+    its signature doesn't match.
+    """
+
+
+def jose_b64_decode(data):
+    """
+    Decodes JOSE/JWS base 64 encoded data, raising JWSError if invalid.
+    """
+    if not isinstance(data, str) or not B64_PATTERN.match(data):
+        raise JWSError("Invalid base64url data.")
+    try:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except (binascii.Error, ValueError) as error:
+        raise JWSError("Invalid base64url data.") from error
+
+
+def jwk_thumbprint(jwk):
+    """
+    Returns the RFC 7638 thumbprint of a JWK dict, raising JWSError if a
+    required member is missing.
+    """
+    try:
+        if jwk['kty'] == "RSA":
+            members = {'e': jwk['e'], 'kty': "RSA", 'n': jwk['n']}
+        elif jwk['kty'] == "EC":
+            members = {'crv': jwk['crv'], 'kty': "EC", 'x': jwk['x'],
+                       'y': jwk['y']}
+        else:
+            raise JWSError("Unsupported key type: %s" % jwk['kty'])
+    except (KeyError, TypeError) as error:
+        raise JWSError("Invalid jwk.") from error
+    canonical = json.dumps(members, sort_keys=True, separators=(",", ":"))
+    return jose_b64(hashlib.sha256(canonical.encode()).digest())
+
+
+def jwk_to_public_key(jwk):
+    """
+    Loads the public key of a JWK dict, raising JWSError if it is invalid.
+    """
+    try:
+        if jwk['kty'] == "RSA":
+            key = rsa.RSAPublicNumbers(
+                int.from_bytes(jose_b64_decode(jwk['e']), "big"),
+                int.from_bytes(jose_b64_decode(jwk['n']), "big")
+            ).public_key()
+            if key.key_size < MINIMUM_KEY_SIZE:
+                raise JWSError("The key must be %s bits or longer." %
+                               MINIMUM_KEY_SIZE)
+            return key
+        if jwk['kty'] == "EC":
+            curves = {crv: name for name, (crv, _) in EC_CURVES.items()}
+            curve = get_curve(curves[jwk['crv']])
+            return ec.EllipticCurvePublicNumbers(
+                int.from_bytes(jose_b64_decode(jwk['x']), "big"),
+                int.from_bytes(jose_b64_decode(jwk['y']), "big"),
+                curve).public_key()
+    except (KeyError, TypeError, ValueError) as error:
+        if isinstance(error, JWSError):
+            raise
+        raise JWSError("Invalid jwk.") from error
+    raise JWSError("Unsupported key type: %s" % jwk['kty'])
+
+
+def load_public_key(value):
+    """
+    Loads a public key from a key object, a private key, a JWK dict or PEM
+    data.
+    """
+    if isinstance(value, dict):
+        return jwk_to_public_key(value)
+    if isinstance(value, (bytes, str)):
+        from .keyring import pem_to_public_key
+        if isinstance(value, str):
+            value = value.encode()
+        return pem_to_public_key(value)
+    if hasattr(value, "public_key"):
+        return value.public_key()
+    return value
+
+
+class PublicKeyCache:
+    """
+    LRU of parsed public keys, keyed by JWK thumbprint or kid.
+    """
+
+    def __init__(self, maxsize=PUBLIC_KEY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, name):
+        with self._lock:
+            key = self._keys.get(name)
+            if key is None:
+                self.misses += 1
+                return None
+            self._keys.move_to_end(name)
+            self.hits += 1
+            return key
+
+    def put(self, name, key):
+        with self._lock:
+            self._keys[name] = key
+            self._keys.move_to_end(name)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def remove(self, name):
+        with self._lock:
+            self._keys.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+class VerifiedJWS:
+    """
+    A JWS with a valid signature.
+    """
+
+    __slots__ = ("header", "payload", "key", "key_id")
+
+    def __init__(self, header, payload, key, key_id):
+        self.header = header
+        self.payload = payload
+        self.key = key
+        self.key_id = key_id
+
+    def json(self):
+        """
+        Returns the payload decoded from JSON, None for an empty payload.
+        """
+        if not self.payload:
+            return None
+        return json.loads(self.payload)
+
+
+class Verifier:
+    """
+    Verifies JWS signed by peasant clients.
+
+    Cheap structural checks run first: the size, the serialization, the
+    base64 encoding, the protected header, the algorithm and the signature
+    length. Only then is the signature checked. Public keys are parsed once
+    and kept in a `PublicKeyCache`, keyed by the thumbprint of an embedded
+    jwk, or by kid for keys resolved by the key_resolver.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param algorithms: Accepted algorithms. Default is every algorithm
+        in `ALGORITHMS`.
+        :param key_cache: The `PublicKeyCache` of parsed keys. Default is a
+        new cache with `PUBLIC_KEY_CACHE_SIZE` keys.
+        :param key_resolver: Callable returning the key of a kid, as a key
+        object, JWK dict or PEM data, or None if the kid is unknown. Default
+        is None, only keys added with `add_key` are known.
+        :param max_size: Maximum size of a JWS. Default is `MAX_JWS_SIZE`.
+        :param executor: Executor running the signature check of
+        `verify_async`. Default is None, the loop default executor.
+        :param critical: Header members the caller understands, accepted
+        in a crit header. Default is none, a JWS with crit is rejected.
+        """
+        self.algorithms = frozenset(kwargs.get("algorithms", ALGORITHMS))
+        unsupported = self.algorithms - set(ALGORITHMS)
+        if unsupported:
+            raise ValueError("Unsupported algorithms: %s" %
+                             ", ".join(sorted(map(str, unsupported))))
+        self.critical = frozenset(kwargs.get("critical", ()))
+        self.key_cache = kwargs.get("key_cache") or PublicKeyCache()
+        self.key_resolver = kwargs.get("key_resolver")
+        self.max_size = kwargs.get("max_size", MAX_JWS_SIZE)
+        self.executor = kwargs.get("executor")
+
+    def add_key(self, kid, key):
+        """
+        Registers the key of a kid, as a key object, JWK dict or PEM data.
+        """
+        self.key_cache.put(f"kid:{kid}", load_public_key(key))
+
+    def parse(self, jws):
+        """
+        Runs the structural checks of a JWS, without resolving its key or
+        checking its signature.
+
+        :param jws: Compact serialization, as str or bytes, or flattened
+        JSON serialization, as dict or JSON data
+        :return tuple: The signing input, protected header, payload and
+        signature
+        """
+        if isinstance(jws, (bytes, bytearray)):
+            if len(jws) > self.max_size:
+                raise JWSError("The JWS is too big.")
+            try:
+                jws = jws.decode("ascii")
+            except UnicodeDecodeError as error:
+                raise JWSError("Invalid JWS.") from error
+        if isinstance(jws, str):
+            if len(jws) > self.max_size:
+                raise JWSError("The JWS is too big.")
+            if jws.startswith("{"):
+                try:
+                    jws = json.loads(jws)
+                except ValueError as error:
+                    raise JWSError("Invalid JWS.") from error
+            else:
+                parts = jws.split(".")
+                if len(parts) != 3:
+                    raise JWSError("A compact JWS has three parts.")
+                jws = dict(zip(("protected", "payload", "signature"),
+                               parts))
+        if not isinstance(jws, dict):
+            raise JWSError("Invalid JWS.")
+        protected = jws.get("protected")
+        payload = jws.get("payload")
+        signature = jws.get("signature")
+        if not all(isinstance(part, str)
+                   for part in (protected, payload, signature)):
+            raise JWSError("The JWS protected, payload and signature must "
+                           "be strings.")
+        if not protected or not signature:
+            raise JWSError("The JWS protected header and signature are "
+                           "required.")
+        try:
+            header = json.loads(jose_b64_decode(protected))
+        except ValueError as error:
+            if isinstance(error, JWSError):
+                raise
+            raise JWSError("Invalid protected header.") from error
+        if not isinstance(header, dict):
+            raise JWSError("Invalid protected header.")
+        alg = header.get("alg")
+        if not isinstance(alg, str) or alg not in self.algorithms:
+            raise JWSError("Unsupported algorithm: %s" % alg)
+        if ("jwk" in header) == ("kid" in header):
+            raise JWSError("The protected header must have either jwk or "
+                           "kid.")
+        if "kid" in header and not isinstance(header['kid'], str):
+            raise JWSError("The kid must be a string.")
+        if "jwk" in header and not isinstance(header['jwk'], dict):
+            raise JWSError("The jwk must be an object.")
+        if "crit" in header:
+            self._check_critical(header)
+        signature = jose_b64_decode(signature)
+        _, coordinate_size = ALGORITHMS[header['alg']]
+        if coordinate_size is not None and len(signature) != (
+                2 * coordinate_size):
+            raise JWSError("Invalid signature length.")
+        return (f"{protected}.{payload}".encode("ascii"), header,
+                jose_b64_decode(payload), signature)
+
+    def _check_critical(self, header):
+        # RFC 7515 section 4.1.11
+        crit = header['crit']
+        if (not isinstance(crit, list) or not crit or
+                not all(isinstance(name, str) for name in crit)):
+            raise JWSError("The crit header must be a list of names.")
+        for name in crit:
+            if name not in self.critical:
+                raise JWSError("Unsupported critical header: %s" % name)
+            if name not in header:
+                raise JWSError("Critical header missing: %s" % name)
+
+    def resolve_key(self, header):
+        """
+        Returns the public key of a protected header and its cache name,
+        parsing it only if it isn't cached.
+        """
+        if "jwk" in header:
+            name = f"jwk:{jwk_thumbprint(header['jwk'])}"
+            key = self.key_cache.get(name)
+            if key is None:
+                key = jwk_to_public_key(header['jwk'])
+                self.key_cache.put(name, key)
+            return key, name
+        name = f"kid:{header['kid']}"
+        key = self.key_cache.get(name)
+        if key is None:
+            resolved = None
+            if self.key_resolver is not None:
+                resolved = self.key_resolver(header['kid'])
+            if resolved is None:
+                raise JWSError("Unknown kid: %s" % header['kid'])
+            key = load_public_key(resolved)
+            self.key_cache.put(name, key)
+        return key, name
+
+    def check_signature(self, key, alg, signing_input, signature):
+        """
+        Checks the signature with the key, raising JWSError if the key
+        doesn't fit the algorithm or the signature doesn't match.
+        """
+        hash_class, coordinate_size = ALGORITHMS[alg]
+        try:
+            if coordinate_size is None:
+                if not isinstance(key, rsa.RSAPublicKey):
+                    raise JWSError("The %s algorithm needs a RSA key." % alg)
+                if len(signature) != (key.key_size + 7) // 8:
+                    raise JWSError("Invalid signature length.")
+                key.verify(signature, signing_input, padding.PKCS1v15(),
+                           hash_class())
+                return
+            if (not isinstance(key, ec.EllipticCurvePublicKey) or
+                    EC_CURVES.get(key.curve.name, (None, None))[1] != alg):
+                raise JWSError("The %s algorithm needs a key of its "
+                               "curve." % alg)
+            der = encode_dss_signature(
+                int.from_bytes(signature[:coordinate_size], "big"),
+                int.from_bytes(signature[coordinate_size:], "big"))
+            key.verify(der, signing_input, ec.ECDSA(hash_class()))
+        except InvalidSignature as error:
+            raise JWSError("Invalid signature.") from error
+
+    def verify(self, jws):
+        """
+        Verifies a JWS, raising JWSError if it is invalid.
+
+        :param jws: Compact or flattened JSON serialization
+        :return VerifiedJWS:
+        """
+        signing_input, header, payload, signature = self.parse(jws)
+        key, name = self.resolve_key(header)
+        self.check_signature(key, header['alg'], signing_input, signature)
+        return VerifiedJWS(header, payload, key, name)
+
+    async def verify_async(self, jws):
+        """
+        Verifies a JWS from a coroutine. The structural checks run on the
+        loop, rejecting malformed JWS right away, while resolving the key
+        and checking the signature run in the verifier executor.
+
+        :param jws: Compact or flattened JSON serialization
+        :return VerifiedJWS:
+        """
+        signing_input, header, payload, signature = self.parse(jws)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(
+                self._verify_parsed, signing_input, header, payload,
+                signature))
+
+    def _verify_parsed(self, signing_input, header, payload, signature):
+        key, name = self.resolve_key(header)
+        self.check_signature(key, header['alg'], signing_input, signature)
+        return VerifiedJWS(header, payload, key, name)
@@ -0,0 +1,297 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import functools
+import logging
+import threading
+import typing as t
+from cryptography.hazmat.primitives.serialization import (
+    load_pem_private_key
+)
+from .ec import get_curve
+from .rsa import MINIMUM_KEY_SIZE
+
+logger = logging.getLogger(__name__)
+
+LOW_WATERMARK = 2
+HIGH_WATERMARK = 8
+
+
+def key_spec(**kwargs) -> t.Tuple[str, t.Union[int, str]]:
+    """ Return the queue a key belongs to, from the `keyring.generate_key`
+    arguments: ("rsa", size) or ("ec", curve name).
+    """
+    key_type = kwargs.get("type", "rsa").lower()
+    if key_type == "rsa":
+        return "rsa", kwargs.get("size", MINIMUM_KEY_SIZE)
+    if key_type == "ec":
+        return "ec", get_curve(kwargs.get("curve")).name
+    raise NotImplementedError
+
+
+def is_poolable(**kwargs) -> bool:
+    """ Return False if the key generation is customized with a key_gen, so
+    it can't be served by the pool.
+    """
+    return kwargs.get("key_gen") is None
+
+
+def spec_kwargs(spec: t.Tuple[str, t.Union[int, str]]) -> dict:
+    """ Return the `keyring.generate_key` arguments of a key spec.
+    """
+    key_type, parameter = spec
+    if key_type == "rsa":
+        return {'type': key_type, 'size': parameter}
+    return {'type': key_type, 'curve': parameter}
+
+
+def generate_pem(kwargs: dict) -> bytes:
+    """ Generate a private key, returning it in PEM format.
+
+    This runs in worker processes, keys cross the process boundary as PEM.
+    Used by the key pool and `keyring.generate_keys`.
+
+    :param dict kwargs: The `keyring.generate_key` arguments
+    """
+    from .keyring import generate_key, key_to_pem
+    return key_to_pem(generate_key(**kwargs))
+
+
+def load_pooled_key(pem: bytes):
+    """ Load a key generated by the pool workers. The RSA key validation is
+    skipped, as the key was just generated by peasant itself.
+    """
+    return load_pem_private_key(pem, password=None,
+                                unsafe_skip_rsa_key_validation=True)
+
+
+class KeyPool:
+    """ Keeps private keys generated ahead of time by a process pool.
+
+    There is a queue for each key type and size or curve. When a queue,
+    counting keys being generated, drops below low_watermark, it is filled
+    up to high_watermark. A key asked for while its queue is empty is
+    generated by the process pool right away, so keys are never generated
+    on the caller thread.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key low_watermark: Keys left in a queue triggering a fill. Default
+        is `LOW_WATERMARK`.
+        :key high_watermark: Keys a queue is filled up to. Default is
+        `HIGH_WATERMARK`.
+        :key max_workers: Number of worker processes. Default is the number
+        of processors.
+        :key mp_context: Multiprocessing context used to start the workers.
+        Default is the platform default.
+        """
+        self.low_watermark = kwargs.get("low_watermark", LOW_WATERMARK)
+        self.high_watermark = kwargs.get("high_watermark", HIGH_WATERMARK)
+        if self.low_watermark > self.high_watermark:
+            raise ValueError("The low watermark must not be greater than "
+                             "the high watermark.")
+        self._max_workers = kwargs.get("max_workers")
+        self._mp_context = kwargs.get("mp_context")
+        self._executor = None
+        self._queues = {}
+        self._pending = {}
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """ The process pool generating the keys.
+
+        The executor is created on first use, and recreated if used after
+        the pool was closed.
+
+        :return ProcessPoolExecutor:
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers,
+                    mp_context=self._mp_context)
+            return self._executor
+
+    def available(self, **kwargs) -> int:
+        """ Return the number of keys ready in a queue.
+
+        :param dict kwargs: The `keyring.generate_key` arguments
+        """
+        with self._lock:
+            return len(self._queues.get(key_spec(**kwargs), ()))
+
+    def fill(self, **kwargs) -> t.List[Future]:
+        """ Start filling a queue up to the high watermark.
+
+        :param dict kwargs: The `keyring.generate_key` arguments
+        :return list: The futures of the keys being generated
+        """
+        return self._fill(key_spec(**kwargs), self.high_watermark)
+
+    def _fill(self, spec: tuple, target: int) -> t.List[Future]:
+        with self._lock:
+            queued = len(self._queues.get(spec, ()))
+            missing = target - queued - self._pending.get(spec, 0)
+            if missing <= 0:
+                return []
+            self._pending[spec] = self._pending.get(spec, 0) + missing
+        executor = self.executor
+        futures = []
+        for _ in range(missing):
+            future = executor.submit(generate_pem, spec_kwargs(spec))
+            with self._lock:
+                self._futures.add(future)
+            future.add_done_callback(functools.partial(self._filled, spec))
+            futures.append(future)
+        logger.debug("Filling %s key queue with %s keys.", spec, missing)
+        return futures
+
+    def _filled(self, spec: tuple, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+            self._pending[spec] -= 1
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                self._queues.setdefault(spec, deque()).append(
+                    future.result())
+                return
+        logger.warning("Failed to generate a %s key for the pool: %s", spec,
+                       error)
+
+    def _pop(self, spec: tuple) -> t.Tuple[t.Optional[bytes], bool]:
+        """ Take a key from a queue, without filling it.
+
+        :return tuple: The key PEM, None if the queue is empty, and True if
+        the queue must be filled
+        """
+        with self._lock:
+            queue = self._queues.get(spec)
+            pem = queue.popleft() if queue else None
+            left = (len(queue) if queue else 0) + self._pending.get(spec, 0)
+        return pem, left < self.low_watermark
+
+    def _submit(self, spec: tuple) -> Future:
+        return self.executor.submit(generate_pem, spec_kwargs(spec))
+
+    def get(self, **kwargs):
+        """ Return a private key from the pool, waiting for the process pool
+        to generate one if the queue is empty.
+
+        A key_gen can't be pooled, so the key is generated on the caller
+        thread.
+
+        :param dict kwargs: The `keyring.generate_key` arguments
+        """
+        if not is_poolable(**kwargs):
+            from .keyring import generate_key
+            return generate_key(**kwargs)
+        spec = key_spec(**kwargs)
+        pem, needs_fill = self._pop(spec)
+        if needs_fill:
+            self._fill(spec, self.high_watermark)
+        if pem is None:
+            pem = self._submit(spec).result()
+        return load_pooled_key(pem)
+
+    async def get_async(self, **kwargs):
+        """ Return a private key from the pool, without blocking the event
+        loop while a key is generated.
+
+        Creating the process pool starts the worker processes, and
+        submitting a job may start one, so the fill and submit calls run in
+        the loop default executor, never on the loop thread. A key_gen can't
+        be pooled, so the key is generated by the loop default executor too.
+
+        :param dict kwargs: The `keyring.generate_key` arguments
+        """
+        loop = asyncio.get_running_loop()
+        if not is_poolable(**kwargs):
+            from .keyring import generate_key
+            return await loop.run_in_executor(
+                None, functools.partial(generate_key, **kwargs))
+        spec = key_spec(**kwargs)
+        pem, needs_fill = self._pop(spec)
+        if needs_fill:
+            loop.run_in_executor(
+                None, self._fill, spec, self.high_watermark
+            ).add_done_callback(functools.partial(self._fill_done, spec))
+        if pem is None:
+            future = await loop.run_in_executor(None, self._submit, spec)
+            pem = await asyncio.wrap_future(future)
+        return load_pooled_key(pem)
+
+    @staticmethod
+    def _fill_done(spec: tuple, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Failed to fill the %s key queue: %s", spec,
+                           future.exception())
+
+    def clear(self):
+        """ Discard the keys ready in the queues.
+        """
+        with self._lock:
+            self._queues.clear()
+
+    def close(self):
+        """ Cancel the keys not being generated yet, discard the ready ones
+        and shut the process pool down.
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.clear()
+
+
+_key_pool = None
+_key_pool_lock = threading.Lock()
+
+
+def get_key_pool() -> KeyPool:
+    """ Return the key pool shared by `keyring.generate_key_async`, created
+    with the default watermarks on first use.
+
+    :return KeyPool:
+    """
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is None:
+            _key_pool = KeyPool()
+        return _key_pool
+
+
+def set_key_pool(key_pool: t.Optional[KeyPool]):
+    """ Replace the shared key pool, closing the previous one.
+
+    :param KeyPool key_pool: The new pool, None to create a default one on
+    next use
+    """
+    global _key_pool
+    with _key_pool_lock:
+        previous, _key_pool = _key_pool, key_pool
+    if previous is not None and previous is not key_pool:
+        previous.close()
@@ -30,6 +30,72 @@ def generate_key(**kwargs):
     raise NotImplementedError
 
 
+async def generate_key_async(**kwargs):
+    """
+    Returns a new private key without generating it on the event loop
+    thread, taking it from a pool of keys generated ahead of time by worker
+    processes.
+
+    :param key_pool: The `peasant.security.keypool.KeyPool` the key is taken
+    from. Default is the shared pool.
+    :param kwargs: The `generate_key` arguments
+    :return:
+    """
+    from .keypool import get_key_pool
+    key_pool = kwargs.pop("key_pool", None) or get_key_pool()
+    return await key_pool.get_async(**kwargs)
+
+
+def generate_keys(count, **kwargs):
+    """
+    Generates count private keys across worker processes, yielding them in
+    PEM format as they complete, so they can be written out without being
+    held in memory all at once.
+
+    At most window keys are generated or waiting to be consumed at a time.
+    A key_gen must be picklable, like a module level function, to be sent
+    to the workers.
+
+    :param count: Number of keys to be generated
+    :param executor: The executor generating the keys. Default is a new
+    `ProcessPoolExecutor`, shut down when the iteration ends.
+    :param max_workers: Number of worker processes of the default executor.
+    Default is the number of processors.
+    :param window: Maximum number of keys generated at once. Default is
+    twice the number of workers.
+    :param kwargs: The `generate_key` arguments
+    :return: Iterator of PEM encoded private keys
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    import os
+    from .keypool import generate_pem
+    executor = kwargs.pop("executor", None)
+    max_workers = kwargs.pop("max_workers", None)
+    window = kwargs.pop("window", None)
+    if window is None:
+        window = 2 * (max_workers or os.cpu_count() or 1)
+    if window < 1:
+        raise ValueError("The window must be at least 1.")
+    owned = executor is None
+    if owned:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    running = set()
+    submitted = 0
+    try:
+        while submitted < count or running:
+            while submitted < count and len(running) < window:
+                running.add(executor.submit(generate_pem, kwargs))
+                submitted += 1
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in running:
+            future.cancel()
+        if owned:
+            executor.shutdown(wait=True)
+
+
 def pem_to_private_key(data):
     from cryptography.hazmat.backends import default_backend
     from cryptography.hazmat.primitives.asymmetric.ec import (
@@ -12,11 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+from collections import OrderedDict
 import functools
+import inspect
 import logging
+import secrets
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+NONCE_HEADER = "Replay-Nonce"
+NONCE_SERVICE_METHODS = ("block_request", "clear", "consume", "from_request",
+                         "provided")
+
+_background_tasks = set()
+
 
 class NonceServiceMixin:
 
@@ -47,20 +59,294 @@ class NonceServiceMixin:
         raise NotImplementedError
 
 
+class _NonceStripe:
+    """ A slice of the nonces kept by `InMemoryNonceService`, with its own
+    lock.
+
+    Nonces are mapped to the time bucket they were issued in, and buckets
+    are kept in issue order, so expired nonces are dropped a whole bucket at
+    a time from the front.
+    """
+
+    __slots__ = ("lock", "nonces", "buckets")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nonces = {}
+        self.buckets = OrderedDict()
+
+
+class InMemoryNonceService(NonceServiceMixin):
+    """ Nonce service keeping issued nonces in process memory.
+
+    Issuing, consuming and clearing a nonce are O(1). Nonces are spread
+    across lock striped slices, so concurrent requests rarely contend on
+    the same lock. Expiry is resolved by time buckets, a nonce is valid
+    for at least ttl seconds and at most ttl plus bucket_width seconds.
+    When max_nonces is reached the oldest nonces are evicted.
+
+    A nonce is valid once, consuming it removes it from the service.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param dict kwargs:
+        :key ttl: Seconds a nonce is valid. Default is 300.
+        :key bucket_width: Seconds covered by each expiry bucket. Default is
+        1.
+        :key max_nonces: Maximum number of nonces kept. Default is 100000.
+        :key stripes: Number of lock striped slices. Default is 16.
+        :key header: Request header the nonce is read from. Default is
+        Replay-Nonce.
+        :key nonce_size: Random bytes used by each nonce. Default is 16.
+        :key clock: Callable returning the current time in seconds. Default
+        is `time.monotonic`.
+        """
+        self.ttl = kwargs.get("ttl", 300)
+        self.bucket_width = kwargs.get("bucket_width", 1)
+        self.header = kwargs.get("header", NONCE_HEADER)
+        self.nonce_size = kwargs.get("nonce_size", 16)
+        self._clock = kwargs.get("clock", time.monotonic)
+        stripes = kwargs.get("stripes", 16)
+        self._max_stripe_nonces = max(
+            kwargs.get("max_nonces", 100000) // stripes, 1)
+        self._stripes = tuple(_NonceStripe() for _ in range(stripes))
+
+    def __len__(self):
+        """ Return the number of nonces kept, including expired ones not
+        purged yet.
+        """
+        return sum(len(stripe.nonces) for stripe in self._stripes)
+
+    def purge(self):
+        """ Drop expired nonces from every stripe.
+
+        Stripes are purged when nonces are issued on them, call this to
+        release memory held by stripes not being used.
+        """
+        now = self._clock()
+        for stripe in self._stripes:
+            with stripe.lock:
+                self._expire(stripe, now)
+
+    def _stripe(self, nonce) -> _NonceStripe:
+        return self._stripes[hash(nonce) % len(self._stripes)]
+
+    def _expire(self, stripe: _NonceStripe, now: float):
+        buckets = stripe.buckets
+        while buckets:
+            bucket = next(iter(buckets))
+            if (bucket + 1) * self.bucket_width + self.ttl > now:
+                break
+            for nonce in buckets.pop(bucket):
+                stripe.nonces.pop(nonce, None)
+
+    def _evict(self, stripe: _NonceStripe):
+        buckets = stripe.buckets
+        while buckets:
+            bucket, nonces = next(iter(buckets.items()))
+            if nonces:
+                stripe.nonces.pop(nonces.pop(), None)
+                return
+            del buckets[bucket]
+
+    def issue(self, **kwargs) -> str:
+        """ Issue a new nonce.
+
+        :return str:
+        """
+        nonce = secrets.token_urlsafe(self.nonce_size)
+        now = self._clock()
+        bucket = int(now // self.bucket_width)
+        stripe = self._stripe(nonce)
+        with stripe.lock:
+            self._expire(stripe, now)
+            if len(stripe.nonces) >= self._max_stripe_nonces:
+                self._evict(stripe)
+            stripe.nonces[nonce] = bucket
+            nonces = stripe.buckets.get(bucket)
+            if nonces is None:
+                nonces = stripe.buckets[bucket] = set()
+            nonces.add(nonce)
+        return nonce
+
+    def consume(self, **kwargs):
+        """ Consume a nonce, returning it if valid or None otherwise.
+
+        :param kwargs:
+        :key request: The Http request being serviced.
+        :key nonce: The nonce being consumed by the server.
+        :return str:
+        """
+        nonce = kwargs.get("nonce")
+        if not nonce:
+            return None
+        now = self._clock()
+        stripe = self._stripe(nonce)
+        with stripe.lock:
+            bucket = stripe.nonces.pop(nonce, None)
+            if bucket is None:
+                return None
+            nonces = stripe.buckets.get(bucket)
+            if nonces is not None:
+                nonces.discard(nonce)
+            if (bucket + 1) * self.bucket_width + self.ttl <= now:
+                return None
+        return nonce
+
+    def clear(self, **kwargs):
+        """ Clears a nonce sent to the request. Consumed nonces are already
+        removed, so this only makes sure the nonce can't be used anymore.
+
+        :param kwargs:
+        :key request: The Http request being serviced.
+        :key nonce: The nonce being consumed by the server.
+        """
+        nonce = kwargs.get("nonce")
+        if not nonce:
+            return
+        stripe = self._stripe(nonce)
+        with stripe.lock:
+            bucket = stripe.nonces.pop(nonce, None)
+            if bucket is not None and bucket in stripe.buckets:
+                stripe.buckets[bucket].discard(nonce)
+
+    def block_request(self, **kwargs):
+        """ Answer the request with 400, as no valid nonce was sent.
+
+        :param kwargs:
+        :key request: The request handler being serviced.
+        """
+        request = kwargs.get("request")
+        request.set_status(400)
+        request.write("Missing or invalid nonce.")
+
+    def from_request(self, **kwargs):
+        request = kwargs.get("request")
+        return request.request.headers.get(self.header)
+
+    def provided(self, **kwargs):
+        return bool(self.from_request(**kwargs))
+
+
+def is_async_service(nonce_service) -> bool:
+    """ Return True if any of the nonce service methods is a coroutine
+    function.
+
+    Methods returning awaitables without being coroutine functions, like
+    decorated or partial methods, aren't detected here. `nonced` checks
+    the values returned at call time for those.
+    """
+    return any(inspect.iscoroutinefunction(getattr(nonce_service, name, None))
+               for name in NONCE_SERVICE_METHODS)
+
+
+async def _resolve(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Error clearing nonce.", exc_info=task.exception())
+
+
+def _clear_in_background(result):
+    if inspect.isawaitable(result):
+        task = asyncio.ensure_future(result)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_done)
+
+
+def _schedule_clear(nonce_service, handler, nonce):
+    """ Clear the nonce in a later loop iteration, after the handler
+    returned and the response was finished, so clearing doesn't add to the
+    request latency.
+    """
+    def clear():
+        try:
+            result = nonce_service.clear(request=handler, nonce=nonce)
+        except Exception:
+            logger.exception("Error clearing nonce.")
+            return
+        _clear_in_background(result)
+    asyncio.get_running_loop().call_soon(clear)
+
+
+async def _run_nonced(method, handler, args, kwargs, **steps):
+    """ Run a nonced handler, awaiting the nonce service and handler
+    results that are awaitable.
+
+    :param steps: Results already returned to the synchronous wrapper, by
+    provided, from_request, consume and the handler method, before one of
+    them returned an awaitable
+    """
+    nonce_service = handler.nonce_service
+
+    async def step(name, call):
+        return await _resolve(steps[name] if name in steps else call())
+
+    if await step("provided",
+                  lambda: nonce_service.provided(request=handler)):
+        nonce = await step(
+            "nonce", lambda: nonce_service.from_request(request=handler))
+        if await step("consumed", lambda: nonce_service.consume(
+                request=handler, nonce=nonce)) is not None:
+            retval = await step("retval",
+                                lambda: method(handler, *args, **kwargs))
+            _schedule_clear(nonce_service, handler, nonce)
+            return retval
+    else:
+        await _resolve(nonce_service.block_request(request=handler))
+
+
 def nonced(method):
     """ Decorates a handler to only accept requests with nonce header.
     If the request is missing the request handler we set the status as 400 with
     a malformed message.
+
+    Coroutine handlers, or handlers whose nonce service has coroutine
+    methods, are wrapped by a coroutine. The nonce is consumed without
+    blocking the loop before the handler runs, and cleared in a later loop
+    iteration after the handler returns. Nonce service methods or handlers
+    returning awaitables without being coroutine functions, like decorated
+    or partial methods, are detected when called, and the rest of the
+    request runs in a coroutine returned to tornado.
     """
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            return await _run_nonced(method, self, args, kwargs)
+        return async_wrapper
+
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        if self.nonce_service.provided(request=self):
-            nonce = self.nonce_service.from_request(request=self)
-            if self.nonce_service.consume(
-                    request=self, nonce=nonce) is not None:
-                retval = method(self, *args, **kwargs)
-                self.nonce_service.clear(request=self, nonce=nonce)
-                return retval
-        else:
-            self.nonce_service.block_request(request=self)
+        nonce_service = self.nonce_service
+        if is_async_service(nonce_service):
+            return _run_nonced(method, self, args, kwargs)
+        # a value returned as awaitable switches to the coroutine, returned
+        # to tornado, which awaits it
+        steps = {}
+        steps['provided'] = nonce_service.provided(request=self)
+        if inspect.isawaitable(steps['provided']):
+            return _run_nonced(method, self, args, kwargs, **steps)
+        if not steps['provided']:
+            return nonce_service.block_request(request=self)
+        steps['nonce'] = nonce_service.from_request(request=self)
+        if inspect.isawaitable(steps['nonce']):
+            return _run_nonced(method, self, args, kwargs, **steps)
+        steps['consumed'] = nonce_service.consume(request=self,
+                                                  nonce=steps['nonce'])
+        if inspect.isawaitable(steps['consumed']):
+            return _run_nonced(method, self, args, kwargs, **steps)
+        if steps['consumed'] is None:
+            return None
+        steps['retval'] = method(self, *args, **kwargs)
+        if inspect.isawaitable(steps['retval']):
+            return _run_nonced(method, self, args, kwargs, **steps)
+        _clear_in_background(nonce_service.clear(request=self,
+                                                 nonce=steps['nonce']))
+        return steps['retval']
     return wrapper
@@ -52,6 +52,7 @@ setup(
     author_email=peasant.get_author_email(),
     extras_require={
         'all': resolve_requires("requirements/all.txt"),
+        'h2': resolve_requires("requirements/h2.txt"),
         'requests': resolve_requires("requirements/requests.txt"),
         'tornado': resolve_requires("requirements/tornado.txt"),
     },
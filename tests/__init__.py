@@ -14,6 +14,8 @@
 
 from importlib import reload
 import os
+import socket
+import time
 
 TEST_ROOT = os.path.abspath(os.path.dirname(__file__))
 FIXTURES_ROOT = os.path.join(TEST_ROOT, "fixtures")
@@ -37,6 +39,25 @@ def chdir_fixture_app(app_name, **kwargs):
     return test_app_dirname
 
 
+def wait_for_port(port, host="localhost", timeout=10):
+    """ Block until a fixture application launched in another process starts
+    accepting connections at the given port.
+
+    :param int port: The port the application is listening
+    :param str host: The application host. Default is localhost
+    :param float timeout: Seconds to wait before giving up
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
 def chdir_app(app_name, directory=None):
     """ Change to the application directory located at the resource directory
     for conf tests.
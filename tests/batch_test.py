@@ -0,0 +1,150 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from peasant.client.batch import (AsyncBatchMixin, BatchRequest,
+                                  iter_thread_batch, to_batch_request)
+from peasant.client.protocol import AsyncPeasant
+from peasant.client.transport import Transport
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+
+class AsyncBatchTransport(AsyncBatchMixin, Transport):
+    """ Answers every request with its path after the delay informed, or
+    raises a ValueError if the path is /error.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.running = 0
+        self.peak = 0
+
+    async def request(self, method, path, **kwargs):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(kwargs.get("delay", 0.01))
+            if path == "/error":
+                raise ValueError(path)
+            return f"{method} {path}"
+        finally:
+            self.running -= 1
+
+
+class ThreadBatchTransport(Transport):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, path, **kwargs):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(kwargs.get("delay", 0.01))
+            if path == "/error":
+                raise ValueError(path)
+            return f"{method} {path}"
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class BatchRequestTestCase(TestCase):
+
+    def test_to_batch_request(self):
+        request = to_batch_request(("GET", "/a"))
+        self.assertEqual(("GET", "/a", {}),
+                         (request.method, request.path, request.kwargs))
+        request = to_batch_request(("POST", "/a", {'body': "da body"}))
+        self.assertEqual({'body': "da body"}, request.kwargs)
+        request = to_batch_request({'method': "PUT", 'path': "/a",
+                                    'body': "da body"})
+        self.assertEqual(("PUT", "/a", {'body': "da body"}),
+                         (request.method, request.path, request.kwargs))
+        request = BatchRequest("GET", "/a")
+        self.assertIs(request, to_batch_request(request))
+        with self.assertRaises(TypeError):
+            to_batch_request("/a")
+
+
+class AsyncBatchTestCase(IsolatedAsyncioTestCase):
+
+    async def test_batch(self):
+        transport = AsyncBatchTransport(batch_concurrency=3)
+        requests = [("GET", f"/{index}", {'delay': (20 - index) / 1000})
+                    for index in range(20)]
+        requests.insert(5, ("GET", "/error"))
+        results = await transport.batch(requests)
+        self.assertEqual(3, transport.peak)
+        self.assertEqual(list(range(21)),
+                         [result.index for result in results])
+        self.assertFalse(results[5].ok)
+        self.assertIsInstance(results[5].error, ValueError)
+        with self.assertRaises(ValueError):
+            results[5].result()
+        self.assertEqual(["GET /0", "GET /1"],
+                         [result.result() for result in results[:2]])
+        self.assertEqual(20, len([result for result in results
+                                  if result.ok]))
+
+    async def test_as_completed(self):
+        transport = AsyncBatchTransport()
+        requests = [("GET", "/slow", {'delay': 0.05}),
+                    ("GET", "/fast", {'delay': 0.01})]
+        peasant = AsyncPeasant(transport)
+        results = [result async for result in peasant.as_completed(
+            requests, concurrency=2)]
+        self.assertEqual([1, 0], [result.index for result in results])
+        self.assertEqual(2, transport.peak)
+        transport = AsyncBatchTransport()
+        peasant = AsyncPeasant(transport)
+        results = [result async for result in peasant.as_completed(
+            requests, concurrency=1)]
+        self.assertEqual([0, 1], [result.index for result in results])
+        self.assertEqual(1, transport.peak)
+        results = await peasant.batch([])
+        self.assertEqual([], results)
+
+    async def test_as_completed_interrupted(self):
+        transport = AsyncBatchTransport(batch_concurrency=2)
+        results = transport.as_completed(
+            [("GET", f"/{index}", {'delay': 0.01}) for index in range(10)])
+        async for _ in results:
+            break
+        await results.aclose()
+        await asyncio.sleep(0)
+        self.assertEqual(0, transport.running)
+
+
+class ThreadBatchTestCase(TestCase):
+
+    def test_iter_thread_batch(self):
+        transport = ThreadBatchTransport()
+        requests = [("GET", "/slow", {'delay': 0.1}), ("GET", "/error"),
+                    ("GET", "/fast")]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(iter_thread_batch(executor, transport, requests,
+                                             concurrency=2))
+        self.assertEqual(2, transport.peak)
+        self.assertEqual([1, 2, 0], [result.index for result in results])
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertEqual("GET /fast", results[1].result())
+        self.assertEqual("GET /slow", results[2].result())
@@ -0,0 +1,161 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from peasant.client.cache import (freshness_lifetime, parse_http_date,
+                                  ResponseCache)
+from tests.protocol_test import Clock
+import tempfile
+from unittest import TestCase
+
+URL = "http://bastion/resource"
+
+
+class FreshnessTestCase(TestCase):
+
+    def test_parse_http_date(self):
+        self.assertEqual(1704067230, parse_http_date(
+            "Mon, 01 Jan 2024 00:00:30 GMT"))
+        self.assertIsNone(parse_http_date("soon"))
+        self.assertIsNone(parse_http_date(None))
+
+    def test_freshness_lifetime(self):
+        self.assertEqual(60, freshness_lifetime(
+            {'Cache-Control': "max-age=60"}))
+        self.assertEqual(50, freshness_lifetime(
+            {'cache-control': "public, max-age=60", 'Age': "10"}))
+        self.assertEqual(0, freshness_lifetime(
+            {'Cache-Control': "no-cache, max-age=60"}))
+        self.assertEqual(30, freshness_lifetime({
+            'Date': "Mon, 01 Jan 2024 00:00:00 GMT",
+            'Expires': "Mon, 01 Jan 2024 00:00:30 GMT"}))
+        self.assertEqual(0, freshness_lifetime({'Expires': "0"}))
+        self.assertIsNone(freshness_lifetime({'ETag': '"v1"'}))
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.clock = Clock()
+        self.cache = ResponseCache(clock=self.clock)
+
+    def store(self, cache=None, url=URL, request_headers=None, code=200,
+              body=b"da body", **headers):
+        cache = self.cache if cache is None else cache
+        lookup = cache.lookup("GET", url, request_headers)
+        return lookup.complete(code, "OK", headers, body)
+
+    def test_fresh(self):
+        entry = self.store(**{'Cache-Control': "max-age=10",
+                              'Replay-Nonce': "abc"})
+        self.assertNotIn("Replay-Nonce", entry.headers)
+        lookup = self.cache.lookup("GET", URL)
+        self.assertTrue(lookup.fresh)
+        self.assertEqual(b"da body", lookup.entry.body)
+        self.assertEqual(1, self.cache.hits)
+        self.assertFalse(self.cache.lookup(
+            "GET", URL, {'Cache-Control': "no-cache"}).fresh)
+        self.assertIsNone(self.cache.lookup(
+            "GET", URL, {'Cache-Control': "no-store"}))
+        self.assertIsNone(self.cache.lookup("HEAD", URL).entry)
+        self.clock.now = 10
+        self.assertFalse(self.cache.lookup("GET", URL).fresh)
+
+    def test_not_stored(self):
+        self.assertIsNone(self.store(**{'Cache-Control': "no-store"}))
+        self.assertIsNone(self.store(code=404,
+                                     **{'Cache-Control': "max-age=10"}))
+        self.assertIsNone(self.store(**{'Cache-Control': "max-age=10",
+                                        'Vary': "*"}))
+        self.assertIsNone(self.store())
+        self.assertEqual(0, len(self.cache))
+        self.assertIsNone(self.cache.lookup("OPTIONS", URL))
+
+    def test_revalidate(self):
+        self.store(ETag='"v1"', **{'X-Attempt': "1"})
+        lookup = self.cache.lookup("GET", URL)
+        self.assertFalse(lookup.fresh)
+        self.assertEqual({'If-None-Match': '"v1"'},
+                         lookup.conditional_headers())
+        entry = lookup.complete(304, "Not Modified", {
+            'Cache-Control': "max-age=5", 'X-Attempt': "2"}, b"")
+        self.assertEqual(b"da body", entry.body)
+        self.assertEqual(200, entry.code)
+        self.assertEqual("2", entry.headers['X-Attempt'])
+        self.assertTrue(self.cache.lookup("GET", URL).fresh)
+        self.assertIsNone(self.cache.lookup(
+            "GET", URL, {'If-None-Match': '"v1"'}))
+
+    def test_vary(self):
+        self.store(request_headers={'Accept': "application/json"},
+                   body=b"json", Vary="Accept",
+                   **{'Cache-Control': "max-age=10"})
+        self.store(request_headers={'Accept': "text/html"}, body=b"html",
+                   Vary="Accept", **{'Cache-Control': "max-age=10"})
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(b"json", self.cache.lookup(
+            "GET", URL, {'accept': "application/json"}).entry.body)
+        self.assertEqual(b"html", self.cache.lookup(
+            "GET", URL, {'Accept': "text/html"}).entry.body)
+        self.assertIsNone(self.cache.lookup("GET", URL).entry)
+
+    def test_lru(self):
+        cache = ResponseCache(clock=self.clock, max_bytes=2000,
+                              max_entry_bytes=1000)
+        for index in range(3):
+            self.store(cache, f"{URL}/{index}", body=b"x" * 600,
+                       **{'Cache-Control': "max-age=10"})
+        self.assertEqual(2, len(cache))
+        self.assertLessEqual(cache.size, 2000)
+        self.assertIsNone(cache.lookup("GET", f"{URL}/0").entry)
+        self.store(cache, f"{URL}/big", body=b"x" * 1000,
+                   **{'Cache-Control': "max-age=10"})
+        self.assertIsNone(cache.lookup("GET", f"{URL}/big").entry)
+
+    def test_invalidate(self):
+        self.store(**{'Cache-Control': "max-age=10"})
+        lookup = self.cache.lookup("POST", URL)
+        self.assertTrue(lookup.invalidates)
+        self.assertIsNone(lookup.entry)
+        self.assertFalse(lookup.fresh)
+        # entries are only invalidated once the request is answered
+        self.assertIsNotNone(self.cache.lookup("GET", URL).entry)
+        # an error response doesn't invalidate
+        self.assertIsNone(lookup.complete(500, "Internal Server Error", {},
+                                          b""))
+        self.assertIsNotNone(self.cache.lookup("GET", URL).entry)
+        self.assertIsNone(lookup.complete(201, "Created", {}, b""))
+        self.assertIsNone(self.cache.lookup("GET", URL).entry)
+        self.assertEqual(0, self.cache.size)
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ResponseCache(clock=self.clock, disk_path=path)
+            self.store(cache, **{'Cache-Control': "max-age=10"})
+            cache = ResponseCache(clock=self.clock, disk_path=path)
+            lookup = cache.lookup("GET", URL)
+            self.assertTrue(lookup.fresh)
+            self.assertEqual(b"da body", lookup.entry.body)
+            self.assertEqual(1, len(cache))
+            cache.lookup("DELETE", URL).complete(204, "No Content", {},
+                                                 b"")
+            cache = ResponseCache(clock=self.clock, disk_path=path)
+            self.assertIsNone(cache.lookup("GET", URL).entry)
+            cache = ResponseCache(clock=self.clock, disk_path=path,
+                                  disk_max_bytes=1500)
+            for index in range(3):
+                self.store(cache, f"{URL}/{index}", body=b"x" * 600,
+                           **{'Cache-Control': "max-age=10"})
+            self.assertLessEqual(cache.disk.size, 1500)
+            cache.clear()
+            self.assertEqual(0, cache.disk.size)
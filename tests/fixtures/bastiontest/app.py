@@ -7,10 +7,19 @@ class BastiontestComponent(tornadoweb.TornadoComponent):
     def get_handlers(self):
         return [
             (r"/", handlers.GetHandler),
+            (r"/bad-nonce", handlers.BadNonceHandler),
+            (r"/cached", handlers.CachedHandler),
+            (r"/chunked", handlers.ChunkedHandler),
             (r"/delete", handlers.DeleteHandler),
+            (r"/directory", handlers.DirectoryHandler),
+            (r"/download", handlers.DownloadHandler),
+            (r"/flaky", handlers.FlakyHandler),
             (r"/head", handlers.HeadHandler),
+            (r"/nonce", handlers.NonceHandler),
             (r"/options", handlers.OptionsHandler),
             (r"/patch", handlers.PatchHandler),
+            (r"/payload", handlers.PayloadHandler),
             (r"/post", handlers.PostHandler),
             (r"/put", handlers.PutHandler),
+            (r"/slow", handlers.SlowHandler),
         ]
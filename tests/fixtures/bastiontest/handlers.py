@@ -1,5 +1,8 @@
+import asyncio
 from firenado import tornadoweb
+import json
 import logging
+import secrets
 from tornado.web import HTTPError
 
 logger = logging.getLogger(__name__)
@@ -24,12 +27,107 @@ class DeleteHandler(tornadoweb.TornadoHandler):
         self.write("Delete method output")
 
 
+class BadNonceHandler(tornadoweb.TornadoHandler):
+    """ Rejects requests without the nonce header set to good, as an ACME
+    server rejects a bad nonce, sending the good one back.
+    """
+
+    def post(self):
+        self.add_header("Replay-Nonce", "good")
+        if self.request.headers.get("nonce") != "good":
+            self.set_status(400)
+            self.set_header("Content-Type", "application/problem+json")
+            self.write(json.dumps({
+                'type': "urn:ietf:params:acme:error:badNonce",
+                'detail': "Bad nonce",
+            }))
+            return
+        self.write("Bad nonce method output")
+
+
+class CachedHandler(tornadoweb.TornadoHandler):
+    """ Answers with the max-age informed and an ETag, counting the requests
+    with the same key in the X-Attempt header.
+    """
+
+    attempts = {}
+
+    def get(self):
+        key = self.get_argument("key")
+        attempts = CachedHandler.attempts.get(key, 0) + 1
+        CachedHandler.attempts[key] = attempts
+        self.set_header("Cache-Control",
+                        f"max-age={self.get_argument('max_age', '60')}")
+        self.set_header("Replay-Nonce", secrets.token_urlsafe())
+        self.set_header("X-Attempt", str(attempts))
+        self.write("Cached method output")
+
+
+class ChunkedHandler(tornadoweb.TornadoHandler):
+
+    async def get(self):
+        for chunk in ("Chunked ", "method ", "output"):
+            self.write(chunk)
+            await self.flush()
+
+
+class DirectoryHandler(tornadoweb.TornadoHandler):
+
+    def get(self):
+        base_url = f"{self.request.protocol}://{self.request.host}"
+        self.write({
+            'newNonce': f"{base_url}/nonce",
+        })
+
+
+class DownloadHandler(tornadoweb.TornadoHandler):
+    """ Writes the number of bytes informed by the size argument, flushing
+    them in 64KB chunks.
+    """
+
+    async def get(self):
+        remaining = int(self.get_argument("size", "0"))
+        chunk = b"x" * 65536
+        while remaining > 0:
+            self.write(chunk[:remaining])
+            remaining -= len(chunk)
+            await self.flush()
+
+
+class FlakyHandler(tornadoweb.TornadoHandler):
+    """ Answers 503 for the first failures requests with the same key.
+    """
+
+    attempts = {}
+
+    def get(self):
+        key = self.get_argument("key")
+        failures = int(self.get_argument("failures", "1"))
+        attempts = FlakyHandler.attempts.get(key, 0) + 1
+        FlakyHandler.attempts[key] = attempts
+        if attempts <= failures:
+            self.set_status(503)
+            self.set_header("Retry-After", "0")
+            return
+        self.write(f"Flaky method output after {attempts} attempts")
+
+
 class GetHandler(tornadoweb.TornadoHandler):
 
     def get(self):
         self.write("Get method output")
 
 
+class NonceHandler(tornadoweb.TornadoHandler):
+
+    def head(self):
+        self.add_header("Replay-Nonce", secrets.token_urlsafe(16))
+
+    def get(self):
+        self.add_header("Replay-Nonce", secrets.token_urlsafe(16))
+        self.write("Nonce method output")
+
+
 class OptionsHandler(tornadoweb.TornadoHandler):
 
     def options(self):
@@ -46,6 +144,24 @@ class PatchHandler(tornadoweb.TornadoHandler):
         self.write("Patch method output")
 
 
+class PayloadHandler(tornadoweb.TornadoHandler):
+    """ Answers the size of the body received, used by benchmarks to send
+    large payloads without echoing them back.
+    """
+
+    def _write_size(self):
+        self.write(str(len(self.request.body)))
+
+    def patch(self):
+        self._write_size()
+
+    def post(self):
+        self._write_size()
+
+    def put(self):
+        self._write_size()
+
+
 class PostHandler(tornadoweb.TornadoHandler):
 
     def post(self):
@@ -54,6 +170,22 @@ class PostHandler(tornadoweb.TornadoHandler):
         self.write("Post method output")
 
 
+class SlowHandler(tornadoweb.TornadoHandler):
+    """ Answers the first request with the same key after delay seconds,
+    and the next ones right away.
+    """
+
+    attempts = {}
+
+    async def get(self):
+        key = self.get_argument("key")
+        attempts = SlowHandler.attempts.get(key, 0) + 1
+        SlowHandler.attempts[key] = attempts
+        if attempts == 1:
+            await asyncio.sleep(float(self.get_argument("delay", "5")))
+        self.write(f"Slow method output from attempt {attempts}")
+
+
 class PutHandler(tornadoweb.TornadoHandler):
 
     def put(self):
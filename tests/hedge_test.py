@@ -0,0 +1,130 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from peasant.client.hedge import (hedge, HedgeBudget, HedgePolicy,
+                                  LatencyTracker)
+from unittest import TestCase
+
+
+class Sender:
+    """ Sends fake requests answering after the delays informed, in order.
+    """
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.sent = 0
+        self.cancelled = 0
+
+    async def send(self):
+        delay = self.delays[self.sent]
+        self.sent += 1
+        attempt = self.sent
+        try:
+            await asyncio.sleep(abs(delay))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if delay < 0:
+            raise ConnectionError(f"attempt {attempt} failed")
+        return attempt
+
+
+class HedgePolicyTestCase(TestCase):
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker(window=10)
+        self.assertIsNone(tracker.percentile(0.5))
+        for latency in range(20):
+            tracker.record(latency)
+        self.assertEqual(10, len(tracker))
+        self.assertEqual(10, tracker.percentile(0))
+        self.assertEqual(14, tracker.percentile(0.5))
+        self.assertEqual(19, tracker.percentile(0.95))
+        self.assertEqual(19, tracker.percentile(1))
+
+    def test_budget(self):
+        budget = HedgeBudget(ratio=0.5, max_tokens=2)
+        self.assertFalse(budget.try_spend())
+        for _ in range(10):
+            budget.on_request()
+        self.assertEqual(2, budget.tokens)
+        self.assertTrue(budget.try_spend())
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+
+    def test_delay(self):
+        policy = HedgePolicy(min_samples=3, min_delay=0.5, max_delay=2)
+        self.assertIsNone(policy.delay())
+        for latency in (0.1, 0.2, 0.3):
+            policy.latencies.record(latency)
+        self.assertEqual(0.5, policy.delay())
+        policy.latencies.record(5)
+        self.assertEqual(2, policy.delay())
+
+
+class HedgeTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.policy = HedgePolicy(min_samples=1, max_delay=0.05,
+                                  budget=HedgeBudget(ratio=1))
+        self.policy.latencies.record(0.05)
+
+    def test_hedge_wins(self):
+        sender = Sender(5, 0.01)
+        self.assertEqual(2, asyncio.run(hedge(self.policy, sender.send)))
+        self.assertEqual(2, sender.sent)
+        self.assertEqual(1, sender.cancelled)
+
+    def test_no_hedge(self):
+        sender = Sender(0.01, 0.01)
+        self.assertEqual(1, asyncio.run(hedge(self.policy, sender.send)))
+        self.assertEqual(1, sender.sent)
+        self.policy.latencies = LatencyTracker()
+        self.policy.min_samples = 0
+        sender = Sender(0.1)
+        self.assertEqual(1, asyncio.run(hedge(self.policy, sender.send)))
+
+    def test_latency_recorded(self):
+        self.policy.latencies = LatencyTracker()
+        self.policy.min_samples = 0
+        # the hedge wins, the cancelled first request is still recorded
+        sender = Sender(0.3, 0.01)
+        self.policy.latencies.record(0.05)
+        self.assertEqual(2, asyncio.run(hedge(self.policy, sender.send)))
+        latencies = sorted(self.policy.latencies._latencies)
+        self.assertEqual(2, len(latencies))
+        self.assertGreaterEqual(latencies[1], 0.05)
+        # the first request wins
+        sender = Sender(0.01)
+        self.assertEqual(1, asyncio.run(hedge(self.policy, sender.send)))
+        self.assertEqual(3, len(self.policy.latencies))
+
+    def test_budget_exhausted(self):
+        self.policy.budget = HedgeBudget(ratio=0.5)
+        sender = Sender(0.2, 0.2, 0.01)
+        self.assertEqual(1, asyncio.run(hedge(self.policy, sender.send)))
+        self.assertEqual(3, asyncio.run(hedge(self.policy, sender.send)))
+        self.assertEqual(0, self.policy.budget.tokens)
+
+    def test_errors(self):
+        sender = Sender(-0.1, 0.2)
+        self.assertEqual(2, asyncio.run(hedge(self.policy, sender.send)))
+        sender = Sender(-0.1, -0.2)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(hedge(self.policy, sender.send))
+        sender = Sender(-0.01, 0.1)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(hedge(self.policy, sender.send))
+        self.assertEqual(1, sender.sent)
@@ -0,0 +1,133 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import gc
+import weakref
+from cryptography.hazmat.primitives.asymmetric import rsa
+from peasant.security import keyring
+from peasant.security.jwk import (int_to_bytes, jwk_info, KeyCache,
+                                  public_jwk, thumbprint, to_jwk)
+from unittest import TestCase
+
+# RFC 7638 section 3.1 example key
+RFC_N = ("0vx7agoebGcQSuuPiLJXZptN9nndrQmbXEps2aiAFbWhM78LhWx4cbbfAAtVT86zwu1RK7"
+         "aPFFxuhDR1L6tSoc_BJECPebWKRXjBZCiFV4n3oknjhMstn64tZ_2W-5JsGY4Hc5n9yB"
+         "XArwl93lqt7_RN5w6Cf0h4QyQ5v-65YGjQR0_FDW2QvzqY368QQMicAtaSqzs8KJZgnY"
+         "b9c7d0zgdAZHzu6qMQvRL5hajrn1n91CbOpbISD08qNLyrdkt-bFTWhAI4vMQFh6WeZu"
+         "0fM4lFd2NcRwr3XPksINHaQ-G_xBniIqbw0Ls1jF44-csFCur-kEgU8awapJzKnqDKgw")
+RFC_THUMBPRINT = "NzbLsXh8uDCcd-6MNwXF4W_7noWXFZAfHkxZsRGC9Xs"
+
+
+class KeyWrapper:
+
+    def __init__(self, key):
+        self.key = key
+
+    def public_key(self):
+        return self.key.public_key()
+
+
+def b64_to_int(data):
+    return int.from_bytes(base64.urlsafe_b64decode(
+        data + "=" * (-len(data) % 4)), byteorder="big")
+
+
+class Weakrefable:
+    pass
+
+
+class JwkTestCase(TestCase):
+
+    def test_int_to_bytes(self):
+        self.assertEqual(b"\x01\x00\x01", int_to_bytes(65537))
+        self.assertEqual(b"\x00", int_to_bytes(0))
+        self.assertEqual(b"\x00\x00\x01", int_to_bytes(1, 3))
+
+    def test_rsa(self):
+        key = rsa.RSAPublicNumbers(
+            b64_to_int("AQAB"), b64_to_int(RFC_N)).public_key()
+        self.assertEqual(RFC_THUMBPRINT, thumbprint(key))
+        self.assertEqual({'alg': "RS256", 'jwk': {
+            'kty': "RSA", 'e': "AQAB", 'n': RFC_N}}, to_jwk(key))
+
+    def test_ec(self):
+        for curve, crv, alg in (("P-256", "P-256", "ES256"),
+                                ("secp384r1", "P-384", "ES384"),
+                                ("P-521", "P-521", "ES512")):
+            key = keyring.generate_key(type="ec", curve=curve)
+            header = to_jwk(key)
+            self.assertEqual(alg, header['alg'])
+            self.assertEqual(crv, header['jwk']['crv'])
+            numbers = key.public_key().public_numbers()
+            self.assertEqual(numbers.x, b64_to_int(header['jwk']['x']))
+            self.assertEqual(numbers.y, b64_to_int(header['jwk']['y']))
+            size = (key.curve.key_size + 7) // 8
+            self.assertEqual(size, len(base64.urlsafe_b64decode(
+                header['jwk']['x'] + "==")))
+            self.assertEqual(thumbprint(key), thumbprint(key.public_key()))
+
+    def test_cached(self):
+        key = keyring.generate_key()
+        self.assertIs(jwk_info(key), jwk_info(key))
+        self.assertIs(jwk_info(key), jwk_info(key.public_key()))
+        # cached by public numbers, the key isn't kept alive
+        wrapper = KeyWrapper(key)
+        reference = weakref.ref(wrapper)
+        self.assertIs(jwk_info(key), jwk_info(wrapper))
+        del wrapper
+        gc.collect()
+        self.assertIsNone(reference())
+        header = to_jwk(key)
+        header['jwk']['n'] = "changed"
+        self.assertNotEqual("changed", to_jwk(key)['jwk']['n'])
+        public_jwk(key)['e'] = "changed"
+        self.assertEqual("AQAB", public_jwk(key)['e'])
+
+
+class KeyCacheTestCase(TestCase):
+
+    def test_not_weakrefable(self):
+        cache = KeyCache()
+        key = (1,)
+        self.assertEqual(1, cache.get(key, lambda _: 1))
+        self.assertEqual(2, cache.get(key, lambda _: 2))
+        self.assertEqual(0, len(cache))
+
+    def test_lru(self):
+        cache = KeyCache(maxsize=2, strong=True)
+        # tuples can't be weakly referenced
+        keys = [(index,) for index in range(3)]
+        calls = []
+
+        def factory(key):
+            calls.append(key)
+            return key[0]
+
+        for key in keys + keys[2:]:
+            cache.get(key, factory)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(keys, calls)
+        cache.get(keys[0], factory)
+        self.assertEqual(4, len(calls))
+
+    def test_weak(self):
+        cache = KeyCache()
+        key = Weakrefable()
+        self.assertEqual(1, cache.get(key, lambda _: 1))
+        self.assertEqual(1, cache.get(key, lambda _: 2))
+        self.assertEqual(1, len(cache))
+        del key
+        gc.collect()
+        self.assertEqual(0, len(cache))
@@ -0,0 +1,290 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    encode_dss_signature
+)
+from peasant.security import keyring
+from peasant.security.jwk import public_jwk
+from peasant.security.jws import (encode_payload, get_signer, JWSError,
+                                  jwk_thumbprint, PublicKeyCache,
+                                  SERIALIZATION_COMPACT, Signer, Verifier)
+from unittest import TestCase
+
+RSA_KEY = keyring.generate_key()
+EC_KEYS = {
+    'ES256': keyring.generate_key(type="ec", curve="P-256"),
+    'ES384': keyring.generate_key(type="ec", curve="P-384"),
+}
+
+
+def b64_decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def verify(key, alg, jws):
+    protected, payload, signature = jws.split(".")
+    signing_input = f"{protected}.{payload}".encode()
+    signature = b64_decode(signature)
+    public_key = key.public_key()
+    if alg == "RS256":
+        public_key.verify(signature, signing_input, padding.PKCS1v15(),
+                          hashes.SHA256())
+    else:
+        size = len(signature) // 2
+        hash_class = hashes.SHA256 if alg == "ES256" else hashes.SHA384
+        public_key.verify(encode_dss_signature(
+            int.from_bytes(signature[:size], "big"),
+            int.from_bytes(signature[size:], "big")),
+            signing_input, ec.ECDSA(hash_class()))
+    return json.loads(b64_decode(protected)), b64_decode(payload)
+
+
+class SignerTestCase(TestCase):
+
+    def test_encode_payload(self):
+        self.assertEqual(b"", encode_payload(None))
+        self.assertEqual(b"da body", encode_payload("da body"))
+        self.assertEqual(b'{"a":1}', encode_payload({'a': 1}))
+
+    def test_sign(self):
+        keys = dict(EC_KEYS, RS256=RSA_KEY)
+        for alg, key in keys.items():
+            signer = Signer(key)
+            header, payload = verify(key, alg, signer.sign(
+                {'termsOfServiceAgreed': True}, nonce="abc",
+                url="https://bastion/new-account"))
+            self.assertEqual({'alg': alg, 'jwk': public_jwk(key),
+                              'nonce': "abc",
+                              'url': "https://bastion/new-account"}, header)
+            self.assertEqual(b'{"termsOfServiceAgreed":true}', payload)
+
+    def test_protected_header_prefix(self):
+        # kids of different lengths cover every base64 alignment
+        for kid in ("https://bastion/acct/1", "https://bastion/acct/12",
+                    "https://bastion/acct/123"):
+            signer = Signer(EC_KEYS['ES256'], kid=kid)
+            self.assertEqual({'alg': "ES256", 'kid': kid}, json.loads(
+                b64_decode(signer.protected_header())))
+            self.assertEqual({'alg': "ES256", 'kid': kid, 'nonce': "n"},
+                             json.loads(b64_decode(
+                                 signer.protected_header(nonce="n"))))
+
+    def test_flattened(self):
+        signer = Signer(RSA_KEY, kid="https://bastion/acct/1")
+        jws = signer.sign_flattened(None, nonce="abc", url="https://b/o")
+        header, payload = verify(RSA_KEY, "RS256", ".".join(
+            (jws['protected'], jws['payload'], jws['signature'])))
+        self.assertEqual("", jws['payload'])
+        self.assertEqual("https://bastion/acct/1", header['kid'])
+        self.assertNotIn("jwk", header)
+
+    def test_sign_batch(self):
+        signer = Signer(EC_KEYS['ES384'])
+        items = [({'index': index}, {'nonce': str(index)})
+                 for index in range(5)] + [b"raw"]
+        results = signer.sign_batch(items)
+        self.assertEqual(6, len(results))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            compact = signer.sign_batch(
+                items, serialization=SERIALIZATION_COMPACT,
+                executor=executor)
+        for index, jws in enumerate(compact[:5]):
+            header, payload = verify(EC_KEYS['ES384'], "ES384", jws)
+            self.assertEqual(str(index), header['nonce'])
+            self.assertEqual({'index': index}, json.loads(payload))
+        self.assertEqual(b"raw", verify(EC_KEYS['ES384'], "ES384",
+                                        compact[5])[1])
+        with self.assertRaises(ValueError):
+            signer.sign_batch(items, serialization="json")
+
+    def test_get_signer(self):
+        signer = get_signer(RSA_KEY)
+        # rust backed keys can't be weakly referenced, so they aren't kept
+        self.assertIsNot(signer, get_signer(RSA_KEY))
+        self.assertEqual(signer.protected_header(),
+                         get_signer(RSA_KEY).protected_header())
+        self.assertIs(signer.thumbprint, get_signer(RSA_KEY).thumbprint)
+        self.assertIsNot(signer, get_signer(RSA_KEY, kid="acct"))
+        self.assertEqual("acct", get_signer(RSA_KEY, kid="acct").kid)
+
+
+class VerifierTestCase(TestCase):
+
+    def setUp(self):
+        self.verifier = Verifier()
+
+    def test_verify(self):
+        for key in [RSA_KEY] + list(EC_KEYS.values()):
+            signer = Signer(key)
+            verified = self.verifier.verify(signer.sign(
+                {'status': "valid"}, nonce="abc", url="https://x/new"))
+            self.assertEqual({'status': "valid"}, verified.json())
+            self.assertEqual("abc", verified.header['nonce'])
+            self.assertEqual(f"jwk:{signer.thumbprint}", verified.key_id)
+            verified = self.verifier.verify(signer.sign_flattened(None))
+            self.assertEqual(b"", verified.payload)
+            self.assertIsNone(verified.json())
+            verified = self.verifier.verify(
+                json.dumps(signer.sign_flattened("x")).encode())
+            self.assertEqual(b"x", verified.payload)
+
+    def test_key_cache(self):
+        signer = Signer(EC_KEYS['ES256'])
+        self.assertEqual(signer.thumbprint,
+                         jwk_thumbprint(public_jwk(EC_KEYS['ES256'])))
+        for _ in range(3):
+            self.verifier.verify(signer.sign({}))
+        self.assertEqual(1, len(self.verifier.key_cache))
+        self.assertEqual(1, self.verifier.key_cache.misses)
+        self.assertEqual(2, self.verifier.key_cache.hits)
+
+    def test_key_cache_bounded(self):
+        cache = PublicKeyCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+
+    def test_kid(self):
+        resolved = []
+
+        def resolver(kid):
+            resolved.append(kid)
+            if kid == "account/1":
+                return keyring.key_to_pem(RSA_KEY.public_key())
+
+        verifier = Verifier(key_resolver=resolver)
+        signer = Signer(RSA_KEY, kid="account/1")
+        verifier.verify(signer.sign({}))
+        verifier.verify(signer.sign({}))
+        self.assertEqual(["account/1"], resolved)
+        with self.assertRaises(JWSError):
+            verifier.verify(Signer(RSA_KEY, kid="account/2").sign({}))
+        verifier.add_key("account/3", EC_KEYS['ES256'])
+        verified = verifier.verify(
+            Signer(EC_KEYS['ES256'], kid="account/3").sign({}))
+        self.assertEqual("kid:account/3", verified.key_id)
+        # a known kid with a key of another algorithm
+        with self.assertRaises(JWSError):
+            verifier.verify(Signer(EC_KEYS['ES384'], kid="account/3").sign(
+                {}))
+
+    def test_invalid_signature(self):
+        for key in [RSA_KEY] + list(EC_KEYS.values()):
+            jws = Signer(key).sign({'a': 1})
+            protected, _, signature = jws.split(".")
+            payload = base64.urlsafe_b64encode(b'{"a":2}').decode().rstrip(
+                "=")
+            with self.assertRaises(JWSError):
+                self.verifier.verify(f"{protected}.{payload}.{signature}")
+
+    def test_fast_reject(self):
+        signer = Signer(EC_KEYS['ES256'])
+        protected, payload, signature = signer.sign({}).split(".")
+        none_header = base64.urlsafe_b64encode(
+            b'{"alg":"none","kid":"x"}').decode().rstrip("=")
+        both_header = base64.urlsafe_b64encode(
+            b'{"alg":"ES256","kid":"x","jwk":{}}').decode().rstrip("=")
+        invalid = [
+            "abc",
+            f"{protected}.{payload}",
+            f"{protected}.{payload}.{signature}.x",
+            f"{protected}.{payload}.{signature}!",
+            f"{protected}.{payload}.{signature[:-4]}",
+            f"{none_header}.{payload}.{signature}",
+            f"{both_header}.{payload}.{signature}",
+            f"{payload}.{payload}.{signature}",
+            "x" * (self.verifier.max_size + 1),
+            {'protected': protected, 'payload': payload},
+            b"\xff",
+            "{",
+            42,
+        ]
+        cache = self.verifier.key_cache
+        for jws in invalid:
+            with self.assertRaises(JWSError):
+                self.verifier.verify(jws)
+        # nothing got past the structural checks
+        self.assertEqual(0, cache.hits + cache.misses)
+
+    def test_malformed_header(self):
+        signer = Signer(EC_KEYS['ES256'])
+        _, payload, signature = signer.sign({}).split(".")
+        jwk = public_jwk(EC_KEYS['ES256'])
+        headers = [
+            {'alg': ["ES256"], 'jwk': jwk},
+            {'alg': {}, 'jwk': jwk},
+            {'alg': 256, 'jwk': jwk},
+            {'alg': "ES256", 'kid': ["account/1"]},
+            {'alg': "ES256", 'kid': {}},
+            {'alg': "ES256", 'jwk': "jwk"},
+            {'alg': "ES256", 'jwk': [jwk]},
+            {'alg': "ES256", 'jwk': jwk, 'crit': ["exp"], 'exp': 1},
+            {'alg': "ES256", 'jwk': jwk, 'crit': []},
+            {'alg': "ES256", 'jwk': jwk, 'crit': "exp"},
+            {'alg': "ES256", 'jwk': jwk, 'crit': [{}]},
+        ]
+        for header in headers:
+            protected = base64.urlsafe_b64encode(json.dumps(
+                header).encode()).decode().rstrip("=")
+            with self.assertRaises(JWSError):
+                self.verifier.verify(f"{protected}.{payload}.{signature}")
+
+    def test_critical(self):
+        signer = Signer(EC_KEYS['ES256'], header={'crit': ["exp"]})
+        verifier = Verifier(critical=["exp"])
+        self.assertEqual(1, verifier.verify(signer.sign({}, exp=1)).header[
+            'exp'])
+        with self.assertRaises(JWSError):
+            verifier.verify(signer.sign({}))
+        with self.assertRaises(JWSError):
+            self.verifier.verify(signer.sign({}, exp=1))
+
+    def test_algorithms(self):
+        verifier = Verifier(algorithms=["ES256"])
+        verifier.verify(Signer(EC_KEYS['ES256']).sign({}))
+        with self.assertRaises(JWSError):
+            verifier.verify(Signer(RSA_KEY).sign({}))
+        with self.assertRaises(ValueError):
+            Verifier(algorithms=["ES256", "HS256"])
+
+    def test_verify_async(self):
+        signer = Signer(RSA_KEY)
+        threads = []
+        verifier = Verifier(executor=ThreadPoolExecutor(1))
+        check_signature = verifier.check_signature
+
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            return check_signature(*args)
+
+        verifier.check_signature = record_thread
+        verified = asyncio.run(verifier.verify_async(signer.sign({'a': 1})))
+        self.assertEqual({'a': 1}, verified.json())
+        self.assertNotEqual([threading.current_thread()], threads)
+        with self.assertRaises(JWSError):
+            asyncio.run(verifier.verify_async("abc"))
+        self.assertEqual(1, len(threads))
+        verifier.executor.shutdown()
@@ -0,0 +1,142 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, wait
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from peasant.security import keyring
+from peasant.security.keypool import key_spec, KeyPool, spec_kwargs
+import threading
+from unittest import TestCase
+
+
+class KeyPoolTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.pool = KeyPool(low_watermark=1, high_watermark=2, max_workers=2)
+
+    def tearDown(self) -> None:
+        self.pool.close()
+
+    def test_key_spec(self):
+        self.assertEqual(("rsa", 2048), key_spec())
+        self.assertEqual(("rsa", 4096), key_spec(type="RSA", size=4096))
+        self.assertEqual(("ec", "secp384r1"), key_spec(type="ec"))
+        self.assertEqual(("ec", "secp256r1"),
+                         key_spec(type="ec", curve=ec.SECP256R1))
+        with self.assertRaises(NotImplementedError):
+            key_spec(type="dsa")
+        with self.assertRaises(ValueError):
+            KeyPool(low_watermark=3, high_watermark=2)
+        for kwargs in ({'size': 4096}, {'type': "ec", 'curve': "P-256"}):
+            spec = key_spec(**kwargs)
+            self.assertEqual(spec, key_spec(**spec_kwargs(spec)))
+
+    def test_watermarks(self):
+        wait(self.pool.fill(type="ec", curve="P-256"))
+        self.assertEqual(2, self.pool.available(type="ec", curve="P-256"))
+        self.assertEqual([], self.pool.fill(type="ec", curve="P-256"))
+        key = self.pool.get(type="ec", curve="P-256")
+        self.assertIsInstance(key, ec.EllipticCurvePrivateKey)
+        self.assertEqual("secp256r1", key.curve.name)
+        # one key left, still at the low watermark
+        self.assertEqual(1, self.pool.available(type="ec", curve="P-256"))
+        self.pool.get(type="ec", curve="P-256")
+        with self.pool._lock:
+            futures = list(self.pool._futures)
+        wait(futures)
+        self.assertEqual(2, self.pool.available(type="ec", curve="P-256"))
+        self.assertEqual(0, self.pool.available(type="ec"))
+
+    def test_get_empty(self):
+        key = self.pool.get(size=2048)
+        self.assertIsInstance(key, rsa.RSAPrivateKey)
+        self.assertEqual(2048, key.key_size)
+        key = self.pool.get(type="ec", key_gen=lambda **kwargs:
+                            ec.generate_private_key(ec.SECP521R1()))
+        self.assertEqual("secp521r1", key.curve.name)
+        self.assertEqual(0, self.pool.available(type="ec", curve="P-521"))
+
+    def test_generate_key_async(self):
+        loop_thread = []
+
+        def key_gen(**kwargs):
+            loop_thread.append(threading.current_thread())
+            return ec.generate_private_key(ec.SECP256R1())
+
+        async def generate():
+            keys = await asyncio.gather(*[keyring.generate_key_async(
+                type="ec", key_pool=self.pool) for _ in range(3)])
+            keys.append(await keyring.generate_key_async(
+                type="ec", key_gen=key_gen, key_pool=self.pool))
+            return keys, threading.current_thread()
+
+        keys, thread = asyncio.run(generate())
+        self.assertEqual(4, len(keys))
+        self.assertEqual(4, len({keyring.key_to_pem(key) for key in keys}))
+        self.assertNotIn(thread, loop_thread)
+
+    def test_get_async_off_loop(self):
+        executor_threads = []
+        executor = KeyPool.executor.fget
+
+        class RecordingPool(KeyPool):
+            @property
+            def executor(self):
+                executor_threads.append(threading.current_thread())
+                return executor(self)
+
+        pool = RecordingPool(low_watermark=1, high_watermark=2, max_workers=2)
+
+        async def get():
+            key = await pool.get_async(type="ec", curve="P-256")
+            return key, threading.current_thread()
+
+        try:
+            key, thread = asyncio.run(get())
+        finally:
+            pool.close()
+        self.assertEqual("secp256r1", key.curve.name)
+        self.assertTrue(executor_threads)
+        self.assertNotIn(thread, executor_threads)
+
+
+class GenerateKeysTestCase(TestCase):
+
+    def test_generate_keys(self):
+        pems = list(keyring.generate_keys(5, type="ec", curve="P-256",
+                                          max_workers=2))
+        self.assertEqual(5, len(set(pems)))
+        key = keyring.pem_to_private_key(pems[0])
+        self.assertEqual("secp256r1", key.curve.name)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            keys = keyring.generate_keys(4, size=2048, executor=executor,
+                                         window=1)
+            self.assertEqual(2048, keyring.pem_to_private_key(
+                next(keys)).key_size)
+            keys.close()
+            self.assertEqual(1, len(list(keyring.generate_keys(
+                1, type="ec", executor=executor))))
+        self.assertEqual([], list(keyring.generate_keys(0)))
+
+
+class EcKeyTestCase(TestCase):
+
+    def test_generate_key_kwargs(self):
+        self.assertEqual("secp384r1",
+                         keyring.generate_key(type="ec").curve.name)
+        self.assertEqual("secp256r1", keyring.generate_key(
+            type="ec", curve="P-256").curve.name)
+        self.assertEqual("secp521r1", keyring.generate_key(
+            type="ec", curve=ec.SECP521R1()).curve.name)
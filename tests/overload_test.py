@@ -0,0 +1,229 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from peasant.client.overload import (AIMDLimiter, CircuitBreaker,
+                                     CircuitOpenError, clear_registry,
+                                     get_circuit_breaker, get_limiter,
+                                     is_overload, OverloadGuard, STATE_CLOSED,
+                                     STATE_HALF_OPEN, STATE_OPEN)
+from peasant.client.transport import Transport
+from tests.protocol_test import Clock
+import threading
+from unittest import TestCase
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(name="bastion", failure_threshold=2,
+                                      reset_timeout=10, clock=self.clock)
+
+    def test_is_overload(self):
+        self.assertTrue(is_overload(error=ConnectionError()))
+        self.assertTrue(is_overload(503))
+        self.assertTrue(is_overload(429))
+        self.assertFalse(is_overload(404))
+        self.assertFalse(is_overload(200))
+
+    def test_open_after_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(STATE_CLOSED, self.breaker.state)
+        self.breaker.record_failure()
+        self.assertEqual(STATE_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 4
+        self.assertEqual(6, self.breaker.retry_in())
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.check()
+        self.assertIs(self.breaker, context.exception.breaker)
+
+    def test_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 10
+        self.assertEqual(STATE_HALF_OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(STATE_OPEN, self.breaker.state)
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(STATE_CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_lost_probe(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.clock.now = 15
+        self.assertFalse(self.breaker.allow())
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow())
+
+
+class AIMDLimiterTestCase(TestCase):
+
+    def test_additive_increase(self):
+        limiter = AIMDLimiter(initial_limit=2, max_limit=3)
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        limiter.release(0.1)
+        limiter.release(0.1)
+        self.assertEqual(2, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+        for _ in range(5):
+            limiter.try_acquire()
+            limiter.try_acquire()
+            limiter.release(0.1)
+            limiter.release(0.1)
+        self.assertEqual(3, limiter.limit)
+        # an idle limiter doesn't grow
+        limiter = AIMDLimiter(initial_limit=4)
+        for _ in range(10):
+            limiter.try_acquire()
+            limiter.release(0.1)
+        self.assertEqual(4, limiter.limit)
+
+    def test_multiplicative_decrease(self):
+        limiter = AIMDLimiter(initial_limit=10, backoff_ratio=0.5,
+                              latency_threshold=1)
+        limiter.try_acquire()
+        limiter.release(0.1, overloaded=True)
+        self.assertEqual(5, limiter.limit)
+        limiter.try_acquire()
+        limiter.release(2)
+        self.assertEqual(2, limiter.limit)
+        for _ in range(3):
+            limiter.try_acquire()
+            limiter.release(overloaded=True)
+        self.assertEqual(1, limiter.limit)
+        limiter.try_acquire()
+        limiter.release(overloaded=True, adapt=False)
+        self.assertEqual(1, limiter.limit)
+
+    def test_acquire(self):
+        limiter = AIMDLimiter(initial_limit=1)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(0.01))
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(limiter.acquire(5)))
+        thread.start()
+        limiter.release(0.1)
+        thread.join()
+        self.assertEqual([True], acquired)
+        self.assertEqual(1, limiter.in_flight)
+
+    def test_acquire_async(self):
+        limiter = AIMDLimiter(initial_limit=1)
+
+        async def run():
+            self.assertTrue(await limiter.acquire_async())
+            self.assertFalse(await limiter.acquire_async(0.01))
+            waiter = asyncio.ensure_future(limiter.acquire_async(5))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            limiter.release(0.1)
+            return await waiter
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(1, limiter.in_flight)
+
+    def test_acquire_async_release_from_thread(self):
+        limiter = AIMDLimiter(initial_limit=1)
+        self.assertTrue(limiter.acquire())
+
+        async def run():
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            threading.Timer(0.05, limiter.release).start()
+            return await asyncio.wait_for(waiter, 5)
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(1, limiter.in_flight)
+
+    def test_acquire_async_wakeup_passed_on(self):
+        limiter = AIMDLimiter(initial_limit=1)
+        self.assertTrue(limiter.try_acquire())
+
+        async def run():
+            first = asyncio.ensure_future(limiter.acquire_async())
+            second = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            # the wakeup goes to the first waiter, cancelled before it runs
+            limiter.release()
+            first.cancel()
+            return await asyncio.wait_for(second, 5)
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(1, limiter.in_flight)
+
+
+class OverloadGuardTestCase(TestCase):
+
+    def tearDown(self) -> None:
+        clear_registry()
+
+    def test_guard(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        limiter = AIMDLimiter(initial_limit=1)
+        guard = OverloadGuard(circuit_breaker=breaker, limiter=limiter,
+                              limiter_timeout=0.01)
+        started_at = guard.enter()
+        self.assertEqual(1, limiter.in_flight)
+        with self.assertRaises(TimeoutError):
+            guard.enter()
+        guard.exit(started_at, 200)
+        self.assertEqual(0, limiter.in_flight)
+        self.assertEqual(STATE_CLOSED, breaker.state)
+        guard.exit(guard.enter(), 503)
+        self.assertEqual(STATE_OPEN, breaker.state)
+        with self.assertRaises(CircuitOpenError):
+            guard.enter()
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_registry(self):
+        breaker = get_circuit_breaker("http://bastion", failure_threshold=1)
+        self.assertIs(breaker, get_circuit_breaker("http://bastion"))
+        self.assertEqual("http://bastion", breaker.name)
+        self.assertIsNot(breaker, get_circuit_breaker("http://other"))
+        limiter = get_limiter("http://bastion")
+        self.assertIs(limiter, get_limiter("http://bastion"))
+        clear_registry()
+        self.assertIsNot(breaker, get_circuit_breaker("http://bastion"))
+
+    def test_transport_guard(self):
+        transport = Transport()
+        self.assertIsNone(transport.overload_guard)
+        self.assertIsNone(transport.enter_guard())
+        transport = Transport(circuit_breaker=True, concurrency_limiter=True)
+        transport._bastion_address = "http://bastion"
+        guard = transport.overload_guard
+        self.assertIs(get_circuit_breaker("http://bastion"),
+                      guard.circuit_breaker)
+        self.assertIs(get_limiter("http://bastion"), guard.limiter)
+        started_at = transport.enter_guard()
+        transport.exit_guard(started_at, error=ValueError())
+        self.assertEqual(0, guard.limiter.in_flight)
+        self.assertEqual(10, guard.limiter.limit)
+        transport.exit_guard(transport.enter_guard(),
+                             error=ConnectionError())
+        self.assertEqual(9, guard.limiter.limit)
@@ -0,0 +1,225 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from peasant.client.cache import DirectoryCache
+from peasant.client.nonce import NoncePool
+from peasant.client.protocol import AsyncPeasant, Peasant
+from peasant.client.transport import Transport
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+DIRECTORY = {'resource': "/resource"}
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class DirectoryTransport(Transport):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.etag = '"v1"'
+        self.cache_control = "max-age=10"
+        self.fetches = 0
+        self.revalidations = 0
+
+    def fetch_directory(self):
+        self.fetches += 1
+        if self.peasant.directory_headers().get(
+                "If-None-Match") == self.etag:
+            self.revalidations += 1
+            self.peasant.revalidate_directory({})
+            return
+        self.peasant.store_directory(dict(DIRECTORY), {
+            'ETag': self.etag, 'Cache-Control': self.cache_control})
+
+    def set_directory(self):
+        self.fetch_directory()
+
+
+class AsyncDirectoryTransport(DirectoryTransport):
+
+    async def set_directory(self):
+        await asyncio.sleep(0.01)
+        self.fetch_directory()
+
+
+class PeasantTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = DirectoryTransport()
+        self.peasant = Peasant(self.transport, directory_cache=DirectoryCache(
+            clock=self.clock))
+
+    def test_directory_legacy_cache(self):
+        transport = Transport()
+        transport.set_directory = lambda: setattr(
+            transport.peasant, "directory_cache", DIRECTORY)
+        peasant = Peasant(transport)
+        self.assertEqual(DIRECTORY, peasant.directory())
+        self.assertEqual(DIRECTORY, peasant.directory_cache)
+        peasant.directory_cache = None
+        self.assertIsNone(peasant.directory_cache)
+
+    def test_directory_revalidation(self):
+        self.assertEqual(DIRECTORY, self.peasant.directory())
+        self.assertEqual(DIRECTORY, self.peasant.directory())
+        self.assertEqual(1, self.transport.fetches)
+        self.clock.now = 11
+        self.assertEqual(DIRECTORY, self.peasant.directory())
+        self.assertEqual(2, self.transport.fetches)
+        self.assertEqual(1, self.transport.revalidations)
+        self.assertTrue(self.peasant.directory_cache_backend.is_fresh())
+        self.transport.etag = '"v2"'
+        self.clock.now = 22
+        self.peasant.directory()
+        self.assertEqual('"v2"', self.peasant.directory_cache_backend.etag)
+
+    def test_directory_stale_while_revalidate(self):
+        self.transport.cache_control = (
+            "max-age=10, stale-while-revalidate=5")
+        self.peasant.directory()
+        self.clock.now = 12
+        self.assertEqual(DIRECTORY, self.peasant.directory())
+        self.peasant._directory_lock.acquire()
+        self.peasant._directory_lock.release()
+        self.assertEqual(2, self.transport.fetches)
+
+
+class NonceTransport(Transport):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.issued = 0
+
+    def new_nonce(self):
+        self.issued += 1
+        nonce = f"nonce-{self.issued}"
+        # as a real transport would do with the new nonce response
+        self.process_response_headers({'Replay-Nonce': nonce})
+        return nonce
+
+
+class AsyncNonceTransport(NonceTransport):
+
+    async def new_nonce(self):
+        await asyncio.sleep(0)
+        return super().new_nonce()
+
+
+class NoncePeasantTestCase(TestCase):
+
+    def test_new_nonce_without_pool(self):
+        transport = NonceTransport()
+        peasant = Peasant(transport)
+        self.assertIsNone(peasant.nonce_pool)
+        self.assertEqual("nonce-1", peasant.new_nonce())
+        self.assertEqual("nonce-2", peasant.new_nonce())
+
+    def test_new_nonce_with_pool(self):
+        transport = NonceTransport()
+        peasant = Peasant(transport, nonce_pool_size=3,
+                          nonce_low_watermark=1)
+        nonce = peasant.new_nonce()
+        self.assertEqual("nonce-1", nonce)
+        refill_thread = peasant._nonce_refill_thread
+        if refill_thread is not None:
+            refill_thread.join()
+        self.assertEqual(["nonce-2", "nonce-3", "nonce-4"],
+                         [nonce for nonce, _ in peasant.nonce_pool._nonces])
+        transport.process_response_headers({'replay-nonce': "harvested"})
+        self.assertEqual(3, len(peasant.nonce_pool))
+        self.assertEqual("nonce-2", peasant.new_nonce())
+        transport.process_response_headers({'replay-nonce': "harvested"})
+        self.assertEqual("harvested", peasant.nonce_pool._nonces[-1][0])
+
+
+class NoncePoolTestCase(TestCase):
+
+    def test_pool(self):
+        clock = Clock()
+        pool = NoncePool(size=2, low_watermark=1, max_age=10, clock=clock)
+        self.assertTrue(pool.needs_refill())
+        self.assertIsNone(pool.pop())
+        self.assertFalse(pool.put(None))
+        self.assertTrue(pool.put("a"))
+        clock.now = 5
+        self.assertTrue(pool.put("b"))
+        self.assertFalse(pool.put("c"))
+        self.assertEqual(0, pool.missing())
+        clock.now = 12
+        self.assertEqual("b", pool.pop())
+        self.assertIsNone(pool.pop())
+
+
+class DirectoryCacheTestCase(TestCase):
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = DirectoryCache(ttl=5, clock=clock)
+        self.assertFalse(cache.is_usable())
+        self.assertEqual({}, cache.conditional_headers())
+        cache.store(DIRECTORY, {'last-modified': "yesterday"})
+        self.assertTrue(cache.is_fresh())
+        self.assertEqual({'If-Modified-Since': "yesterday"},
+                         cache.conditional_headers())
+        clock.now = 5
+        self.assertFalse(cache.is_fresh())
+        self.assertFalse(cache.is_usable())
+
+    def test_no_cache(self):
+        cache = DirectoryCache(ttl=5)
+        cache.store(DIRECTORY, {'Cache-Control': "no-cache"})
+        self.assertFalse(cache.is_fresh())
+        self.assertEqual(DIRECTORY, cache.value)
+
+
+class AsyncPeasantTestCase(IsolatedAsyncioTestCase):
+
+    async def test_directory_single_flight(self):
+        transport = AsyncDirectoryTransport()
+        peasant = AsyncPeasant(transport)
+        directories = await asyncio.gather(
+            *[peasant.directory() for _ in range(10)])
+        self.assertEqual([DIRECTORY] * 10, directories)
+        self.assertEqual(1, transport.fetches)
+
+    async def test_directory_stale_while_revalidate(self):
+        clock = Clock()
+        transport = AsyncDirectoryTransport()
+        transport.cache_control = "max-age=10, stale-while-revalidate=5"
+        peasant = AsyncPeasant(transport, directory_cache=DirectoryCache(
+            clock=clock))
+        await peasant.directory()
+        clock.now = 12
+        self.assertEqual(DIRECTORY, await peasant.directory())
+        self.assertEqual(1, transport.fetches)
+        await peasant._directory_future
+        self.assertEqual(2, transport.fetches)
+        self.assertEqual(1, transport.revalidations)
+
+    async def test_new_nonce_with_pool(self):
+        transport = AsyncNonceTransport()
+        peasant = AsyncPeasant(transport, nonce_pool_size=2)
+        self.assertEqual("nonce-1", await peasant.new_nonce())
+        await peasant._nonce_future
+        self.assertEqual(2, len(peasant.nonce_pool))
+        self.assertEqual("nonce-2", await peasant.new_nonce())
@@ -0,0 +1,114 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+from peasant.client.retry import (BAD_NONCE_TYPE, is_bad_nonce,
+                                  is_replayable, parse_retry_after,
+                                  RetryPolicy, RetryThrottle)
+from tests.protocol_test import Clock
+from unittest import TestCase
+
+BAD_NONCE_HEADERS = {'Content-Type': "application/problem+json"}
+BAD_NONCE_BODY = json.dumps({'type': BAD_NONCE_TYPE}).encode()
+
+
+class RetryFunctionsTestCase(TestCase):
+
+    def test_parse_retry_after(self):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(120, parse_retry_after("120"))
+        self.assertEqual(30, parse_retry_after(
+            "Mon, 01 Jan 2024 00:00:30 GMT", now))
+        self.assertEqual(0, parse_retry_after(
+            "Sun, 31 Dec 2023 23:00:00 GMT", now))
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+    def test_is_bad_nonce(self):
+        self.assertTrue(is_bad_nonce(400, BAD_NONCE_HEADERS, BAD_NONCE_BODY))
+        self.assertFalse(is_bad_nonce(403, BAD_NONCE_HEADERS,
+                                      BAD_NONCE_BODY))
+        self.assertFalse(is_bad_nonce(400, {}, BAD_NONCE_BODY))
+        self.assertFalse(is_bad_nonce(400, BAD_NONCE_HEADERS, b"bad"))
+
+    def test_is_replayable(self):
+        self.assertTrue(is_replayable({}))
+        self.assertTrue(is_replayable({'body': "da body"}))
+        self.assertTrue(is_replayable({'data': {'key': "value"}}))
+        self.assertFalse(is_replayable({'data': iter([b"da body"])}))
+
+
+class RetryPolicyTestCase(TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff_base=1, backoff_max=5,
+                             random=lambda: 1)
+        self.assertEqual([1, 2, 4, 5],
+                         [policy.backoff(attempt) for attempt in
+                          range(1, 5)])
+        policy = RetryPolicy(random=lambda: 0)
+        self.assertEqual(0, policy.backoff(3))
+
+    def test_idempotent_methods(self):
+        policy = RetryPolicy(retries=2, throttle=None, random=lambda: 1)
+        retry = policy.start("GET")
+        self.assertEqual(0.1, retry.on_response(503))
+        self.assertEqual(0.2, retry.on_error(ConnectionError()))
+        self.assertIsNone(retry.on_response(503))
+        self.assertIsNone(policy.start("GET").on_response(404))
+        self.assertIsNone(policy.start("POST").on_response(503))
+        self.assertIsNone(policy.start("POST").on_error(ConnectionError()))
+        self.assertIsNone(policy.start("GET", False).on_response(503))
+
+    def test_retry_after(self):
+        policy = RetryPolicy(throttle=None, retry_after_max=10)
+        retry = policy.start("GET")
+        self.assertEqual(5, retry.on_response(429, {'retry-after': "5"}))
+        self.assertIsNone(retry.on_response(429, {'Retry-After': "11"}))
+
+    def test_deadline(self):
+        clock = Clock()
+        policy = RetryPolicy(throttle=None, deadline=10, clock=clock,
+                             random=lambda: 1, backoff_base=4)
+        retry = policy.start("GET")
+        self.assertEqual(4, retry.on_response(503))
+        clock.now = 4
+        self.assertIsNone(retry.on_response(503))
+
+    def test_bad_nonce(self):
+        policy = RetryPolicy(throttle=None)
+        retry = policy.start("POST")
+        self.assertEqual(0, retry.on_response(400, BAD_NONCE_HEADERS,
+                                              BAD_NONCE_BODY))
+        self.assertIsNone(retry.on_response(400, BAD_NONCE_HEADERS,
+                                            BAD_NONCE_BODY))
+        retry = policy.start("POST", False)
+        self.assertIsNone(retry.on_response(400, BAD_NONCE_HEADERS,
+                                            BAD_NONCE_BODY))
+
+    def test_throttle(self):
+        throttle = RetryThrottle(max_tokens=4, token_ratio=0.5)
+        policy = RetryPolicy(retries=10, throttle=throttle)
+        retry = policy.start("GET")
+        self.assertIsNotNone(retry.on_response(503))
+        self.assertIsNone(retry.on_response(503))
+        self.assertEqual(2, throttle.tokens)
+        policy.start("GET").on_response(200)
+        self.assertEqual(2.5, throttle.tokens)
+        self.assertIsNone(policy.start("GET").on_response(503))
+        for _ in range(6):
+            policy.start("GET").on_response(200)
+        self.assertEqual(4, throttle.tokens)
+        self.assertIsNotNone(policy.start("GET").on_response(503))
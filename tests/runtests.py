@@ -15,13 +15,31 @@
 # limitations under the License.
 
 import unittest
-from tests import (transport_requests_test, transport_test,
+from tests import (batch_test, cache_test, hedge_test, jwk_test, jws_test,
+                   keypool_test, overload_test, protocol_test, retry_test,
+                   server_test, transport_asyncio_test,
+                   transport_balanced_test, transport_h2_test,
+                   transport_requests_test, transport_test,
                    transport_tornado_test)
 
 
 def suite():
     testLoader = unittest.TestLoader()
     alltests = unittest.TestSuite()
+    alltests.addTests(testLoader.loadTestsFromModule(batch_test))
+    alltests.addTests(testLoader.loadTestsFromModule(cache_test))
+    alltests.addTests(testLoader.loadTestsFromModule(hedge_test))
+    alltests.addTests(testLoader.loadTestsFromModule(jwk_test))
+    alltests.addTests(testLoader.loadTestsFromModule(jws_test))
+    alltests.addTests(testLoader.loadTestsFromModule(keypool_test))
+    alltests.addTests(testLoader.loadTestsFromModule(overload_test))
+    alltests.addTests(testLoader.loadTestsFromModule(protocol_test))
+    alltests.addTests(testLoader.loadTestsFromModule(retry_test))
+    alltests.addTests(testLoader.loadTestsFromModule(server_test))
+    alltests.addTests(testLoader.loadTestsFromModule(transport_asyncio_test))
+    alltests.addTests(testLoader.loadTestsFromModule(
+        transport_balanced_test))
+    alltests.addTests(testLoader.loadTestsFromModule(transport_h2_test))
     alltests.addTests(testLoader.loadTestsFromModule(transport_requests_test))
     alltests.addTests(testLoader.loadTestsFromModule(transport_test))
     alltests.addTests(testLoader.loadTestsFromModule(transport_tornado_test))
@@ -0,0 +1,208 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import inspect
+from peasant.server import InMemoryNonceService, nonced
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Request:
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class Handler:
+
+    def __init__(self, nonce_service, headers=None):
+        self.nonce_service = nonce_service
+        self.request = Request(headers)
+        self.status = 200
+        self.output = []
+
+    def set_status(self, status):
+        self.status = status
+
+    def write(self, chunk):
+        self.output.append(chunk)
+
+    @nonced
+    def post(self):
+        self.write("Post method output")
+        return "posted"
+
+
+class AsyncHandler(Handler):
+
+    @nonced
+    async def post(self):
+        await asyncio.sleep(0)
+        self.write("Post method output")
+        return "posted"
+
+
+class AsyncNonceService(InMemoryNonceService):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.cleared = []
+
+    async def consume(self, **kwargs):
+        await asyncio.sleep(0)
+        return super().consume(**kwargs)
+
+    async def clear(self, **kwargs):
+        await asyncio.sleep(0)
+        self.cleared.append(kwargs['nonce'])
+        super().clear(**kwargs)
+
+
+class AwaitableNonceService(AsyncNonceService):
+    """ Nonce service whose methods return awaitables without being
+    coroutine functions, like decorated methods.
+    """
+
+    def consume(self, **kwargs):
+        return AsyncNonceService.consume(self, **kwargs)
+
+    def clear(self, **kwargs):
+        return AsyncNonceService.clear(self, **kwargs)
+
+
+class AwaitableHandler(Handler):
+
+    @nonced
+    def post(self):
+        async def post():
+            await asyncio.sleep(0)
+            self.write("Post method output")
+            return "posted"
+        return post()
+
+
+class InMemoryNonceServiceTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.service = InMemoryNonceService(ttl=10, bucket_width=1,
+                                            clock=self.clock)
+
+    def test_consume_once(self):
+        nonce = self.service.issue()
+        self.assertEqual(1, len(self.service))
+        self.assertEqual(nonce, self.service.consume(nonce=nonce))
+        self.assertIsNone(self.service.consume(nonce=nonce))
+        self.service.clear(nonce=nonce)
+        self.assertIsNone(self.service.consume(nonce="unknown"))
+        self.assertIsNone(self.service.consume(nonce=None))
+        self.assertEqual(0, len(self.service))
+
+    def test_clear(self):
+        nonce = self.service.issue()
+        self.service.clear(nonce=nonce)
+        self.assertIsNone(self.service.consume(nonce=nonce))
+
+    def test_expiry(self):
+        nonce = self.service.issue()
+        self.clock.now = 10.5
+        self.assertEqual(nonce, self.service.consume(nonce=nonce))
+        nonce = self.service.issue()
+        self.clock.now = 22
+        self.assertIsNone(self.service.consume(nonce=nonce))
+        expired = [self.service.issue() for _ in range(10)]
+        self.clock.now = 40
+        self.service.purge()
+        self.assertEqual(0, len(self.service))
+        self.assertIsNone(self.service.consume(nonce=expired[0]))
+
+    def test_max_nonces(self):
+        service = InMemoryNonceService(max_nonces=4, stripes=1,
+                                       clock=self.clock)
+        nonces = []
+        for now in range(6):
+            self.clock.now = now
+            nonces.append(service.issue())
+        self.assertEqual(4, len(service))
+        self.assertIsNone(service.consume(nonce=nonces[0]))
+        self.assertIsNone(service.consume(nonce=nonces[1]))
+        self.assertEqual(nonces[5], service.consume(nonce=nonces[5]))
+
+    def test_nonced(self):
+        nonce = self.service.issue()
+        handler = Handler(self.service, {'Replay-Nonce': nonce})
+        self.assertEqual("posted", handler.post())
+        self.assertEqual(["Post method output"], handler.output)
+
+        handler = Handler(self.service)
+        self.assertIsNone(handler.post())
+        self.assertEqual(400, handler.status)
+
+
+class AsyncNoncedTestCase(IsolatedAsyncioTestCase):
+
+    async def test_coroutine_handler(self):
+        service = InMemoryNonceService()
+        nonce = service.issue()
+        handler = AsyncHandler(service, {'Replay-Nonce': nonce})
+        self.assertEqual("posted", await handler.post())
+        self.assertIsNone(await handler.post())
+        self.assertEqual(["Post method output"], handler.output)
+
+        handler = AsyncHandler(service)
+        self.assertIsNone(await handler.post())
+        self.assertEqual(400, handler.status)
+
+    async def test_async_nonce_service(self):
+        service = AsyncNonceService()
+        nonce = service.issue()
+        handler = Handler(service, {'Replay-Nonce': nonce})
+        self.assertEqual("posted", await handler.post())
+        self.assertEqual([], service.cleared)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual([nonce], service.cleared)
+
+        handler = AsyncHandler(service, {'Replay-Nonce': nonce})
+        self.assertIsNone(await handler.post())
+        self.assertEqual([], handler.output)
+
+    async def test_awaitable_nonce_service(self):
+        service = AwaitableNonceService()
+        nonce = service.issue()
+        handler = Handler(service, {'Replay-Nonce': nonce})
+        result = handler.post()
+        self.assertTrue(inspect.isawaitable(result))
+        self.assertEqual("posted", await result)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual([nonce], service.cleared)
+        self.assertIsNone(await Handler(service, {
+            'Replay-Nonce': nonce}).post())
+
+        service = InMemoryNonceService()
+        nonce = service.issue()
+        handler = AwaitableHandler(service, {'Replay-Nonce': nonce})
+        self.assertEqual("posted", await handler.post())
+        self.assertEqual(["Post method output"], handler.output)
+        self.assertIsNone(service.consume(nonce=nonce))
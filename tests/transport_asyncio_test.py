@@ -0,0 +1,346 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from firenado.testing import TornadoAsyncTestCase
+from firenado.launcher import ProcessLauncher
+from peasant.client.cache import ResponseCache
+from peasant.client.overload import (AIMDLimiter, CircuitBreaker,
+                                     CircuitOpenError)
+from peasant.client.protocol import AsyncPeasant
+from peasant.client.retry import RetryPolicy
+from peasant.client.transport_asyncio import (AsyncioTransport,
+                                              check_request_head, Connection,
+                                              host_header, HTTPClientError,
+                                              parse_head)
+from tests import chdir_fixture_app, PROJECT_ROOT, wait_for_port
+from tornado.testing import gen_test
+import tracemalloc
+import unittest
+
+
+class ParseHeadTestCase(unittest.TestCase):
+
+    def test_parse_head(self):
+        code, reason, headers = parse_head(
+            b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n"
+            b"replay-nonce: abc\r\n\r\n")
+        self.assertEqual(404, code)
+        self.assertEqual("Not Found", reason)
+        self.assertEqual("abc", headers.get("Replay-Nonce"))
+        code, reason, _ = parse_head(b"HTTP/1.1 200\r\n\r\n")
+        self.assertEqual(200, code)
+        self.assertEqual("", reason)
+
+    def test_host_header(self):
+        self.assertEqual("example.com", host_header("http", "example.com",
+                                                    80))
+        self.assertEqual("example.com", host_header("https", "example.com",
+                                                     443))
+        self.assertEqual("example.com:8443",
+                         host_header("https", "example.com", 8443))
+        self.assertEqual("[::1]:8080", host_header("http", "::1", 8080))
+        self.assertEqual("[::1]", host_header("https", "::1", 443))
+
+    def test_request_head_injection(self):
+        check_request_head("GET", "/path?query=1", {'X-Value': "a\tb"})
+        invalid = [
+            ("GET", "/path\r\nX-Injected: 1", {}),
+            ("GET", "/path HTTP/1.1\r\n\r\nGET /other", {}),
+            ("GET", "/?q=a\nb", {}),
+            ("GET\r\n", "/", {}),
+            ("GET", "/", {'X-Value': "a\r\nX-Injected: 1"}),
+            ("GET", "/", {'X-Value': "a\nb"}),
+            ("GET", "/", {'X-Name\r\nX-Injected': "1"}),
+            ("GET", "/", {'X Name': "1"}),
+        ]
+        for method, target, headers in invalid:
+            with self.assertRaises(ValueError):
+                check_request_head(method, target, headers)
+        connection = Connection(("http", "example.com", 80), None, None)
+        with self.assertRaises(ValueError):
+            asyncio.run(AsyncioTransport("http://example.com")._send_request(
+                connection, "GET", "example.com", 80, "/",
+                headers={'X-Value': "a\r\nb"}))
+
+    def test_caller_headers(self):
+        class Writer:
+            data = b""
+
+            def write(self, data):
+                self.data += data
+
+            async def drain(self):
+                pass
+
+        writer = Writer()
+        connection = Connection(("http", "example.com", 80), None, writer)
+        transport = AsyncioTransport("http://example.com")
+        asyncio.run(transport._send_request(
+            connection, "POST", "example.com", 80, "/", body=b"abc",
+            headers={'host': "other.com", 'content-length': "3"}))
+        head = writer.data.decode().lower()
+        self.assertEqual(1, head.count("host:"))
+        self.assertIn("host: other.com", head)
+        self.assertEqual(1, head.count("content-length:"))
+
+
+class AsyncioTransportTestCase(TornadoAsyncTestCase):
+
+    def get_launcher(self) -> ProcessLauncher:
+        application_dir = chdir_fixture_app("bastiontest")
+        return ProcessLauncher(
+            dir=application_dir, path=PROJECT_ROOT)
+
+    def setUp(self) -> None:
+        super().setUp()
+        wait_for_port(self.http_port())
+        self.transport = AsyncioTransport(
+                f"http://localhost:{self.http_port()}")
+
+    def tearDown(self) -> None:
+        self.transport.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_connection_reuse(self):
+        for _ in range(3):
+            await self.transport.get("/")
+        self.assertEqual(1, self.transport.pool.opened)
+        self.assertEqual(1, self.transport.pool.idle_connections())
+        transport = AsyncioTransport(f"http://localhost:{self.http_port()}",
+                                     max_connections=2)
+        with transport:
+            responses = await asyncio.gather(
+                *[transport.get("/") for _ in range(10)])
+            self.assertEqual(10, len(responses))
+            self.assertEqual(2, transport.pool.opened)
+        self.assertEqual(0, transport.pool.idle_connections())
+
+    def test_loops(self):
+        transport = AsyncioTransport(f"http://localhost:{self.http_port()}",
+                                     max_connections=1)
+
+        async def run():
+            return await asyncio.gather(
+                *[transport.get("/") for _ in range(3)])
+
+        with transport:
+            for _ in range(2):
+                self.assertEqual(3, len(asyncio.run(run())))
+            self.assertEqual(1, len(transport.pool._loops))
+            self.assertEqual(1, transport.pool.idle_connections())
+
+    @gen_test
+    async def test_close_in_flight(self):
+        pool = self.transport.pool
+        port = self.http_port()
+        connection = await pool.acquire("http", "localhost", port)
+        pool.close()
+        pool.release(connection)
+        self.assertTrue(connection.writer.is_closing())
+        self.assertEqual(0, pool.idle_connections())
+        limit = pool._limit(asyncio.get_running_loop(),
+                            ("http", "localhost", port))
+        # the semaphore of the new pool state wasn't over-released
+        self.assertEqual(pool.max_connections, limit._value)
+
+    @gen_test
+    async def test_closed_connection_retry(self):
+        await self.transport.get("/")
+        for idle_connections, _ in self.transport.pool._loops.values():
+            for idle in idle_connections.values():
+                for connection in idle:
+                    connection.writer.transport.abort()
+        response = await self.transport.get("/")
+        self.assertEqual(b"Get method output", response.body)
+
+    @gen_test
+    async def test_chunked(self):
+        response = await self.transport.get("/chunked")
+        self.assertEqual(b"Chunked method output", response.body)
+        response = await self.transport.get("/")
+        self.assertEqual(b"Get method output", response.body)
+        self.assertEqual(1, self.transport.pool.opened)
+
+    @gen_test
+    async def test_stream(self):
+        size = 16 * 1024 * 1024
+        received = 0
+        tracemalloc.start()
+        try:
+            async for chunk in self.transport.stream(
+                    "GET", "/download", query_string={'size': size}):
+                received += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(size, received)
+        self.assertLess(peak, 2 * 1024 * 1024)
+        self.assertEqual(1, self.transport.pool.idle_connections())
+
+        stream = self.transport.stream("GET", "/download",
+                                       query_string={'size': size})
+        await stream.__anext__()
+        await stream.aclose()
+        self.assertEqual(0, self.transport.pool.idle_connections())
+
+        async def payload():
+            for _ in range(10):
+                yield b"x" * 1000
+
+        response = await self.transport.post("/payload", body=payload())
+        self.assertEqual(b"10000", response.body)
+        chunks = [chunk async for chunk in self.transport.stream(
+            "PUT", "/payload", body=(b"x" * 1000 for _ in range(5)))]
+        self.assertEqual([b"5000"], chunks)
+        with self.assertRaises(HTTPClientError) as context:
+            async for _ in self.transport.stream("GET", "/not-found"):
+                pass
+        self.assertEqual(404, context.exception.code)
+
+    @gen_test
+    async def test_batch(self):
+        transport = AsyncioTransport(f"http://localhost:{self.http_port()}",
+                                     batch_concurrency=4)
+        with transport:
+            results = await transport.batch(
+                [("GET", "/")] * 10 + [("GET", "/not-found")] +
+                [("POST", "/payload", {'body': "da body"})])
+            self.assertEqual(4, transport.pool.opened)
+        self.assertEqual([b"Get method output"] * 10,
+                         [result.response.body for result in results[:10]])
+        self.assertEqual(404, results[10].error.code)
+        self.assertEqual(b"7", results[11].result().body)
+
+    @gen_test
+    async def test_response_cache(self):
+        self.transport.response_cache = ResponseCache()
+        for _ in range(2):
+            response = await self.transport.get("/cached", query_string={
+                'key': "asyncio"})
+            self.assertEqual(b"Cached method output", response.body)
+            self.assertEqual("1", response.headers['X-Attempt'])
+        self.assertEqual(1, self.transport.pool.opened)
+        for attempt in ("1", "2"):
+            response = await self.transport.get("/cached", query_string={
+                'key': "asyncio-revalidate", 'max_age': 0})
+            self.assertEqual(200, response.code)
+            self.assertEqual(b"Cached method output", response.body)
+            self.assertEqual(attempt, response.headers['X-Attempt'])
+
+    @gen_test
+    async def test_circuit_breaker(self):
+        limiter = AIMDLimiter(initial_limit=4)
+        with AsyncioTransport(
+                f"http://localhost:{self.http_port()}",
+                circuit_breaker=CircuitBreaker(failure_threshold=2),
+                concurrency_limiter=limiter) as transport:
+            for _ in range(2):
+                with self.assertRaises(HTTPClientError):
+                    await transport.get("/flaky", query_string={
+                        'key': "asyncio-breaker", 'failures': 5})
+            with self.assertRaises(CircuitOpenError):
+                await transport.get("/")
+        self.assertEqual(3, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    @gen_test
+    async def test_retry(self):
+        self.transport.retry_policy = RetryPolicy(backoff_base=0.01)
+        response = await self.transport.get(
+            "/flaky", query_string={'key': "asyncio", 'failures': 2})
+        self.assertEqual(b"Flaky method output after 3 attempts",
+                         response.body)
+        peasant = AsyncPeasant(self.transport, nonce_pool_size=5)
+        nonces = []
+
+        def kwargs_updater(method, **kwargs):
+            nonce = peasant.nonce_pool.pop() or "bad"
+            nonces.append(nonce)
+            kwargs['headers'] = {'nonce': nonce}
+            return kwargs
+
+        self.transport.kwargs_updater = kwargs_updater
+        response = await self.transport.post("/bad-nonce")
+        self.assertEqual(b"Bad nonce method output", response.body)
+        self.assertEqual(["bad", "good"], nonces)
+
+    @gen_test
+    async def test_raise_error(self):
+        with self.assertRaises(HTTPClientError) as context:
+            await self.transport.get("/not-found")
+        self.assertEqual(404, context.exception.code)
+        response = await self.transport.get("/not-found", raise_error=False)
+        self.assertEqual(404, response.code)
+
+    @gen_test
+    async def test_directory_and_nonce(self):
+        peasant = AsyncPeasant(self.transport, nonce_pool_size=5)
+        directory = await peasant.directory()
+        self.assertEqual(f"http://localhost:{self.http_port()}/nonce",
+                         directory['newNonce'])
+        etag = peasant.directory_cache_backend.etag
+        self.assertIsNotNone(etag)
+        await self.transport.set_directory()
+        self.assertEqual(etag, peasant.directory_cache_backend.etag)
+        nonce = await peasant.new_nonce()
+        self.assertTrue(nonce)
+        await peasant._nonce_future
+        self.assertEqual(5, len(peasant.nonce_pool))
+        self.assertNotIn(nonce, [nonce for nonce, _ in
+                                 peasant.nonce_pool._nonces])
+
+    @gen_test
+    async def test_head(self):
+        response = await self.transport.head("/head")
+        self.assertEqual(response.headers.get("head-response"),
+                         "Head method response")
+        self.assertEqual(response.headers.get("user-agent"),
+                         self.transport.user_agent)
+
+    @gen_test
+    async def test_delete(self):
+        response = await self.transport.delete("/delete")
+        self.assertEqual("da body", response.headers.get("request-body"))
+        self.assertEqual(b"Delete method output", response.body)
+
+    @gen_test
+    async def test_get(self):
+        response = await self.transport.get("/")
+        self.assertEqual(response.body, b"Get method output")
+
+    @gen_test
+    async def test_options(self):
+        response = await self.transport.options("/options")
+        self.assertEqual("da body", response.headers.get("request-body"))
+        self.assertEqual(b"Options method output", response.body)
+
+    @gen_test
+    async def test_patch(self):
+        response = await self.transport.patch("/patch", body="da body")
+        self.assertEqual("da body", response.headers.get("request-body"))
+        self.assertEqual(b"Patch method output", response.body)
+
+    @gen_test
+    async def test_post(self):
+        response = await self.transport.post("/post", body="da body")
+        self.assertEqual("da body", response.headers.get("request-body"))
+        self.assertEqual(response.body, b"Post method output")
+
+    @gen_test
+    async def test_put(self):
+        response = await self.transport.put("/put", body="da body")
+        self.assertEqual("da body", response.headers.get("request-body"))
+        self.assertEqual(b"Put method output", response.body)
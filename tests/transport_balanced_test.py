@@ -0,0 +1,246 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from firenado.testing import TornadoAsyncTestCase
+from firenado.launcher import ProcessLauncher
+from peasant.client.overload import (CircuitBreaker, CircuitOpenError,
+                                     clear_registry)
+from peasant.client.transport import fix_address, Transport
+from peasant.client.transport_balanced import (BALANCE_LEAST_OUTSTANDING,
+                                               BalancedTransport, Balancer,
+                                               Endpoint)
+from tests import chdir_fixture_app, PROJECT_ROOT, wait_for_port
+from tornado.testing import gen_test
+from unittest import TestCase
+
+
+class ReplicaTransport(Transport):
+    """ Synchronous transport answering with its own address.
+    """
+
+    def __init__(self, bastion_address, **kwargs):
+        super().__init__(**kwargs)
+        self._bastion_address = fix_address(bastion_address)
+        self.kwargs = kwargs
+        self.closed = False
+
+    def request(self, method: str, path: str, **kwargs: dict):
+        guard = self.enter_guard()
+        self.exit_guard(guard, kwargs.get("code", 200))
+        return f"{method} {self._bastion_address}{path}"
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncReplicaTransport(ReplicaTransport):
+    """ Asynchronous replica transport recording where nonces are fetched
+    from.
+    """
+
+    async def request(self, method: str, path: str, **kwargs: dict):
+        return f"{method} {self._bastion_address}{path}"
+
+    async def new_nonce(self, nonce_path=None):
+        return f"{self._bastion_address}{nonce_path}"
+
+
+class DirectoryPeasant:
+
+    async def directory(self):
+        return {'newNonce': "http://replica0/acme/new-nonce"}
+
+
+class BalancerTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.endpoints = [
+            Endpoint(ReplicaTransport(
+                f"http://replica{index}",
+                circuit_breaker=CircuitBreaker(failure_threshold=1)))
+            for index in range(3)]
+
+    def test_p2c(self):
+        balancer = Balancer(self.endpoints)
+        self.endpoints[1].outstanding = 5
+        self.endpoints[2].outstanding = 10
+        picked = set()
+        for _ in range(20):
+            endpoint = balancer.pick()
+            picked.add(endpoint.address)
+            balancer.release(endpoint)
+        # the most loaded endpoint never wins a choice of two
+        self.assertNotIn("http://replica2", picked)
+        self.assertIn("http://replica0", picked)
+        self.assertEqual([0, 5, 10], [endpoint.outstanding
+                                      for endpoint in self.endpoints])
+
+    def test_least_outstanding(self):
+        balancer = Balancer(self.endpoints,
+                            strategy=BALANCE_LEAST_OUTSTANDING)
+        picked = [balancer.pick() for _ in range(6)]
+        self.assertEqual([2, 2, 2], [endpoint.outstanding
+                                     for endpoint in self.endpoints])
+        self.assertEqual(3, len(set(picked[:3])))
+        with self.assertRaises(ValueError):
+            Balancer(self.endpoints, strategy="round_robin")
+
+    def test_ejection(self):
+        balancer = Balancer(self.endpoints)
+        self.endpoints[0].transport.circuit_breaker.record_failure()
+        self.assertFalse(self.endpoints[0].available)
+        picked = {balancer.pick(exclude=[self.endpoints[1]])
+                  for _ in range(10)}
+        self.assertEqual({self.endpoints[2]}, picked)
+        self.endpoints[2].transport.circuit_breaker.record_failure()
+        self.assertIsNone(balancer.pick(exclude=[self.endpoints[1]]))
+
+
+class BalancedTransportTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.transport = BalancedTransport(
+            ["http://replica0", "http://replica1/", "http://replica1"],
+            transport_class=ReplicaTransport)
+
+    def tearDown(self) -> None:
+        clear_registry()
+
+    def test_request(self):
+        self.assertEqual(2, len(self.transport.endpoints))
+        responses = {self.transport.get("/directory") for _ in range(20)}
+        self.assertEqual({"GET http://replica0/directory",
+                          "GET http://replica1/directory"}, responses)
+        self.assertIn(self.transport.post("http://replica1/new-nonce"),
+                      ("POST http://replica0/new-nonce",
+                       "POST http://replica1/new-nonce"))
+        self.assertEqual([0, 0], [endpoint.outstanding
+                                  for endpoint in self.transport.endpoints])
+        self.transport.close()
+        self.assertTrue(all(endpoint.transport.closed
+                            for endpoint in self.transport.endpoints))
+
+    def test_propagation(self):
+        self.transport.basic_headers = {'User-Agent': "balanced"}
+        self.transport.kwargs_updater = lambda method, **kwargs: kwargs
+        for endpoint in self.transport.endpoints:
+            self.assertEqual("balanced",
+                             endpoint.transport.basic_headers['User-Agent'])
+            self.assertIs(self.transport.kwargs_updater,
+                          endpoint.transport.kwargs_updater)
+
+    def test_ejection(self):
+        first, second = self.transport.endpoints
+        for _ in range(5):
+            first.transport.circuit_breaker.record_failure()
+        responses = {self.transport.get("/") for _ in range(10)}
+        self.assertEqual({"GET http://replica1/"}, responses)
+        for _ in range(5):
+            second.transport.circuit_breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.transport.get("/")
+
+    def test_endpoint_guards(self):
+        transport = BalancedTransport(
+            ["http://replica0", "http://replica1"],
+            transport_class=ReplicaTransport,
+            circuit_breaker=lambda: CircuitBreaker(failure_threshold=1),
+            concurrency_limiter=True)
+        first, second = transport.endpoints
+        self.assertIsNot(first.transport.circuit_breaker,
+                         second.transport.circuit_breaker)
+        self.assertIsNot(first.transport.concurrency_limiter,
+                         second.transport.concurrency_limiter)
+        first.transport.circuit_breaker.record_failure()
+        self.assertEqual([second], transport.healthy_endpoints)
+        for option in ("transport_class", "balance_strategy", "random"):
+            self.assertNotIn(option, first.transport.kwargs)
+        with self.assertRaises(ValueError):
+            BalancedTransport(["http://replica0"],
+                              transport_class=ReplicaTransport,
+                              circuit_breaker=CircuitBreaker())
+
+    def test_new_nonce(self):
+        transport = BalancedTransport(
+            ["http://replica0", "http://replica1"],
+            transport_class=AsyncReplicaTransport)
+        transport.peasant = DirectoryPeasant()
+
+        async def nonces():
+            return {await transport.new_nonce() for _ in range(20)}
+
+        self.assertEqual({"http://replica0/acme/new-nonce",
+                          "http://replica1/acme/new-nonce"},
+                         asyncio.run(nonces()))
+
+    def test_batch(self):
+        results = self.transport.batch([("GET", "/")] * 4)
+        self.assertEqual([0, 1, 2, 3], [result.index for result in results])
+        self.assertTrue(all(result.ok for result in results))
+        self.transport.close()
+        self.assertIsNone(self.transport._executor)
+
+
+class AsyncBalancedTransportTestCase(TornadoAsyncTestCase):
+
+    def get_launcher(self) -> ProcessLauncher:
+        application_dir = chdir_fixture_app("bastiontest")
+        return ProcessLauncher(
+            dir=application_dir, path=PROJECT_ROOT)
+
+    def setUp(self) -> None:
+        super().setUp()
+        wait_for_port(self.http_port())
+        self.transport = BalancedTransport([
+            f"http://localhost:{self.http_port()}",
+            f"http://127.0.0.1:{self.http_port()}"])
+
+    def tearDown(self) -> None:
+        self.transport.close()
+        clear_registry()
+        super().tearDown()
+
+    @gen_test
+    async def test_batch(self):
+        results = await self.transport.batch([("GET", "/")] * 20,
+                                             concurrency=4)
+        self.assertEqual([b"Get method output"] * 20,
+                         [result.result().body for result in results])
+        for endpoint in self.transport.endpoints:
+            self.assertEqual(0, endpoint.outstanding)
+            self.assertLessEqual(1, endpoint.transport.pool.opened)
+        chunks = [chunk async for chunk in self.transport.stream(
+            "GET", "/download", query_string={'size': 1024})]
+        self.assertEqual(1024, len(b"".join(chunks)))
+
+    @gen_test
+    async def test_ejection(self):
+        self.transport.close()
+        self.transport = BalancedTransport([
+            f"http://localhost:{self.http_port()}", "http://127.0.0.1:1"],
+            request_timeout=2)
+        dead = self.transport.endpoints[1]
+        failures = 0
+        for _ in range(100):
+            try:
+                await self.transport.get("/")
+            except OSError:
+                failures += 1
+            if not dead.available:
+                break
+        self.assertEqual(5, failures)
+        for _ in range(10):
+            response = await self.transport.get("/")
+            self.assertEqual(b"Get method output", response.body)
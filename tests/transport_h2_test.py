@@ -0,0 +1,278 @@
+# Copyright 2020-2024 Flavio Garcia
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+from peasant.client.protocol import AsyncPeasant
+from peasant.client.transport_asyncio import HTTPClientError
+from peasant.client.transport_h2 import h2_installed, H2Transport
+import secrets
+import ssl
+from tornado.testing import AsyncTestCase, gen_test
+import unittest
+
+if h2_installed:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+
+
+class H2Server:
+    """ Local h2c server answering every stream after a short delay, so
+    concurrent streams can be counted.
+    """
+
+    def __init__(self, **kwargs):
+        self.delay = kwargs.get("delay", 0.01)
+        self.max_concurrent_streams = kwargs.get("max_concurrent_streams")
+        self.connections = 0
+        self.open_streams = 0
+        self.peak_streams = 0
+        self.sent = 0
+        self.server = None
+        self.port = None
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "localhost", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        connection = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False,
+                                             header_encoding="utf-8"))
+        connection.initiate_connection()
+        if self.max_concurrent_streams:
+            connection.update_settings({
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                    self.max_concurrent_streams,
+            })
+        writer.write(connection.data_to_send())
+        requests = {}
+        window_updated = asyncio.Event()
+        while True:
+            try:
+                data = await reader.read(65536)
+            except ConnectionError:
+                break
+            if not data:
+                break
+            for event in connection.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    requests[event.stream_id] = [dict(event.headers), b""]
+                elif isinstance(event, h2.events.DataReceived):
+                    requests[event.stream_id][1] += event.data
+                    connection.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = requests.pop(event.stream_id)
+                    asyncio.ensure_future(self.respond(
+                        connection, writer, event.stream_id, headers, body,
+                        window_updated))
+                elif isinstance(event, h2.events.WindowUpdated):
+                    window_updated.set()
+            writer.write(connection.data_to_send())
+        writer.close()
+
+    async def respond(self, connection, writer, stream_id, headers, body,
+                      window_updated):
+        self.open_streams += 1
+        self.peak_streams = max(self.peak_streams, self.open_streams)
+        await asyncio.sleep(self.delay)
+        self.open_streams -= 1
+        path, _, query = headers[":path"].partition("?")
+        status = "200"
+        response_headers = [("user-agent", headers.get("user-agent", ""))]
+        if path == "/directory":
+            content = json.dumps({
+                'newNonce': f"http://localhost:{self.port}/nonce"
+            }).encode()
+        elif path == "/nonce":
+            response_headers.append(("replay-nonce",
+                                     secrets.token_urlsafe(16)))
+            content = b""
+        elif path == "/download":
+            content = b"x" * int(query.partition("=")[2])
+        elif path == "/echo":
+            content = f"{headers[':method']} {len(body)}".encode()
+        else:
+            status = "404"
+            content = b"Not found"
+        connection.send_headers(stream_id, [
+            (":status", status),
+            ("content-length", str(len(content))),
+        ] + response_headers, end_stream=not content)
+        writer.write(connection.data_to_send())
+        view = memoryview(content)
+        while view:
+            window = connection.local_flow_control_window(stream_id)
+            if window <= 0:
+                window_updated.clear()
+                await window_updated.wait()
+                continue
+            size = min(window, connection.max_outbound_frame_size, len(view))
+            connection.send_data(stream_id, view[:size].tobytes(),
+                                 end_stream=size == len(view))
+            self.sent += size
+            view = view[size:]
+            writer.write(connection.data_to_send())
+
+
+@unittest.skipUnless(h2_installed, "h2 isn't installed")
+class H2TransportTestCase(AsyncTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = H2Server()
+        self.io_loop.run_sync(self.server.start)
+        self.transport = H2Transport(f"http://localhost:{self.server.port}")
+
+    def tearDown(self) -> None:
+        self.transport.close()
+        self.io_loop.run_sync(self.server.stop)
+        super().tearDown()
+
+    @gen_test
+    async def test_multiplexing(self):
+        responses = await asyncio.gather(
+            *[self.transport.post("/echo", body="da body")
+              for _ in range(20)])
+        self.assertEqual([b"POST 7"] * 20,
+                         [response.body for response in responses])
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(1, self.transport.opened)
+        self.assertGreater(self.server.peak_streams, 1)
+        response = await self.transport.get("/echo")
+        self.assertEqual(self.transport.user_agent,
+                         response.headers.get("User-Agent"))
+        self.assertEqual(1, self.server.connections)
+
+    def test_authority(self):
+        authorities = []
+
+        class Connection:
+            async def request(self, method, authority, *args):
+                authorities.append(authority)
+                return 200, [], b""
+
+        async def connection(*args):
+            return Connection()
+
+        transport = H2Transport("https://example.com")
+        transport.connection = connection
+        for url in ("https://example.com/", "http://[::1]:8080/",
+                    "https://[::1]/", "http://example.com:8443/"):
+            self.io_loop.run_sync(lambda: transport.fetch("GET", url))
+        self.assertEqual(["example.com", "[::1]:8080", "[::1]",
+                          "example.com:8443"], authorities)
+        transport.close()
+
+    def test_ssl_context(self):
+        class Context(ssl.SSLContext):
+            alpn_protocols = None
+
+            def set_alpn_protocols(self, protocols):
+                self.alpn_protocols = protocols
+                super().set_alpn_protocols(protocols)
+
+        context = Context(ssl.PROTOCOL_TLS_CLIENT)
+        transport = H2Transport("https://localhost", ssl_context=context)
+        self.assertIs(context, transport.ssl_context)
+        self.assertIsNone(context.alpn_protocols)
+        self.assertIsNone(transport.pool)
+        transport.close()
+
+    @gen_test
+    async def test_max_concurrent_streams(self):
+        transport = H2Transport(f"http://localhost:{self.server.port}",
+                                max_concurrent_streams=2)
+        with transport:
+            await asyncio.gather(*[transport.get("/echo")
+                                   for _ in range(10)])
+        self.assertEqual(2, self.server.peak_streams)
+
+    @gen_test
+    async def test_server_max_concurrent_streams(self):
+        self.server.max_concurrent_streams = 3
+        await asyncio.gather(*[self.transport.get("/echo")
+                               for _ in range(10)])
+        self.assertEqual(3, self.server.peak_streams)
+
+    @gen_test
+    async def test_large_body(self):
+        body = "x" * 200000
+        response = await self.transport.put("/echo", body=body)
+        self.assertEqual(b"PUT 200000", response.body)
+
+    @gen_test
+    async def test_stream(self):
+        size = 1024 * 1024
+        stream = self.transport.stream("GET", "/download",
+                                       query_string={'size': size})
+        received = len(await stream.__anext__())
+        await asyncio.sleep(0.05)
+        # nothing beyond the stream flow control window is sent until the
+        # received data is consumed
+        self.assertLessEqual(self.server.sent, 65535 + received)
+        async for chunk in stream:
+            received += len(chunk)
+        self.assertEqual(size, received)
+        self.assertEqual(size, self.server.sent)
+
+        async def payload():
+            for _ in range(10):
+                yield b"x" * 10000
+
+        chunks = [chunk async for chunk in self.transport.stream(
+            "POST", "/echo", body=payload())]
+        self.assertEqual(b"POST 100000", b"".join(chunks))
+        with self.assertRaises(HTTPClientError) as context:
+            async for _ in self.transport.stream("GET", "/not-found"):
+                pass
+        self.assertEqual(404, context.exception.code)
+        self.assertEqual(0, self.transport._connections[
+            ("http", "localhost", self.server.port)].open_streams)
+
+    @gen_test
+    async def test_raise_error(self):
+        with self.assertRaises(HTTPClientError) as context:
+            await self.transport.get("/not-found")
+        self.assertEqual(404, context.exception.code)
+        response = await self.transport.get("/not-found", raise_error=False)
+        self.assertEqual(b"Not found", response.body)
+
+    @gen_test
+    async def test_reconnect(self):
+        await self.transport.get("/echo")
+        for connection in self.transport._connections.values():
+            connection.close()
+        await self.transport.get("/echo")
+        self.assertEqual(2, self.transport.opened)
+
+    @gen_test
+    async def test_directory_and_nonce(self):
+        peasant = AsyncPeasant(self.transport)
+        directory = await peasant.directory()
+        self.assertEqual(f"http://localhost:{self.server.port}/nonce",
+                         directory['newNonce'])
+        self.assertTrue(await peasant.new_nonce())
@@ -14,8 +14,14 @@
 
 from firenado.testing import TornadoAsyncTestCase
 from firenado.launcher import ProcessLauncher
+from peasant.client.cache import ResponseCache
+from peasant.client.overload import (AIMDLimiter, CircuitBreaker,
+                                     CircuitOpenError)
+from peasant.client.protocol import Peasant
+from peasant.client.retry import RetryPolicy
 from peasant.client.transport_requests import RequestsTransport
-from tests import chdir_fixture_app, PROJECT_ROOT
+import requests
+from tests import chdir_fixture_app, PROJECT_ROOT, wait_for_port
 from tornado.testing import gen_test
 
 
@@ -29,6 +35,7 @@ class RequestsTransportTestCase(TornadoAsyncTestCase):
 
     def setUp(self) -> None:
         super().setUp()
+        wait_for_port(self.http_port())
         # setting tests simplefilter to ignore because requests uses a
         # keep-alive model, not closing sockets explicitly in many cases.
         # with that will cause the ResourceWarning warn be displayed in testing
@@ -41,6 +48,138 @@ class RequestsTransportTestCase(TornadoAsyncTestCase):
         self.transport = RequestsTransport(
                 f"http://localhost:{self.http_port()}")
 
+    def tearDown(self) -> None:
+        self.transport.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_connection_reuse(self):
+        for _ in range(3):
+            self.transport.get("/")
+        url = f"http://localhost:{self.http_port()}"
+        pools = self.transport.session.get_adapter(url).poolmanager.pools
+        self.assertEqual(1, len(pools))
+        self.assertEqual(1, pools[next(iter(pools.keys()))].num_connections)
+
+    @gen_test
+    async def test_harvest_nonce(self):
+        peasant = Peasant(self.transport, nonce_pool_size=5,
+                          nonce_low_watermark=0)
+        self.transport.new_nonce = lambda: self.transport.head(
+            "/nonce").headers['Replay-Nonce']
+        self.transport.get("/nonce")
+        self.transport.get("/")
+        self.assertEqual(1, len(peasant.nonce_pool))
+        nonce = peasant.nonce_pool._nonces[0][0]
+        self.assertEqual(nonce, peasant.new_nonce())
+
+    @gen_test
+    async def test_stream(self):
+        size = 1024 * 1024
+        chunks = list(self.transport.stream(
+            "GET", "/download", query_string={'size': size},
+            chunk_size=16384))
+        self.assertEqual(size, sum(len(chunk) for chunk in chunks))
+        self.assertEqual(16384, max(len(chunk) for chunk in chunks))
+
+        def payload():
+            for _ in range(10):
+                yield b"x" * 1000
+
+        response = self.transport.post("/payload", data=payload())
+        self.assertEqual(b"10000", response.content)
+        with self.assertRaises(requests.HTTPError):
+            next(self.transport.stream("GET", "/not-found"))
+
+    def test_batch(self):
+        transport = RequestsTransport(
+            f"http://localhost:{self.http_port()}", batch_concurrency=4)
+        with transport:
+            future = transport.submit("GET", "/")
+            self.assertEqual(b"Get method output", future.result().content)
+            results = transport.batch(
+                [("GET", "/")] * 10 + [("GET", "/not-found")] +
+                [("POST", "/payload", {'data': "da body"})])
+            url = f"http://localhost:{self.http_port()}"
+            pools = transport.session.get_adapter(url).poolmanager.pools
+            pool = pools[next(iter(pools.keys()))]
+            self.assertLessEqual(pool.num_connections, 4)
+            results_completed = list(transport.as_completed(
+                [("GET", "/")] * 3, concurrency=2))
+            executor = transport.executor
+        self.assertIsNone(transport._executor)
+        self.assertTrue(executor._shutdown)
+        self.assertEqual([b"Get method output"] * 10,
+                         [result.response.content for result in results[:10]])
+        self.assertEqual(404, results[10].error.response.status_code)
+        self.assertEqual(b"7", results[11].result().content)
+        self.assertEqual(3, len(results_completed))
+
+    def test_retry(self):
+        self.transport.retry_policy = RetryPolicy(backoff_base=0.01)
+        response = self.transport.get(
+            "/flaky", query_string={'key': "requests", 'failures': 2})
+        self.assertEqual(b"Flaky method output after 3 attempts",
+                         response.content)
+        with self.assertRaises(requests.HTTPError):
+            self.transport.get("/flaky", query_string={
+                'key': "requests-exhausted", 'failures': 5})
+
+    def test_response_cache(self):
+        self.transport.response_cache = ResponseCache()
+        for _ in range(2):
+            response = self.transport.get("/cached", query_string={
+                'key': "requests"})
+            self.assertEqual(b"Cached method output", response.content)
+            self.assertEqual("1", response.headers['X-Attempt'])
+        self.assertEqual(1, self.transport.response_cache.hits)
+        for attempt in ("1", "2"):
+            response = self.transport.get("/cached", query_string={
+                'key': "requests-revalidate", 'max_age': 0})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b"Cached method output", response.content)
+            self.assertEqual(attempt, response.headers['X-Attempt'])
+        self.assertNotIn("Replay-Nonce", response.headers)
+
+    def test_circuit_breaker(self):
+        limiter = AIMDLimiter(initial_limit=4)
+        transport = RequestsTransport(
+            f"http://localhost:{self.http_port()}",
+            circuit_breaker=CircuitBreaker(failure_threshold=2),
+            concurrency_limiter=limiter)
+        with transport:
+            for _ in range(2):
+                with self.assertRaises(requests.HTTPError):
+                    transport.get("/flaky", query_string={
+                        'key': "requests-breaker", 'failures': 5})
+            with self.assertRaises(CircuitOpenError):
+                transport.get("/")
+        self.assertEqual(3, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_retry_bad_nonce(self):
+        self.transport.retry_policy = RetryPolicy()
+        peasant = Peasant(self.transport, nonce_pool_size=5,
+                          nonce_low_watermark=0)
+        self.transport.new_nonce = lambda: "bad"
+
+        def kwargs_updater(method, **kwargs):
+            kwargs['headers'] = {'nonce': peasant.new_nonce()}
+            return kwargs
+
+        self.transport.kwargs_updater = kwargs_updater
+        response = self.transport.post("/bad-nonce")
+        self.assertEqual(b"Bad nonce method output", response.content)
+
+    def test_close(self):
+        session = self.transport.session
+        self.assertIs(session, self.transport.session)
+        self.transport.close()
+        self.assertIsNot(session, self.transport.session)
+        with self.transport as transport:
+            session = transport.session
+        self.assertIsNone(self.transport._session)
+
     @gen_test
     async def test_delete(self):
         expected_body = "da body"
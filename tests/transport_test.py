@@ -12,8 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from peasant.client.transport import (concat_url, fix_address, METHOD_POST,
-                                      Transport)
+from peasant.client.transport import (concat_url, fix_address,
+                                      LayeredHeaders, METHOD_GET,
+                                      METHOD_POST, Transport)
 from unittest import TestCase
 
 
@@ -94,3 +95,97 @@ class TransportTestCase(TestCase):
         kwargs = transport.update_kwargs(METHOD_POST, **kwargs)
         self.assertTrue("test" in kwargs)
         self.assertEqual(METHOD_POST, kwargs['test'])
+
+    def test_prepare_request(self):
+        transport = Transport()
+        transport._bastion_address = "http://bastion"
+        transport.basic_headers = {'User-Agent': "Peasant"}
+
+        def kwargs_updater(method, **kwargs):
+            kwargs['test'] = method
+            return kwargs
+
+        transport.kwargs_updater = kwargs_updater
+        url, kwargs = transport.prepare_request(
+            METHOD_GET, "/resource", query_string={"abc": 1},
+            headers={'Accept': "application/json"})
+        self.assertEqual("http://bastion/resource?abc=1", url)
+        self.assertNotIn("query_string", kwargs)
+        self.assertEqual(METHOD_GET, kwargs['test'])
+        self.assertEqual({'User-Agent': "Peasant",
+                          'Accept': "application/json"},
+                         dict(kwargs['headers']))
+
+    def test_verbs_delegate_to_request(self):
+        transport = Transport()
+        transport.request = lambda method, path, **kwargs: (method, path)
+        self.assertEqual((METHOD_POST, "/resource"),
+                         transport.post("/resource"))
+        self.assertEqual((METHOD_GET, "/resource"),
+                         transport.get("/resource"))
+
+    def test_get_headers(self):
+        transport = Transport()
+        transport.basic_headers = {'User-Agent': "Peasant", 'Accept': "*/*"}
+        with self.assertRaises(TypeError):
+            transport.basic_headers['Accept'] = "text/plain"
+
+        headers = transport.get_headers()
+        self.assertEqual({'User-Agent': "Peasant", 'Accept': "*/*"},
+                         dict(headers))
+
+        request_headers = {'Accept': "text/plain", 'X-Test': "1"}
+        headers = transport.get_headers(headers=request_headers)
+        self.assertEqual(3, len(headers))
+        self.assertEqual("text/plain", headers['Accept'])
+        self.assertEqual(["User-Agent", "Accept", "X-Test"], list(headers))
+
+        headers['Authorization'] = "token"
+        del headers['User-Agent']
+        self.assertEqual({'Accept': "text/plain", 'X-Test': "1",
+                          'Authorization': "token"}, dict(headers))
+        self.assertEqual({'Accept': "text/plain", 'X-Test': "1"},
+                         request_headers)
+        self.assertEqual({'User-Agent': "Peasant", 'Accept': "*/*"},
+                         dict(transport.basic_headers))
+
+    def test_layered_headers(self):
+        headers = LayeredHeaders({'A': "1"})
+        self.assertIn("A", headers)
+        self.assertNotIn("B", headers)
+        self.assertEqual({'A': "1"}, headers.copy())
+        with self.assertRaises(KeyError):
+            headers['B']
+
+    def test_get_url(self):
+        transport = Transport(url_cache_size=2)
+        transport._bastion_address = "http://bastion"
+        self.assertEqual("http://bastion", transport.get_url(""))
+        self.assertEqual("http://bastion/?abc=1",
+                         transport.get_url("/", query_string={"abc": 1}))
+        self.assertEqual("http://bastion/resource",
+                         transport.get_url("/resource"))
+        self.assertEqual("http://bastion/resource?abc=1",
+                         transport.get_url("/resource", query_string="abc=1"))
+        self.assertEqual("https://other/resource",
+                         transport.get_url("https://other/resource"))
+        self.assertEqual("HTTP://other/resource/?abc=1",
+                         transport.get_url("HTTP://other/resource",
+                                           query_string={"abc": 1}))
+        with self.assertRaises(TypeError):
+            transport.get_url("/resource", query_string=1)
+
+    def test_url_cache_info(self):
+        transport = Transport(url_cache_size=2)
+        transport._bastion_address = "http://bastion"
+        transport.get_url("/a")
+        transport.get_url("/a", query_string={"abc": 1})
+        transport.get_url("/b")
+        transport.get_url("/c")
+        info = transport.url_cache_info()
+        self.assertEqual(1, info.hits)
+        self.assertEqual(3, info.misses)
+        self.assertEqual(2, info.maxsize)
+        self.assertEqual(2, info.currsize)
+        transport.url_cache_clear()
+        self.assertEqual(0, transport.url_cache_info().currsize)
@@ -12,10 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 from firenado.testing import TornadoAsyncTestCase
 from firenado.launcher import ProcessLauncher
-from peasant.client.transport_tornado import TornadoTransport
-from tests import chdir_fixture_app, PROJECT_ROOT
+from peasant.client.cache import ResponseCache
+from peasant.client.hedge import HedgeBudget, HedgePolicy
+from peasant.client.protocol import AsyncPeasant
+from peasant.client.retry import RetryPolicy
+from peasant.client.transport_tornado import (StreamBufferFullError,
+                                               TornadoTransport)
+from tests import chdir_fixture_app, PROJECT_ROOT, wait_for_port
+from tornado.httpclient import HTTPClientError
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from tornado.testing import gen_test
 
 
@@ -28,9 +36,128 @@ class TornadoTransportTestCase(TornadoAsyncTestCase):
 
     def setUp(self) -> None:
         super().setUp()
+        wait_for_port(self.http_port())
         self.transport = TornadoTransport(
                 f"http://localhost:{self.http_port()}")
 
+    def tearDown(self) -> None:
+        self.transport.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_client_options(self):
+        transport = TornadoTransport(
+            f"http://localhost:{self.http_port()}", client_class="simple",
+            max_clients=50, max_body_size=1024, request_timeout=5)
+        with transport:
+            client = transport.client
+            self.assertIsInstance(client, SimpleAsyncHTTPClient)
+            self.assertEqual(50, client.max_clients)
+            self.assertEqual(1024, client.max_body_size)
+            self.assertEqual(5, client.defaults['request_timeout'])
+            self.assertIsNot(client, self.transport.client)
+            responses = await asyncio.gather(
+                *[transport.get("/") for _ in range(20)])
+        self.assertEqual(20, len(responses))
+        self.assertIsNone(transport._client)
+
+    @gen_test
+    async def test_stream(self):
+        size = 1024 * 1024
+        received = 0
+        async for chunk in self.transport.stream(
+                "GET", "/download", query_string={'size': size}):
+            received += len(chunk)
+        self.assertEqual(size, received)
+
+        async def payload():
+            for _ in range(10):
+                yield b"x" * 1000
+
+        response = await self.transport.post("/payload", body=payload())
+        self.assertEqual(b"10000", response.body)
+        with self.assertRaises(HTTPClientError) as context:
+            async for _ in self.transport.stream("GET", "/not-found"):
+                pass
+        self.assertEqual(404, context.exception.code)
+
+    @gen_test
+    async def test_stream_buffer(self):
+        size = 4 * 1024 * 1024
+        received = 0
+        with self.assertRaises(StreamBufferFullError):
+            async for chunk in self.transport.stream(
+                    "GET", "/download", query_string={'size': size},
+                    buffer_size=256 * 1024):
+                received += len(chunk)
+                # a slow consumer
+                await asyncio.sleep(0.05)
+        self.assertLess(received, size)
+        received = 0
+        async for chunk in self.transport.stream(
+                "GET", "/download", query_string={'size': size},
+                buffer_size=size):
+            received += len(chunk)
+        self.assertEqual(size, received)
+        # closing the stream stops the fetch
+        stream = self.transport.stream("GET", "/download",
+                                       query_string={'size': size})
+        await stream.__anext__()
+        await stream.aclose()
+        response = await self.transport.get("/")
+        self.assertEqual(200, response.code)
+
+    @gen_test
+    async def test_retry(self):
+        self.transport.retry_policy = RetryPolicy(backoff_base=0.01)
+        response = await self.transport.get(
+            "/flaky", query_string={'key': "tornado", 'failures': 2})
+        self.assertEqual(b"Flaky method output after 3 attempts",
+                         response.body)
+        with self.assertRaises(HTTPClientError) as context:
+            await self.transport.get("/flaky", query_string={
+                'key': "tornado-exhausted", 'failures': 5})
+        self.assertEqual(503, context.exception.code)
+
+    @gen_test
+    async def test_response_cache(self):
+        self.transport.response_cache = ResponseCache()
+        for attempt in ("1", "2"):
+            response = await self.transport.get("/cached", query_string={
+                'key': "tornado", 'max_age': 0})
+            self.assertEqual(200, response.code)
+            self.assertEqual(b"Cached method output", response.body)
+            self.assertEqual(attempt, response.headers['X-Attempt'])
+        self.assertEqual(0, self.transport.response_cache.hits)
+
+    @gen_test
+    async def test_hedge(self):
+        policy = HedgePolicy(min_samples=1, budget=HedgeBudget(ratio=1))
+        policy.latencies.record(0.05)
+        self.transport.hedge_policy = policy
+        response = await self.transport.get(
+            "/slow", query_string={'key': "tornado", 'delay': 3})
+        self.assertEqual(b"Slow method output from attempt 2",
+                         response.body)
+        self.assertEqual(0, policy.budget.tokens)
+        self.assertEqual(2, len(policy.latencies))
+
+    @gen_test
+    async def test_harvest_nonce(self):
+        peasant = AsyncPeasant(self.transport, nonce_pool_size=5)
+
+        async def new_nonce():
+            response = await self.transport.head("/nonce")
+            return response.headers['Replay-Nonce']
+
+        self.transport.new_nonce = new_nonce
+        await self.transport.get("/nonce")
+        self.assertEqual(1, len(peasant.nonce_pool))
+        nonce = peasant.nonce_pool._nonces[0][0]
+        self.assertEqual(nonce, await peasant.new_nonce())
+        await peasant._nonce_future
+        self.assertEqual(5, len(peasant.nonce_pool))
+
     @gen_test
     async def test_head(self):
         try: